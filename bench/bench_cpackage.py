@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# Synthetic-project benchmarks for amigomake's own build overhead
+#
+# Generates a CPackage tree with a configurable number of sources and headers,
+# include depth and fan-out, then times the individual CPackage phases for
+# cold, no-op and single-header-touch builds. The compiler, C++ compiler and
+# archiver are replaced by a stub that only creates its output file, so the
+# numbers measure amigomake itself rather than the toolchain.
+#
+# Usage:
+#   python bench/bench_cpackage.py [--files N] [--headers N] [--depth N]
+#                                  [--fanout N] [--repeat N] [--json PATH]
+from __future__ import print_function
+import argparse
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+
+import amigo_config
+amigo_config.init()
+
+from cpackage import CPackage
+from x86_platform import X86Platform
+
+# (phase name, CPackage attribute) pairs timed by TimedCPackage
+PHASES = [
+    ('collect_files', '_collect_files'),
+    ('populate_src_maps', '_CPackage__populate_src_maps'),
+    ('needs_recompile', '_CPackage__needs_recompile'),
+    ('compile', '_compile'),
+    ('link', '_link'),
+]
+
+SCENARIOS = ['cold', 'noop', 'header_touch']
+
+STUB_COMPILER = """#!/bin/sh
+# Stub compiler: creates the file passed with -o and nothing else
+# (arguments may come in an @response file)
+case "$1" in
+    @*) set -- $(cat "${1#@}");;
+esac
+out=
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o) out="$2"; shift;;
+    esac
+    shift
+done
+[ -n "$out" ] && : > "$out"
+exit 0
+"""
+
+STUB_ARCHIVER = """#!/bin/sh
+# Stub archiver: 'ar -r <output> <objs...>' creates <output>
+case "$1" in
+    @*) set -- $(cat "${1#@}");;
+esac
+: > "$2"
+exit 0
+"""
+
+
+# CPackage that records the wall time of each benchmarked phase
+# Defined at module level so the compiler pool can pickle it
+class TimedCPackage(CPackage):
+    def __init__(self, *args, **kwargs):
+        super(TimedCPackage, self).__init__(*args, **kwargs)
+        self.timings = dict((phase, 0.0) for phase, _ in PHASES)
+
+    def __timed(self, phase, func, *args):
+        start_time = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.timings[phase] += time.time() - start_time
+
+    def _collect_files(self):
+        return self.__timed('collect_files', super(TimedCPackage, self)._collect_files)
+
+    def _CPackage__populate_src_maps(self, *args):
+        return self.__timed('populate_src_maps', CPackage._CPackage__populate_src_maps, self, *args)
+
+    def _CPackage__needs_recompile(self):
+        return self.__timed('needs_recompile', CPackage._CPackage__needs_recompile, self)
+
+    def _compile(self, platform):
+        return self.__timed('compile', super(TimedCPackage, self)._compile, platform)
+
+    def _link(self, platform):
+        return self.__timed('link', super(TimedCPackage, self)._link, platform)
+
+
+# Writes an executable shell script
+def write_script(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+# Generates a synthetic package tree under root
+# Headers are spread over `depth` levels, each header including `fanout`
+# headers of the next level; each source includes `fanout` level 0 headers
+# Returns the header that sits in the middle of the include hierarchy
+def generate_tree(root, num_files, num_headers, depth, fanout, seed=0):
+    rand = random.Random(seed)
+    depth = max(1, min(depth, num_headers))
+    levels = [[] for _ in range(depth)]
+    for index in range(num_headers):
+        levels[index % depth].append('l%d/h%d.h' % (index % depth, index))
+
+    inc_dir = os.path.join(root, 'inc')
+    for level, headers in enumerate(levels):
+        os.makedirs(os.path.join(inc_dir, 'l%d' % level))
+        next_level = levels[level + 1] if level + 1 < depth else []
+        for header in headers:
+            guard = header.replace('/', '_').replace('.', '_').upper()
+            includes = rand.sample(next_level, min(fanout, len(next_level)))
+            with open(os.path.join(inc_dir, header), 'w') as f:
+                f.write('#ifndef %s\n#define %s\n' % (guard, guard))
+                for include in includes:
+                    f.write('#include "%s"\n' % include)
+                f.write('int %s_value(void);\n#endif\n' % guard.lower())
+
+    for index in range(num_files):
+        src_dir = os.path.join(root, 'src', 'd%d' % (index // 100))
+        if not os.path.exists(src_dir):
+            os.makedirs(src_dir)
+        includes = rand.sample(levels[0], min(fanout, len(levels[0])))
+        with open(os.path.join(src_dir, 'f%d.c' % index), 'w') as f:
+            for include in includes:
+                f.write('#include "%s"\n' % include)
+            f.write('int f%d(void) { return %d; }\n' % (index, index))
+
+    return os.path.join(inc_dir, levels[depth // 2][0])
+
+
+# Creates a native platform whose tools are the stub scripts in tools_dir
+def stub_platform(tools_dir):
+    compiler = os.path.join(tools_dir, 'stubcc')
+    archiver = os.path.join(tools_dir, 'stubar')
+    write_script(compiler, STUB_COMPILER)
+    write_script(archiver, STUB_ARCHIVER)
+    platform = X86Platform('x86_64')
+    platform._set_default_flags('CC', compiler)
+    platform._set_default_flags('CXX', compiler)
+    platform._set_default_flags('AR', archiver)
+    return platform
+
+
+# Runs a single build of the package tree and returns the phase timings
+def run_build(package_dir, platform, num_threads):
+    package = TimedCPackage(package_dir, CPackage.STATIC_LIB, 'bench', num_threads)
+    start_time = time.time()
+    package.build(platform)
+    timings = dict(package.timings)
+    timings['total'] = time.time() - start_time
+    return timings
+
+
+# Runs one scenario `repeat` times and returns the per-run timings
+def run_scenario(scenario, package_dir, platform, touch_header, repeat, num_threads):
+    runs = []
+    build_dir = os.path.join(package_dir, 'build')
+    for _ in range(repeat):
+        if scenario == 'cold':
+            if os.path.exists(build_dir):
+                shutil.rmtree(build_dir)
+        else:
+            # Make sure outputs exist before measuring incremental behaviour
+            run_build(package_dir, platform, num_threads)
+            if scenario == 'header_touch':
+                # Move the mtime clearly past the objects regardless of fs granularity
+                future = time.time() + 2
+                os.utime(touch_header, (future, future))
+        runs.append(run_build(package_dir, platform, num_threads))
+    return runs
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+# Prints min/median of every phase for each scenario
+def print_report(results):
+    columns = [phase for phase, _ in PHASES] + ['total']
+    print(('%-14s' % 'scenario') + ''.join('%20s' % column for column in columns))
+    for scenario in SCENARIOS:
+        if scenario not in results:
+            continue
+        runs = results[scenario]
+        row = '%-14s' % scenario
+        for column in columns:
+            values = [run[column] for run in runs]
+            row += '%20s' % ('%.4f/%.4f' % (min(values), median(values)))
+        print(row)
+    print('(seconds, min/median)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark amigomake on a synthetic CPackage tree')
+    parser.add_argument('--files', type=int, default=500, help='Number of source files')
+    parser.add_argument('--headers', type=int, default=200, help='Number of headers')
+    parser.add_argument('--depth', type=int, default=4, help='Header include depth')
+    parser.add_argument('--fanout', type=int, default=4, help='Includes per file')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario')
+    parser.add_argument('--threads', type=int, default=None, help='Compiler pool size')
+    parser.add_argument('--scenario', dest='scenarios', action='append', choices=SCENARIOS,
+                        help='Scenario to run, may be specified multiple times (all by default)')
+    parser.add_argument('--json', dest='json_path', help='Write the raw timings to a JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated tree')
+    params = parser.parse_args()
+
+    scenarios = params.scenarios or SCENARIOS
+    workdir = tempfile.mkdtemp(prefix='amigomake-bench-')
+    cwd = os.getcwd()
+    devnull = open(os.devnull, 'w')
+    try:
+        package_dir = os.path.join(workdir, 'project')
+        touch_header = generate_tree(package_dir, params.files, params.headers,
+                                     params.depth, params.fanout)
+        platform = stub_platform(workdir)
+        os.chdir(workdir)
+        results = {}
+        for scenario in scenarios:
+            # Keep amigomake's progress output out of the report
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                results[scenario] = run_scenario(scenario, 'project', platform, touch_header,
+                                                 params.repeat, params.threads)
+            finally:
+                sys.stdout = stdout
+        print('files=%d headers=%d depth=%d fanout=%d repeat=%d' %
+              (params.files, params.headers, params.depth, params.fanout, params.repeat))
+        print_report(results)
+        if params.json_path:
+            with open(os.path.join(cwd, params.json_path), 'w') as f:
+                json.dump({'config': vars(params), 'results': results}, f, indent=2)
+    finally:
+        os.chdir(cwd)
+        devnull.close()
+        if params.keep:
+            print('Tree kept in ' + workdir)
+        else:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
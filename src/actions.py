@@ -0,0 +1,140 @@
+from package import Package, error_str
+from cpackage import CPackage
+from external_cpackage import ExternalCPackage
+from build_graph import BuildGraph
+from build_stats import BuildStats
+from header_report import HeaderReport
+import build_history
+import ninja_writer
+import pgo
+import sys
+
+
+# Returns the packages defined at the top level of the AmigoMakefile
+# that no other package depends on
+def root_packages(makefile):
+    packages = [value for value in vars(makefile).values() if isinstance(value, Package)]
+    dependencies = set()
+
+    def add_deps(package):
+        for dep in package.deps():
+            if dep not in dependencies:
+                dependencies.add(dep)
+                add_deps(dep)
+
+    for package in packages:
+        add_deps(package)
+    roots = [package for package in packages if package not in dependencies]
+    return sorted(roots, key=lambda package: package.name())
+
+
+# Returns all packages the root packages depend on, dependencies first
+def all_packages(roots):
+    packages = []
+
+    def add(package):
+        if package in packages:
+            return
+        for dep in package.deps():
+            add(dep)
+        packages.append(package)
+
+    for root in roots:
+        add(root)
+    return packages
+
+
+# Returns a file name that is unique per platform when building several archs
+def platform_file_name(name, ext, platform, params):
+    if len(params.archs) > 1:
+        return name + '-' + platform.unique_name() + ext
+    return name + ext
+
+
+# Writes build.ninja and compile_commands.json for the root packages
+def ninja(makefile, platform, params):
+    packages = root_packages(makefile)
+    ninja_path = platform_file_name('build', '.ninja', platform, params)
+    compdb_path = platform_file_name('compile_commands', '.json', platform, params)
+    print (('\t%-15s\t' % ('ninja:')) + 'Writing ' + ninja_path + ' and ' + compdb_path)
+    ninja_writer.generate(packages, platform, ninja_path, compdb_path)
+
+
+# Writes the package dependency graph as DOT and JSON, annotated with the
+# build times recorded by previous builds, and prints the critical path
+def graph(makefile, platform, params):
+    build_graph = BuildGraph(root_packages(makefile), build_history.package_times(platform))
+    dot_path = platform_file_name('amigo_graph', '.dot', platform, params)
+    json_path = platform_file_name('amigo_graph', '.json', platform, params)
+    print (('\t%-15s\t' % ('graph:')) + 'Writing ' + dot_path + ' and ' + json_path + '\n')
+    with open(dot_path, 'w') as f:
+        f.write(build_graph.to_dot())
+    with open(json_path, 'w') as f:
+        f.write(build_graph.to_json())
+    build_graph.print_report()
+
+
+# Prints the build time trends recorded in the build history and flags
+# regressions such as slower no-op builds or headers triggering more rebuilds
+def stats(makefile, platform, params):
+    builds = build_history.builds(platform)
+    if not builds:
+        print (('\t%-15s\t' % ('stats:')) + 'No builds recorded for ' + platform.build_name())
+        return
+    BuildStats(builds, build_history.header_triggers(platform)).print_report()
+
+
+# Ranks the headers of the C packages by the compile time their changes cost,
+# flags include cycles and precompiled header or splitting candidates
+# and writes the full report to amigo_headers.json
+def headers(makefile, platform, params):
+    scanned = []
+    for package in all_packages(root_packages(makefile)):
+        if isinstance(package, CPackage) and not isinstance(package, ExternalCPackage):
+            package.scan(platform, dep_headers=True)
+            scanned.append((package.name(), package.sources(), package.header_to_sources(),
+                            package.include_graph()))
+    report = HeaderReport(scanned, build_history.compile_times(platform),
+                          build_history.header_changes(platform))
+    json_path = platform_file_name('amigo_headers', '.json', platform, params)
+    print (('\t%-15s\t' % ('headers:')) + 'Writing ' + json_path + '\n')
+    with open(json_path, 'w') as f:
+        f.write(report.to_json())
+    report.print_report()
+
+
+# Runs the AmigoMakefile's build action with instrumented C packages
+# (built in build/<platform>-pgo-instrument), clearing the profiles of the
+# previous training. The train action then runs the instrumented executables
+def pgo_instrument(makefile, platform, params):
+    if not hasattr(makefile, 'build'):
+        print (error_str('ERROR') + ': pgo-instrument needs a build action in the AmigoMakefile')
+        sys.exit(1)
+    pgo.reset(platform)
+    makefile.build(platform, params)
+    print (('\t%-15s\t' % ('pgo:')) + 'Run the train action to write profiles to ' + pgo.raw_dir(platform))
+
+
+# Merges the profiles written by the train action and runs the AmigoMakefile's
+# build action optimized with them (built in build/<platform>-pgo-optimize)
+# Objects already optimized are only recompiled when their profile changed
+def pgo_optimize(makefile, platform, params):
+    if not hasattr(makefile, 'build'):
+        print (error_str('ERROR') + ': pgo-optimize needs a build action in the AmigoMakefile')
+        sys.exit(1)
+    if not pgo.merge(platform):
+        print (error_str('ERROR') + ': No profiles in ' + pgo.raw_dir(platform) +
+               ', run pgo-instrument and train first')
+        sys.exit(1)
+    makefile.build(platform, params)
+
+
+# Actions provided by amigomake when the AmigoMakefile doesn't define them
+BUILTIN_ACTIONS = {
+    'ninja': ninja,
+    'graph': graph,
+    'stats': stats,
+    'headers': headers,
+    'pgo-instrument': pgo_instrument,
+    'pgo-optimize': pgo_optimize,
+}
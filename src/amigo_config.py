@@ -3,8 +3,42 @@ def init():
     global GCC
     global CXX11
     global VERSION
+    global COMMAND
+    global MAKEFILE
+    global JOBS
+    global REMOTE_WORKERS
+    global REMOTE_TIMEOUT
+    global SCAN_CONDITIONALS
+    global SCAN_HEAD_ONLY
+    global MAX_LOAD
+    global MEM_RESERVE_MB
+    global JOB_MEMORY_MB
+    global STATE_DIR
+    global LTO
+    global PGO
+    global KEEP_GOING
+    global CACHE_URL
+    global CACHE_MODE
+    global CACHE_TIMEOUT
 
     VERBOSE = False
     GCC = False
     CXX11 = False
     VERSION = '0.1.2'
+    COMMAND = None
+    MAKEFILE = None
+    JOBS = None
+    REMOTE_WORKERS = []
+    REMOTE_TIMEOUT = 300
+    SCAN_CONDITIONALS = False
+    SCAN_HEAD_ONLY = False
+    MAX_LOAD = None
+    MEM_RESERVE_MB = 1024
+    JOB_MEMORY_MB = 512
+    STATE_DIR = None
+    LTO = False
+    PGO = None
+    KEEP_GOING = False
+    CACHE_URL = None
+    CACHE_MODE = 'rw'
+    CACHE_TIMEOUT = 10
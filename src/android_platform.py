@@ -1,7 +1,36 @@
 from platform import Platform, Toolchain
+from file_lock import FileLock
+from package import error_str
 from subprocess import call
 import amigo_config
+import json
 import os
+import shutil
+import sys
+
+# Written into a generated toolchain, with what it was generated for
+TOOLCHAIN_STAMP = '.amigo_toolchain'
+
+
+# Returns the STL the standalone toolchains are generated with, 'default'
+# when it's left to the NDK (whose default depends on its revision)
+def default_stl():
+    if amigo_config.CXX11:
+        return 'libc++'
+    return 'default'
+
+
+# Returns the Pkg.Revision of an NDK, None if unknown
+def ndk_revision(ndk_path):
+    try:
+        with open(os.path.join(ndk_path, 'source.properties')) as f:
+            for line in f:
+                key, _, value = line.partition('=')
+                if key.strip() == 'Pkg.Revision':
+                    return value.strip()
+    except (IOError, OSError):
+        pass
+    return None
 
 
 class AndroidPlatform(Platform):
@@ -82,6 +111,10 @@ class AndroidPlatform(Platform):
     def gcc_libs(self):
         return os.path.join(self.__toolchain_install_path, "lib/gcc/" + self.name() + "/" + self.__toolchain_version)
 
+    # Generates the standalone toolchain, unless the one in the install path
+    # was generated for the same NDK revision, arch, API level and STL
+    # Concurrent builds wait on a lock for the one generating it, it's
+    # generated in a temp dir and moved in place once complete
     def __generate_toolchain(self):
         arch_arg = ''
         if 'armv7' in self.__arch:
@@ -93,14 +126,48 @@ class AndroidPlatform(Platform):
         elif 'x86' == self.__arch:
             arch_arg = '--arch x86'
 
-        builder = os.path.join(self.sdk_path(), "build/tools/make_standalone_toolchain.py --force")
-        api = '--api ' + self.sdk_version()
-        install_dir = "--install-dir=" + self.__toolchain_install_path
-        cxx11 = ''
-        if amigo_config.CXX11:
-            cxx11 = '--stl=libc++'
-        call_str = builder + " " + arch_arg + " " + api + " " + install_dir + " " + cxx11
-        if amigo_config.VERBOSE:
-            print (call_str)
-        call([call_str], shell=True)
+        stamp = {
+            'ndk': ndk_revision(self.sdk_path()),
+            'arch': arch_arg,
+            'api': self.sdk_version(),
+            'stl': default_stl(),
+        }
+        path = self.__toolchain_install_path
+        stamp_path = os.path.join(path, TOOLCHAIN_STAMP)
+        with FileLock(path + '.lock'):
+            if stamp['ndk'] is not None and _read_stamp(stamp_path) == stamp:
+                self.__toolchain_generated = True
+                return
+            print (('\t%-15s\t' % ('Toolchain:')) + 'Generating ' + path)
+            tmp_path = path + '.tmp'
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path)
+            builder = os.path.join(self.sdk_path(), "build/tools/make_standalone_toolchain.py --force")
+            api = '--api ' + self.sdk_version()
+            install_dir = "--install-dir=" + tmp_path
+            call_str = builder + " " + arch_arg + " " + api + " " + install_dir
+            if stamp['stl'] != 'default':
+                call_str += " --stl=" + stamp['stl']
+            if amigo_config.VERBOSE:
+                print (call_str)
+            if call([call_str], shell=True) != 0 or not os.path.exists(tmp_path):
+                print (('\t%-15s\t' % ('Toolchain:')) + error_str('ERROR') + ': Generating ' + path + ' failed!')
+                sys.exit(1)
+            with open(os.path.join(tmp_path, TOOLCHAIN_STAMP), 'w') as f:
+                json.dump(stamp, f)
+            if os.path.exists(path):
+                old_path = path + '.old'
+                if os.path.exists(old_path):
+                    shutil.rmtree(old_path)
+                os.rename(path, old_path)
+                shutil.rmtree(old_path)
+            os.rename(tmp_path, path)
         self.__toolchain_generated = True
+
+
+def _read_stamp(stamp_path):
+    try:
+        with open(stamp_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
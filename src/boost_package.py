@@ -1,35 +1,105 @@
 from android_platform import AndroidPlatform
 from ios_platform import IOSPlatform
 from external_cpackage import ExternalCPackage
-from subprocess import call
+from content_hashes import ContentHashes
+from package import error_str
+from subprocess import call, Popen, PIPE
+import amigo_config
+import launcher
 import os
+import re
+import shutil
 
 boost_libs = ('date_time,random,' +
               'iostreams,regex,' +
               'signals,system,thread')
 
+# Boost libraries that need compiling (the others are header-only)
+COMPILED_LIBS = set([
+    'atomic', 'chrono', 'context', 'coroutine', 'date_time', 'filesystem', 'graph', 'iostreams',
+    'locale', 'log', 'program_options', 'random', 'regex', 'serialization', 'signals', 'system',
+    'test', 'thread', 'timer', 'wave',
+])
+# Compiled libraries other compiled libraries link
+LIB_DEPS = {
+    'chrono': ['system'],
+    'coroutine': ['context', 'system'],
+    'filesystem': ['system'],
+    'locale': ['system'],
+    'log': ['date_time', 'filesystem', 'regex', 'system', 'thread'],
+    'thread': ['chrono', 'date_time', 'system'],
+    'timer': ['chrono', 'system'],
+    'wave': ['date_time', 'filesystem', 'system', 'thread'],
+}
+# Boost headers (dir or header name) whose library has another name
+HEADER_LIBS = {
+    'archive': 'serialization',
+    'asio': 'system',
+    'signal': 'signals',
+}
+INCLUDE_RE = re.compile(r'^\s*#\s*(?:include|import)\s*[<"]boost/([A-Za-z0-9_.]+)', re.MULTILINE)
+LINK_RE = re.compile(r'-lboost_([A-Za-z0-9_]+)')
+
 
 class Boost(ExternalCPackage):
     def __init__(self, version, rootdir):
         super(Boost, self).__init__(version, rootdir)
         self.set_zip_name("boost_" + version.replace(".", "_") + ".tar.bz2")
         self.set_url("http://surfnet.dl.sourceforge.net/project/boost/boost/" + version + "/" + self.zip_name())
+        # Packages whose includes and links select the compiled libraries
+        self.__users = []
+        self.__libraries = None
+
+    # Builds only the libraries the packages include (#include <boost/...>)
+    # or link (-lboost_...), instead of boost_libs
+    # boost_libs is built if they don't use a compiled library
+    def set_users(self, packages):
+        self.__users = packages
+        self.__libraries = None
+
+    # Returns the comma separated libraries to build
+    def libraries(self):
+        if self.__libraries is None:
+            self.__libraries = self.__find_libraries()
+        return self.__libraries
+
+    def __find_libraries(self):
+        libs = set()
+        for package in self.__users:
+            libs.update(_used_libs(package))
+        pending = list(libs)
+        while pending:
+            for lib in LIB_DEPS.get(pending.pop(), []):
+                if lib not in libs:
+                    libs.add(lib)
+                    pending.append(lib)
+        if not libs:
+            return boost_libs
+        return ','.join(sorted(libs))
+
+    # The installed libraries depend on the users
+    def _cache_strings(self, platform, env_vars, configure):
+        return super(Boost, self)._cache_strings(platform, env_vars, configure) + [self.libraries()]
+
+    # Returns the b2 -j argument, with the job count capped like make's
+    def __b2_jobs(self):
+        return ' '.join(arg for arg in self._make_jobs() if arg.startswith('-j'))
 
     def _build_android(self, platform, install_dir, env_vars):
         os.chdir(self.local_path())
         platform.init_env_vars(env_vars)
-        call(["./bootstrap.sh --with-libraries="+boost_libs], shell=True)
+        call(["./bootstrap.sh --with-libraries="+self.libraries()], shell=True)
         self.apply_patches()
         self.__user_config_jam_android(platform, install_dir)
         self.__project_config_jam(install_dir)
         configure = (
-            "./b2 link=static threading=multi --layout=unversioned target-os=linux toolset=android-arm -d+2 install")
+            "./b2 " + self.__b2_jobs() + " link=static threading=multi --layout=unversioned target-os=linux toolset=android-arm -d+2 install")
         super(Boost, self)._build(platform, env_vars, configure)
 
     def _build_ios(self, platform, install_dir, env_vars):
         os.chdir(self.local_path())
         platform.init_env_vars(env_vars)
-        call(["./bootstrap.sh --with-libraries="+boost_libs], shell=True)
+        call(["./bootstrap.sh --with-libraries="+self.libraries()], shell=True)
         self.apply_patches()
         self.__user_config_jam_ios(platform)
         self.__project_config_jam(install_dir)
@@ -41,49 +111,77 @@ class Boost(ExternalCPackage):
             toolset += '-' + platform.version() + '~iphonesim'
             arch = 'x86'
         cxxflags = "cxxflags='-I" + os.path.join(install_dir, "include")+"'"
-        configure = ("./bjam toolset=" + toolset + " architecture=" + arch + 
+        configure = ("./bjam " + self.__b2_jobs() + " toolset=" + toolset + " architecture=" + arch + 
                      " target-os=iphone macosx-version="+ target +"-" + platform.version() +
                      " define=_LITTLE_ENDIAN link=static install " + cxxflags)
         super(Boost, self)._build(platform, env_vars, configure)
 
+    # Merges the libboost_*.a libs b2 installed into libboost.a
+    # The libs are moved out of lib (so they aren't linked or crushed twice)
+    # and merged archive to archive, members with the same name in different
+    # libs are all kept
+    # A build's libs replace those of the previous one (another version or
+    # library set)
+    # The merge is skipped when the libs didn't change since the last one
     def _post_build(self, platform, env_vars=None):
         install_dir = os.path.abspath(self.install_dir(platform))
-        obj_path = os.path.join(self.local_path(), 'tmp/obj')
         lib_path = os.path.join(install_dir, 'lib')
-
-        if not os.path.exists(obj_path):
-            os.makedirs(obj_path)
-        os.chdir(obj_path)
-        # Find lib files
-        lib_files = set()
+        components_path = os.path.join(install_dir, 'components')
+        installed_libs = []
         for (dirpath, dirnames, filenames) in os.walk(lib_path):
             for filename in filenames:
                 if filename.startswith('libboost_') and filename.endswith('.a'):
-                    lib_files.add(os.path.join(dirpath, filename))
-        # Extract objects
-        ar = platform.flags('AR')
-        for lib_file in lib_files:
+                    installed_libs.append(os.path.join(dirpath, filename))
+        if installed_libs and os.path.exists(components_path):
+            shutil.rmtree(components_path)
+        if not os.path.exists(components_path):
+            os.makedirs(components_path)
+        # Move newly installed libs
+        for installed_lib in installed_libs:
+            lib_file = os.path.join(components_path, os.path.basename(installed_lib))
+            os.rename(installed_lib, lib_file)
             if isinstance(platform, IOSPlatform):
                 lipo = platform.flags('LIPO')
                 call([lipo + ' -thin ' + platform.arch() + ' ' + lib_file + ' -output ' + lib_file],
                      shell=True)
-            call([ar + " -x " + lib_file], shell=True)
-            os.remove(lib_file)
-        # Find obj files
-        obj_files = []
-        for (dirpath, dirnames, filenames) in os.walk(obj_path):
-            for filename in filenames:
-                if filename.endswith('.o'):
-                    obj_files.append(os.path.join(dirpath, filename))
-        # Compile 1 output lib
+        lib_files = sorted(os.path.join(components_path, filename)
+                           for filename in os.listdir(components_path) if filename.endswith('.a'))
         output = os.path.join(lib_path, 'libboost.a')
-        ar_flag = 'rv'
-        if isinstance(platform, IOSPlatform):
-            ar_flag = 'crus'
-        call_str = ar + ' ' + ar_flag + ' ' + output + " " + (' '.join(obj_files))
-        call([call_str], shell=True)
+        hashes = ContentHashes(os.path.join(install_dir, '.amigo', 'hashes.json'))
+        signature = hashes.signature(lib_files)
+        if lib_files and not (os.path.exists(output) and hashes.matches(output, signature)):
+            print (('\t%-15s\t' % (self.name() + ':')) + 'Merging ' + str(len(lib_files)) + ' libs')
+            if self.__merge(platform, lib_files, output):
+                hashes.set(output, signature)
+                hashes.save()
         super(Boost, self)._post_build(platform)
 
+    # Merges static libs into output, with an ar MRI script (libtool on iOS)
+    # Returns whether it succeeded
+    def __merge(self, platform, lib_files, output):
+        tmp_output = output + '.tmp'
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+        if isinstance(platform, IOSPlatform):
+            status = call(launcher.split(platform.llvm_tool('libtool')) +
+                          ['-static', '-o', tmp_output] + lib_files)
+        else:
+            script = 'CREATE ' + tmp_output + '\n'
+            for lib_file in lib_files:
+                script += 'ADDLIB ' + lib_file + '\n'
+            script += 'SAVE\nEND\n'
+            if amigo_config.VERBOSE:
+                print (script)
+            ar = platform.flags('AR') or platform.default_flags('AR')
+            process = Popen(launcher.split(ar) + ['-M'], stdin=PIPE, env=platform.var_env())
+            process.communicate(script.encode('utf-8'))
+            status = process.returncode
+        if status != 0 or not os.path.exists(tmp_output):
+            print (('\t%-15s\t' % (self.name() + ':')) + error_str('ERROR') + ': Merging libs failed!')
+            return False
+        os.rename(tmp_output, output)
+        return True
+
     def _build(self, platform, env_vars=None, configure=""):
         install_dir = os.path.abspath(self.install_dir(platform))
         if isinstance(platform, AndroidPlatform):
@@ -93,10 +191,10 @@ class Boost(ExternalCPackage):
         else:
             os.chdir(self.local_path())
             platform.init_env_vars(env_vars)
-            call(["./bootstrap.sh --with-libraries="+boost_libs], shell=True)
+            call(["./bootstrap.sh --with-libraries="+self.libraries()], shell=True)
             self.__project_config_jam(install_dir)
             cxxflags = "cxxflags='-I" + os.path.join(install_dir, "include") + " -fPIC'"
-            configure = './b2 toolset=clang link=static install ' + cxxflags
+            configure = './b2 ' + self.__b2_jobs() + ' toolset=clang link=static install ' + cxxflags
 
             super(Boost, self)._build(platform, env_vars, configure)
 
@@ -106,7 +204,7 @@ class Boost(ExternalCPackage):
     def __project_config_jam(self, install_dir):
         config_file = os.path.join(self.local_path(), 'project-config.jam')
         libs_str = ''
-        for boost_lib in boost_libs.split(','):
+        for boost_lib in self.libraries().split(','):
             libs_str += ' --with-'+boost_lib
         to_write = """libraries ={LIBS} ;
 option.set prefix : {ROOTDIR}/ ;
@@ -240,3 +338,22 @@ using android : arm : {CXX} :
         f = open(config_file, 'w')
         f.write(to_write.format(**context))
         f.close()
+
+
+# Returns the compiled Boost libraries a package includes or links
+def _used_libs(package):
+    libs = set()
+    package._collect_files()
+    for file_path in package.files():
+        try:
+            with open(file_path) as f:
+                text = f.read()
+        except (IOError, OSError, UnicodeDecodeError):
+            continue
+        for name in INCLUDE_RE.findall(text):
+            if name.endswith('.hpp') or name.endswith('.h'):
+                name = name.rsplit('.', 1)[0]
+            libs.add(HEADER_LIBS.get(name, name))
+    for flags in package._appended_flags.values():
+        libs.update(LINK_RE.findall(flags))
+    return libs & COMPILED_LIBS
@@ -0,0 +1,52 @@
+from __future__ import print_function
+from package import error_str
+
+# Failures of the packages built in this process, for the keep-going summary
+# Package name -> (reason, [failed files])
+_failed = {}
+# Package name -> names of the failed deps it was skipped for
+_skipped = {}
+
+
+# Records that a package failed to build
+def record(package, reason, files=()):
+    _failed[package.name()] = (reason, sorted(files))
+
+
+# Records that a package wasn't built because deps failed
+def skip(package, failed_deps):
+    _skipped[package.name()] = sorted(dep.name() for dep in failed_deps)
+
+
+# Whether a package failed or was skipped
+def failed(package):
+    return package.name() in _failed or package.name() in _skipped
+
+
+# Returns the deps of a package that failed or were skipped
+def failed_deps(package):
+    return [dep for dep in package.deps() if failed(dep)]
+
+
+def any_failed():
+    return bool(_failed or _skipped)
+
+
+# Prints every failure and skipped package
+def print_summary():
+    if not any_failed():
+        return
+    print ('\n\t' + error_str('BUILD FAILED') + ': ' + str(len(_failed)) + ' package(s) failed, ' +
+           str(len(_skipped)) + ' skipped')
+    for name in sorted(_failed):
+        reason, files = _failed[name]
+        print (('\t%-15s\t' % (name + ':')) + reason)
+        for file_path in files:
+            print ('\t\t\t  ' + file_path)
+    for name in sorted(_skipped):
+        print (('\t%-15s\t' % (name + ':')) + 'Skipped, failed deps: ' + ', '.join(_skipped[name]))
+
+
+def reset():
+    _failed.clear()
+    _skipped.clear()
@@ -0,0 +1,137 @@
+import json
+
+
+# Package dependency DAG annotated with the build times of previous runs
+# Computes the critical path (the longest chain of dependent builds) and the
+# slack of every package, ie. how long it could be delayed without
+# delaying the end of the build
+class BuildGraph(object):
+    def __init__(self, roots, times):
+        self.__names = {}
+        self.__nodes = []
+        self.__deps = {}
+        for root in roots:
+            self.__add(root)
+        self.__times = dict((node, times.get(node.name())) for node in self.__nodes)
+        self.__analyze()
+
+    def __add(self, package):
+        if package in self.__deps:
+            return
+        self.__deps[package] = []
+        for dep in package.deps():
+            self.__add(dep)
+            if dep not in self.__deps[package]:
+                self.__deps[package].append(dep)
+        # Dependencies first
+        self.__nodes.append(package)
+        name = package.name()
+        if name in self.__names.values():
+            index = 2
+            while name + '#' + str(index) in self.__names.values():
+                index += 1
+            name += '#' + str(index)
+        self.__names[package] = name
+
+    def __weight(self, node):
+        return self.__times[node] or 0.0
+
+    # Returns (critical path length, earliest finish per node)
+    def __longest_paths(self, weights):
+        finish = {}
+        for node in self.__nodes:
+            start = max([finish[dep] for dep in self.__deps[node]] or [0.0])
+            finish[node] = start + weights[node]
+        return max(finish.values() or [0.0]), finish
+
+    def __analyze(self):
+        weights = dict((node, self.__weight(node)) for node in self.__nodes)
+        self.critical_length, self.__finish = self.__longest_paths(weights)
+        # Latest finish that doesn't delay the build
+        latest = dict((node, self.critical_length) for node in self.__nodes)
+        for node in reversed(self.__nodes):
+            for dep in self.__deps[node]:
+                latest[dep] = min(latest[dep], latest[node] - weights[node])
+        self.__slack = dict((node, max(0.0, latest[node] - self.__finish[node])) for node in self.__nodes)
+        self.serial_length = sum(weights.values())
+
+        # Critical path: walk back from the last finishing node through the
+        # dependency that finishes last
+        self.critical_path = []
+        if self.__nodes:
+            node = max(self.__nodes, key=lambda x: self.__finish[x])
+            while node is not None:
+                self.critical_path.insert(0, node)
+                deps = self.__deps[node]
+                node = max(deps, key=lambda x: self.__finish[x]) if deps else None
+
+        # Critical path reduction if each node was cached (took no time)
+        self.__cache_saving = {}
+        for node in self.__nodes:
+            cached = dict(weights)
+            cached[node] = 0.0
+            self.__cache_saving[node] = self.critical_length - self.__longest_paths(cached)[0]
+
+    # Per package report entries, in build order
+    def report(self):
+        critical = set(self.critical_path)
+        entries = []
+        for node in self.__nodes:
+            weight = self.__weight(node)
+            entries.append({
+                'name': self.__names[node],
+                'deps': [self.__names[dep] for dep in self.__deps[node]],
+                'seconds': self.__times[node],
+                'start': self.__finish[node] - weight,
+                'finish': self.__finish[node],
+                'slack': self.__slack[node],
+                'critical': node in critical,
+                # Off the critical path the package could build alongside others
+                'parallel_saving': 0.0 if node in critical else weight,
+                'cache_saving': self.__cache_saving[node],
+            })
+        return entries
+
+    def to_json(self):
+        return json.dumps({
+            'critical_path': [self.__names[node] for node in self.critical_path],
+            'critical_length': self.critical_length,
+            'serial_length': self.serial_length,
+            'packages': self.report(),
+        }, indent=2)
+
+    def to_dot(self):
+        critical = set(self.critical_path)
+        lines = ['digraph amigomake {', '  rankdir=LR;', '  node [shape=box];']
+        for node in self.__nodes:
+            label = self.__names[node]
+            if self.__times[node] is not None:
+                label += '\\n%.1fs (slack %.1fs)' % (self.__times[node], self.__slack[node])
+            else:
+                label += '\\nno timing'
+            attrs = 'label="%s"' % label
+            if node in critical:
+                attrs += ', color=red, penwidth=2'
+            lines.append('  "%s" [%s];' % (self.__names[node], attrs))
+        for node in self.__nodes:
+            for dep in self.__deps[node]:
+                attrs = ''
+                if node in critical and dep in critical:
+                    attrs = ' [color=red, penwidth=2]'
+                lines.append('  "%s" -> "%s"%s;' % (self.__names[node], self.__names[dep], attrs))
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    # Prints a summary table
+    def print_report(self):
+        print ('\t%-20s %10s %10s %10s %12s %12s' %
+               ('Package', 'Time', 'Finish', 'Slack', 'Parallel', 'Cached'))
+        for entry in sorted(self.report(), key=lambda x: (-x['cache_saving'], -x['finish'])):
+            seconds = '-' if entry['seconds'] is None else '%.1fs' % entry['seconds']
+            name = entry['name'] + (' *' if entry['critical'] else '')
+            print ('\t%-20s %10s %9.1fs %9.1fs %11.1fs %11.1fs' %
+                   (name, seconds, entry['finish'], entry['slack'],
+                    entry['parallel_saving'], entry['cache_saving']))
+        print ('\n\tCritical path (*): ' + ' -> '.join(self.__names[node] for node in self.critical_path))
+        print ('\tCritical path: %.1fs, sequential build: %.1fs, saved by building in parallel: %.1fs' %
+               (self.critical_length, self.serial_length, self.serial_length - self.critical_length))
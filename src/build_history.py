@@ -0,0 +1,259 @@
+from contextlib import contextmanager
+import amigo_config
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    platform TEXT,
+    command TEXT
+);
+CREATE TABLE IF NOT EXISTS builds (
+    run_id INTEGER,
+    package TEXT,
+    seconds REAL,
+    noop INTEGER,
+    sources INTEGER,
+    recompiled INTEGER
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER,
+    package TEXT,
+    phase TEXT,
+    seconds REAL
+);
+CREATE TABLE IF NOT EXISTS reasons (
+    run_id INTEGER,
+    package TEXT,
+    reason TEXT,
+    trigger TEXT,
+    count INTEGER
+);
+CREATE TABLE IF NOT EXISTS compiles (
+    run_id INTEGER,
+    package TEXT,
+    file TEXT,
+    seconds REAL
+);
+CREATE INDEX IF NOT EXISTS builds_package ON builds (package, run_id);
+CREATE INDEX IF NOT EXISTS reasons_trigger ON reasons (package, trigger, run_id);
+"""
+
+# Packages being built, innermost last
+_stack = []
+# (package name, platform unique name) -> Build of this run
+_recorded = {}
+# Platform unique name -> run id in the history database
+_run_ids = {}
+_started = time.time()
+
+
+# Measurements of a single package build
+class Build(object):
+    def __init__(self, package, platform):
+        self.package = package
+        self.platform = platform
+        self.start = time.time()
+        # Time spent building nested dependencies
+        self.nested = 0.0
+        self.seconds = None
+        self.phases = {}
+        self.noop = None
+        self.sources = None
+        # (reason, trigger) -> number of files recompiled for it
+        self.reasons = {}
+        # File path -> compile seconds
+        self.compiles = {}
+
+
+def _history_path():
+    if not amigo_config.STATE_DIR:
+        return None
+    return os.path.join(amigo_config.STATE_DIR, 'history.sqlite')
+
+
+# Returns a connection to the history database or None if there's no state dir
+def connect():
+    path = _history_path()
+    if not path:
+        return None
+    if not os.path.exists(amigo_config.STATE_DIR):
+        os.makedirs(amigo_config.STATE_DIR)
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _current(package):
+    for build in reversed(_stack):
+        if build.package is package:
+            return build
+    return None
+
+
+# Times a package build, excluding the time spent building its dependencies
+# The first completed build of each package and platform in a run is recorded
+@contextmanager
+def timed(package, platform):
+    build = Build(package, platform)
+    _stack.append(build)
+    try:
+        yield build
+    except BaseException:
+        _stack.remove(build)
+        raise
+    _stack.remove(build)
+    elapsed = time.time() - build.start
+    if _stack:
+        _stack[-1].nested += elapsed
+    build.seconds = elapsed - build.nested
+    key = (package.name(), platform.build_name())
+    if key not in _recorded:
+        _recorded[key] = build
+    if not _stack:
+        save()
+
+
+# Times a phase of the package build currently running
+@contextmanager
+def phase(package, name):
+    start = time.time()
+    build = _current(package)
+    nested = build.nested if build else 0.0
+    yield
+    if build:
+        # Dependencies built during the phase don't count
+        elapsed = time.time() - start - (build.nested - nested)
+        build.phases[name] = build.phases.get(name, 0.0) + elapsed
+
+
+# Records why files of the package currently building are recompiled
+# reasons: {file path: (reason, trigger)}, the trigger is the changed file
+def record_files(package, sources, reasons):
+    build = _current(package)
+    if not build:
+        return
+    build.sources = sources
+    build.noop = not reasons
+    build.reasons = {}
+    for reason in reasons.values():
+        build.reasons[reason] = build.reasons.get(reason, 0) + 1
+
+
+# Records the compile time of a file of the package currently building
+def record_compile(package, file_path, seconds):
+    build = _current(package)
+    if build:
+        build.compiles[file_path] = seconds
+
+
+# Records whether the package currently building had anything to do
+def record_noop(package, noop):
+    build = _current(package)
+    if build:
+        build.noop = noop
+
+
+# Appends the builds recorded in this run to the history database
+def save():
+    pending = [(key, build) for key, build in _recorded.items() if build is not None]
+    if not pending:
+        return
+    connection = connect()
+    if not connection:
+        return
+    with connection:
+        for key, build in pending:
+            unique_name = key[1]
+            if unique_name not in _run_ids:
+                cursor = connection.execute('INSERT INTO runs (started, platform, command) VALUES (?, ?, ?)',
+                                            (_started, unique_name, amigo_config.COMMAND))
+                _run_ids[unique_name] = cursor.lastrowid
+            run_id = _run_ids[unique_name]
+            recompiled = None if build.sources is None else sum(build.reasons.values())
+            noop = None if build.noop is None else int(build.noop)
+            connection.execute('INSERT INTO builds VALUES (?, ?, ?, ?, ?, ?)',
+                               (run_id, key[0], build.seconds, noop, build.sources, recompiled))
+            for name, seconds in build.phases.items():
+                connection.execute('INSERT INTO phases VALUES (?, ?, ?, ?)', (run_id, key[0], name, seconds))
+            for (reason, trigger), count in build.reasons.items():
+                connection.execute('INSERT INTO reasons VALUES (?, ?, ?, ?, ?)',
+                                   (run_id, key[0], reason, trigger, count))
+            connection.executemany('INSERT INTO compiles VALUES (?, ?, ?, ?)',
+                                   [(run_id, key[0], file_path, seconds)
+                                    for file_path, seconds in build.compiles.items()])
+            # Keep the key so later builds of the package in this run are ignored
+            _recorded[key] = None
+    connection.close()
+
+
+# Returns the builds of a platform, oldest first, as a list of dicts
+# with run_id, started, package, seconds, noop, sources, recompiled and phases
+def builds(platform):
+    connection = connect()
+    if not connection:
+        return []
+    rows = connection.execute(
+        'SELECT runs.id, runs.started, package, seconds, noop, sources, recompiled '
+        'FROM builds JOIN runs ON builds.run_id = runs.id '
+        'WHERE runs.platform = ? ORDER BY runs.id', (platform.build_name(),)).fetchall()
+    phases = {}
+    for run_id, package, name, seconds in connection.execute(
+            'SELECT run_id, package, phase, seconds FROM phases'):
+        phases.setdefault((run_id, package), {})[name] = seconds
+    connection.close()
+    result = []
+    for run_id, started, package, seconds, noop, sources, recompiled in rows:
+        result.append({'run_id': run_id, 'started': started, 'package': package,
+                       'seconds': seconds, 'noop': noop, 'sources': sources,
+                       'recompiled': recompiled, 'phases': phases.get((run_id, package), {})})
+    return result
+
+
+# Returns [(run_id, package, trigger, count)] of the header triggered
+# recompiles of a platform, oldest first
+def header_triggers(platform):
+    connection = connect()
+    if not connection:
+        return []
+    rows = connection.execute(
+        'SELECT run_id, package, trigger, count FROM reasons JOIN runs ON reasons.run_id = runs.id '
+        'WHERE runs.platform = ? AND reason = ? ORDER BY run_id', (platform.build_name(), 'header')).fetchall()
+    connection.close()
+    return rows
+
+
+# Returns {header path: number of builds that recompiled files because it changed}
+def header_changes(platform):
+    runs = {}
+    for run_id, package, trigger, count in header_triggers(platform):
+        runs.setdefault(trigger, set()).add(run_id)
+    return dict((header, len(run_ids)) for header, run_ids in runs.items())
+
+
+# Returns {file path: seconds} of the last recorded compile of each file
+def compile_times(platform):
+    connection = connect()
+    if not connection:
+        return {}
+    rows = connection.execute(
+        'SELECT file, seconds FROM compiles JOIN runs ON compiles.run_id = runs.id '
+        'WHERE runs.platform = ? ORDER BY run_id', (platform.build_name(),)).fetchall()
+    connection.close()
+    return dict(rows)
+
+
+# Returns {package name: seconds} of the last recorded builds for a platform
+# Builds that had work to do are preferred over no-op builds
+def package_times(platform):
+    times = {}
+    work_times = {}
+    for build in builds(platform):
+        times[build['package']] = build['seconds']
+        if not build['noop']:
+            work_times[build['package']] = build['seconds']
+    times.update(work_times)
+    return times
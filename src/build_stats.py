@@ -0,0 +1,116 @@
+from package import warn_str
+import time
+
+# Number of previous builds a build is compared to
+BASELINE_RUNS = 5
+# A value regressed when it is at least this many times its baseline
+REGRESSION_FACTOR = 2.0
+# Durations under this many seconds are too noisy to be flagged
+MIN_SECONDS = 0.05
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if not values:
+        return None
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _regressed(value, baseline, minimum=MIN_SECONDS):
+    return (value is not None and baseline is not None and value >= minimum and
+            value >= REGRESSION_FACTOR * max(baseline, minimum / REGRESSION_FACTOR))
+
+
+# Build history trends of a platform, from build_history.builds() and
+# build_history.header_triggers()
+class BuildStats(object):
+    def __init__(self, builds, header_triggers):
+        self.__builds = {}
+        for build in builds:
+            self.__builds.setdefault(build['package'], []).append(build)
+        self.__header_triggers = header_triggers
+
+    def packages(self):
+        return sorted(self.__builds)
+
+    # Returns the last build of the package and the previous builds
+    # of the same kind (no-op or not)
+    def __last_and_baseline(self, package, noop):
+        builds = [build for build in self.__builds[package] if bool(build['noop']) == noop]
+        if not builds:
+            return None, []
+        return builds[-1], builds[-BASELINE_RUNS - 1:-1]
+
+    # Returns a list of regression descriptions
+    def regressions(self):
+        found = []
+        for package in self.packages():
+            # No-op builds: total time and each phase
+            last, baseline = self.__last_and_baseline(package, True)
+            if last and baseline:
+                base = median([build['seconds'] for build in baseline])
+                if _regressed(last['seconds'], base):
+                    found.append('%s: no-op build took %.2fs, %.1fx the usual %.2fs' %
+                                 (package, last['seconds'], last['seconds'] / max(base, 1e-6), base))
+                for name, seconds in sorted(last['phases'].items()):
+                    phase_base = median([build['phases'][name] for build in baseline if name in build['phases']])
+                    if _regressed(seconds, phase_base):
+                        found.append('%s: no-op %s phase took %.2fs, usually %.2fs' %
+                                     (package, name, seconds, phase_base))
+            # Builds with work: time per recompiled file
+            last, baseline = self.__last_and_baseline(package, False)
+            if last and baseline and last['recompiled']:
+                per_file = [build['seconds'] / build['recompiled'] for build in baseline if build['recompiled']]
+                base = median(per_file)
+                value = last['seconds'] / last['recompiled']
+                if _regressed(value, base, MIN_SECONDS / 10):
+                    found.append('%s: %.3fs per recompiled file, usually %.3fs' % (package, value, base))
+        found += self.__header_regressions()
+        return found
+
+    # Headers whose last change rebuilt at least twice as many files as before
+    def __header_regressions(self):
+        history = {}
+        for run_id, package, trigger, count in self.__header_triggers:
+            history.setdefault((package, trigger), []).append(count)
+        found = []
+        for (package, trigger), counts in sorted(history.items()):
+            if len(counts) < 2:
+                continue
+            base = median(counts[-BASELINE_RUNS - 1:-1])
+            if counts[-1] >= REGRESSION_FACTOR * base:
+                found.append('%s: changing %s now rebuilds %d files, previously %g' %
+                             (package, trigger, counts[-1], base))
+        return found
+
+    def print_report(self):
+        print ('\t%-20s %6s %10s %10s %10s %10s %10s' %
+               ('Package', 'Runs', 'Last', 'Build', 'No-op', 'Hit rate', 'Recompiled'))
+        for package in self.packages():
+            builds = self.__builds[package]
+            work = [build['seconds'] for build in builds if not build['noop']][-BASELINE_RUNS:]
+            noop = [build['seconds'] for build in builds if build['noop']][-BASELINE_RUNS:]
+            counted = [build for build in builds if build['sources']][-BASELINE_RUNS:]
+            hit_rate = '-'
+            recompiled = '-'
+            if counted:
+                hits = sum(build['sources'] - build['recompiled'] for build in counted)
+                hit_rate = '%.0f%%' % (100.0 * hits / sum(build['sources'] for build in counted))
+                recompiled = str(counted[-1]['recompiled'])
+            print ('\t%-20s %6d %9.2fs %10s %10s %10s %10s' %
+                   (package, len(builds), builds[-1]['seconds'],
+                    '-' if not work else '%.2fs' % median(work),
+                    '-' if not noop else '%.2fs' % median(noop),
+                    hit_rate, recompiled))
+        last = max(build['started'] for builds in self.__builds.values() for build in builds)
+        print ('\n\tBuild and no-op are medians of the last %d runs, hit rate is the share of '
+               'up to date objects' % BASELINE_RUNS)
+        print ('\tLast run: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last)))
+        regressions = self.regressions()
+        if regressions:
+            print ('')
+            for regression in regressions:
+                print ('\t' + warn_str('REGRESSION') + ': ' + regression)
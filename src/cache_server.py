@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# Reference server for the remote build cache (see remote_cache.py)
+#
+# Stores entries as files under a directory:
+#   GET /<kind>/<key>  -> 200 with the entry, 404 if missing
+#   PUT /<kind>/<key>  <- the entry, written to a temp file and renamed
+# Kinds are lowercase words and keys hex digests, anything else is rejected.
+#
+# Anyone who can reach the server can store entries that builds will use,
+# so it should only listen on interfaces reachable by trusted build machines
+# (loopback by default).
+#
+# Start a server with:
+#   python cache_server.py [--host 127.0.0.1] [--port 8766] [--dir ~/.amigomake-cache]
+from __future__ import print_function
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+DEFAULT_PORT = 8766
+# Largest entry accepted
+MAX_ENTRY_SIZE = 1024 * 1024 * 1024
+ENTRY_RE = re.compile(r'^/([a-z]+)/([0-9a-f]{16,128})$')
+
+
+class CacheHandler(BaseHTTPRequestHandler):
+    # Returns the file of the requested entry, None if the path isn't valid
+    def __entry_path(self):
+        match = ENTRY_RE.match(self.path)
+        if not match:
+            self.send_error(400, 'Invalid entry path')
+            return None
+        return os.path.join(self.server.directory, match.group(1), match.group(2)[:2], match.group(2))
+
+    def do_GET(self):
+        path = self.__entry_path()
+        if path is None:
+            return
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            self.send_error(404, 'Not found')
+            return
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_PUT(self):
+        path = self.__entry_path()
+        if path is None:
+            return
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            self.send_error(411, 'Content-Length required')
+            return
+        if length < 0 or length > MAX_ENTRY_SIZE:
+            self.send_error(413, 'Entry too large')
+            return
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by a concurrent request
+                pass
+        fd, tmp_path = tempfile.mkstemp(prefix='.put-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                remaining = length
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        raise IOError('Connection closed')
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            os.remove(tmp_path)
+            self.send_error(500, 'Could not store entry')
+            return
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class CacheServer(ThreadingMixIn, HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, directory, verbose=False):
+        HTTPServer.__init__(self, address, CacheHandler)
+        self.directory = os.path.abspath(directory)
+        self.verbose = verbose
+
+
+def main():
+    parser = argparse.ArgumentParser(description='amigomake remote cache server')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (127.0.0.1 by default)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    parser.add_argument('--dir', dest='directory', default=os.path.expanduser('~/.amigomake-cache'),
+                        help='Directory storing the entries (~/.amigomake-cache by default)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log requests')
+    params = parser.parse_args()
+    server = CacheServer((params.host, params.port), params.directory, params.verbose)
+    print('amigomake cache listening on http://%s:%d' % server.server_address[:2])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
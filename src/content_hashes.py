@@ -0,0 +1,94 @@
+from file_lock import write_json
+import hashlib
+import json
+import os
+
+# Bytes read at a time when hashing a file
+CHUNK_SIZE = 1024 * 1024
+
+
+# Content hashes of build inputs and outputs, and signatures of the inputs
+# each step last ran with, so a step whose inputs only changed in mtime (eg.
+# objects recompiled to the same bytes) can be skipped: early cutoff
+# File hashes are cached by mtime and size, so unchanged files aren't reread
+class ContentHashes(object):
+    def __init__(self, path):
+        self.__path = path
+        self.__files = {}
+        self.__signatures = {}
+        self.__changed = False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self.__files = data['files']
+            self.__signatures = data['signatures']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    # Returns the md5 of a file's content, None if it doesn't exist
+    def file_hash(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        entry = self.__files.get(path)
+        if entry and entry[0] == st.st_mtime and entry[1] == st.st_size:
+            return entry[2]
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                md5.update(chunk)
+        self.__files[path] = [st.st_mtime, st.st_size, md5.hexdigest()]
+        self.__changed = True
+        return md5.hexdigest()
+
+    # Returns a signature of the content of files and extra strings (eg. the
+    # command run on them)
+    def signature(self, paths, extra=()):
+        md5 = hashlib.md5()
+        for value in extra:
+            md5.update(('\0' + value).encode('utf-8'))
+        for path in paths:
+            md5.update(('\0' + path + '\0' + str(self.file_hash(path))).encode('utf-8'))
+        return md5.hexdigest()
+
+    # Whether the step named key last ran with this signature
+    def matches(self, key, signature):
+        return self.__signatures.get(key) == signature
+
+    def set(self, key, signature):
+        if self.__signatures.get(key) != signature:
+            self.__signatures[key] = signature
+            self.__changed = True
+
+    # Returns the (mtime, md5) of a file as last hashed, before a step
+    # rewrites it
+    def previous(self, path):
+        if self.file_hash(path) is None:
+            return None
+        entry = self.__files[path]
+        return entry[0], entry[2]
+
+    # Gives a rewritten file its previous mtime back if its content didn't
+    # change, so mtime based checks downstream see no change
+    # Returns whether the content is unchanged
+    def keep_mtime(self, path, previous):
+        if previous is None:
+            return False
+        mtime, md5 = previous
+        if self.file_hash(path) != md5:
+            return False
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, mtime))
+        self.__files[path] = [mtime, st.st_size, md5]
+        self.__changed = True
+        return True
+
+    def save(self):
+        if not self.__changed:
+            return
+        write_json(self.__path, {'files': self.__files, 'signatures': self.__signatures})
+        self.__changed = False
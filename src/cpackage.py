@@ -1,19 +1,27 @@
 from __future__ import print_function
-from platform import crush_deps
-from package import Package, older, check_extensions, error_str
-from subprocess import call
+from platform import crush_deps, crushed_libs
+from package import Package, older, check_extensions, error_str, warn_str
+from ninja_writer import escape, generate as generate_ninja
+from include_scanner import IncludeScanner, Conditions, conditions_from_flags
+from path_graph import PathGraph
+from content_hashes import ContentHashes
+from file_lock import FileLock, FileLocks, dir_lock_path
+from job_scheduler import RssHistory, default_jobs, run_admitted, worker_pool
 import amigo_config
-import multiprocessing
+import build_failures
+import build_history
+import file_collector
+import launcher
+import pgo
+import remote_cache
+import remote_compile
+import stat_cache
 import os
 import shutil
 import re
 import time
 import sys
 
-# Global vars needed to stop multi-threaded compilation on error
-manager = multiprocessing.Manager()
-failed_files = manager.list([])
-
 
 class CPackage(Package):
     # Package output type
@@ -33,6 +41,10 @@ class CPackage(Package):
         self._appended_flags = {}
         self.__crush_ldflags = ''
         self.__outdated_sources = None
+        # Profiles used by PGO optimized builds
+        self.__profiles = None
+        # Content hashes of the outputs and link inputs
+        self.__hashes = None
         self.__package_type = package_type
         self.__included_sources = []
         self.__excluded_sources = []
@@ -41,14 +53,20 @@ class CPackage(Package):
         self.__lib_prefix = 'lib'
         self.__deps_prefix = 'libdeps_' + self.name()
         self.__build_failed = False
+        # Sources that failed to compile in the last build
+        self.__failed_sources = []
         self.__is_clean = False
         self.__lib_path = None
         self.__obj_path = None
         self.__bin_path = None
         self.__inc_path = None
-        self.__header_to_src_map = {}
-        self.__src_to_header_map = {}
-        self.__src_to_rel_header_map = {}
+        # Sources and headers -> headers they #include (edges labeled
+        # with the relative header path in the #include statement)
+        self.__include_graph = PathGraph()
+        # #include name -> header it resolves to, and set of #include names
+        # reachable from a source -> its include dirs (reset with the include graph)
+        self.__resolved_headers = {}
+        self.__include_dirs_cache = {}
         self.__dep_libs = []
         self.__dep_lib_to_path_map = {}
 
@@ -88,12 +106,45 @@ class CPackage(Package):
     def headers(self):
         return self._headers
 
+    # Sources in the package
+    # Available at beginning of the _build step
+    def sources(self):
+        return self._sources
+
     def set_header_exts(self, extensions):
         self.__header_exts = extensions
         
     def set_src_exts(self, extensions):
         self.__src_exts = extensions
 
+    # Whether the package is compiled and linked with link-time optimization
+    def _lto(self):
+        return amigo_config.LTO
+
+    # Profile-guided optimization mode of the package (pgo.INSTRUMENT,
+    # pgo.OPTIMIZE or None)
+    def _pgo(self):
+        return amigo_config.PGO
+
+    # LTO and PGO objects and libs get their own install dir
+    def _build_dir_name(self, platform):
+        name = super(CPackage, self)._build_dir_name(platform)
+        if self._lto():
+            name += '-lto'
+        if self._pgo():
+            name += '-pgo-' + self._pgo()
+        return name
+
+    # Directory keeping ThinLTO results between links, shared per platform
+    def __lto_cache_dir(self, platform):
+        if amigo_config.STATE_DIR:
+            path = os.path.join(amigo_config.STATE_DIR, 'lto-cache', platform.unique_name())
+        else:
+            path = os.path.join(self.install_dir(platform), '.amigo', 'lto-cache')
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
     # Cleans the install directories
     def clean(self, platform, clean_deps=False):
         if self.__is_clean:
@@ -117,6 +168,17 @@ class CPackage(Package):
     def exclude_sources(self, excluded_sources):
         self.__excluded_sources = excluded_sources
 
+    # Returns the lib or executable the package links, None if it doesn't link
+    def output_path(self, platform):
+        install_dir = self.install_dir(platform)
+        if self.__package_type == CPackage.STATIC_LIB:
+            return os.path.join(install_dir, 'lib', self.__lib_prefix + self.name() + '.a')
+        elif self.__package_type == CPackage.SHARED_LIB:
+            return os.path.join(install_dir, 'lib', self.__lib_prefix + self.name() + '.so')
+        elif self.__package_type == CPackage.EXECUTABLE:
+            return os.path.join(install_dir, 'bin', self.name())
+        return None
+
     # Sets flag for whether dependencies should be built
     def should_build_deps(self, should_build):
         self.__should_build_deps = should_build
@@ -143,15 +205,81 @@ class CPackage(Package):
             return False
 
     # Builds the CPackage
+    # Concurrent amigomake runs take turns building it (exclusive lock on
+    # the install dir) and can read its deps at the same time (shared locks)
     def _build(self, platform, env_vars=None):
         if not env_vars:
             env_vars = self._env_vars
         self.__is_clean = False
         if self._build_finished:
             return
-        del failed_files[:]
+        with FileLock(dir_lock_path(self.install_dir(platform))):
+            self.__build(platform, env_vars)
+
+    def __build(self, platform, env_vars):
         self.__build_failed = False
-        # Create output directories
+        self.__init_output_dirs(platform)
+
+        self.__outdated_sources = None
+
+        # Collect all source files and headers to be compiled
+        print (('\t%-15s\t' % (self.name() + ':')) + 'Checking Files')
+        src_filenames = set()
+        self.__collect_files_by_extension(src_filenames)
+        print (('\t%-15s\t' % (self.name() + ':')) + 'Building Dependencies')
+        dep_install_dirs = self.__process_deps(platform, lambda dep: dep.build(platform))
+        failed_deps = build_failures.failed_deps(self)
+        if failed_deps:
+            print (('\t%-15s\t' % (self.name() + ':')) + warn_str('SKIPPED') + ': Dependencies Failed!')
+            build_failures.skip(self, failed_deps)
+            return
+        dep_locks = [dir_lock_path(dep.install_dir(platform)) for dep in self.__all_deps()]
+        with FileLocks(dep_locks, shared=True):
+            self.__build_with_deps(platform, env_vars, dep_install_dirs)
+
+    # Builds the package once its deps are built
+    def __build_with_deps(self, platform, env_vars, dep_install_dirs):
+        with build_history.phase(self, 'crush'):
+            self.__crush_deps(platform, dep_install_dirs)
+        print (('\t%-15s\t' % (self.name() + ':')) + 'Initializing Source Maps')
+        # Popuplate Source->Headers maps and Header->Sources maps
+        with build_history.phase(self, 'scan'):
+            self.__populate_src_maps(platform, env_vars)
+        # Find Sources that require re-compilation
+        self.__profiles = None
+        if self._pgo() == pgo.OPTIMIZE:
+            self.__profiles = pgo.profiles(platform)
+        with build_history.phase(self, 'check'):
+            self.__outdated_sources = self.__needs_recompile()
+            relink = self.__needs_relink(platform)
+        if not self.__outdated_sources and not relink:
+            print (('\t%-15s\t' % (self.name() + ':')) + 'No Changes Detected')
+            self.__hashes.save()
+            return
+        self.__configure_flags(platform, env_vars, dep_install_dirs)
+
+        with build_history.phase(self, 'compile'):
+            self._compile(platform)
+        if self.__build_failed:
+            print (('\t%-15s\t' % (self.name() + ':')) + error_str('ERROR') + ': Compilation Failed!')
+            self.__fail('Compilation Failed', self.__failed_sources)
+        else:
+            with build_history.phase(self, 'link'):
+                linked = self._link(platform)
+            if not linked:
+                self.__fail('Linking Failed')
+            elif self.__should_install_headers:
+                for header in self.headers():
+                    shutil.copy(header, self.__include_path(platform))
+
+    # Records a build failure, exits unless building with --keep-going
+    def __fail(self, reason, files=()):
+        build_failures.record(self, reason, files)
+        if not amigo_config.KEEP_GOING:
+            sys.exit(1)
+
+    # Creates the lib, obj and bin output directories
+    def __init_output_dirs(self, platform):
         self.__lib_path = os.path.join(self.install_dir(platform), 'lib')
         self.__obj_path = os.path.join(self.install_dir(platform), 'obj')
         self.__bin_path = os.path.join(self.install_dir(platform), 'bin')
@@ -161,19 +289,25 @@ class CPackage(Package):
             os.makedirs(self.__obj_path)
         if not os.path.exists(self.__bin_path):
             os.makedirs(self.__bin_path)
-
-        self.__outdated_sources = None
-
-        # Collect all source files and headers to be compiled
-        print (('\t%-15s\t' % (self.name() + ':')) + 'Checking Files')
-        src_filenames = set()
-        self.__collect_files_by_extension(src_filenames)
-        print (('\t%-15s\t' % (self.name() + ':')) + 'Building Dependencies')
+        file_collector.mark_build_dir(self.install_dir(platform))
+        self.__hashes = ContentHashes(os.path.join(self.install_dir(platform), '.amigo', 'hashes.json'))
+
+    # Returns the header install dir, creating it if needed
+    def __include_path(self, platform):
+        self.__inc_path = os.path.join(self.install_dir(platform), 'include')
+        if not os.path.exists(self.__inc_path):
+            os.makedirs(self.__inc_path)
+        return self.__inc_path
+
+    # Calls visit_dep on every dependency (if deps should be built)
+    # and collects their headers and libs
+    # Returns the dependency install dirs whose libs need crushing
+    def __process_deps(self, platform, visit_dep):
         dep_install_dirs = []
         for dep in self.deps():
             install_dir = dep.install_dir(platform)
             if self.__should_build_deps:
-                dep.build(platform)
+                visit_dep(dep)
             for dep_header in dep.headers():
                 self._headers.add(dep_header)
             if dep.__dep_libs:
@@ -181,28 +315,43 @@ class CPackage(Package):
                 self.__dep_lib_to_path_map.update(dep.__dep_lib_to_path_map)
             elif not install_dir in dep_install_dirs:
                 dep_install_dirs.insert(0, install_dir)
-        dep_install_dirs = [x for x in dep_install_dirs
-                            if os.path.join(x, 'lib') not in self.__dep_lib_to_path_map.values()]
-
-        # Crush dependency libs into one static lib for IOS
-        if self.__should_build_deps:
-            print (('\t%-15s\t' % (self.name() + ':')) + 'Crushing Deps')
-            index = 1
-            for install_dir in dep_install_dirs:
-                for (dirpath, dirnames, filenames) in os.walk(install_dir):
-                    for filename in filenames:
-                        if filename.startswith(self.__deps_prefix):
-                            os.remove(os.path.join(dirpath, filename))
-                if crush_deps(platform, install_dir, self.__deps_prefix + '_' + str(index), self.__crush_ldflags):
-                    index += 1
-        print (('\t%-15s\t' % (self.name() + ':')) + 'Initializing Source Maps')
-        # Popuplate Source->Headers maps and Header->Sources maps
-        self.__populate_src_maps()
-        # Find Sources that require re-compilation
-        self.__outdated_sources = self.__needs_recompile()
-        if not self.__outdated_sources:
-            print (('\t%-15s\t' % (self.name() + ':')) + 'No Changes Detected')
+        return [x for x in dep_install_dirs
+                if os.path.join(x, 'lib') not in self.__dep_lib_to_path_map.values()]
+
+    # Crush dependency libs into one static lib for IOS
+    # Install dirs whose libs and flags didn't change since they were
+    # crushed are skipped
+    def __crush_deps(self, platform, dep_install_dirs):
+        if not self.__should_build_deps:
             return
+        print (('\t%-15s\t' % (self.name() + ':')) + 'Crushing Deps')
+        index = 1
+        for install_dir in dep_install_dirs:
+            output_name = self.__deps_prefix + '_' + str(index)
+            lto_cache_dir = self.__lto_cache_dir(platform) if self._lto() else None
+            ldflags = ' '.join([self.__crush_ldflags] + pgo.link_flags(self._pgo()))
+            key = 'crush:' + install_dir
+            signature = self.__hashes.signature(crushed_libs(install_dir),
+                                                [output_name, ldflags, str(lto_cache_dir)])
+            output = os.path.join(install_dir, 'lib', output_name + '.a')
+            if self.__hashes.matches(key, [signature, False]):
+                continue
+            if self.__hashes.matches(key, [signature, True]) and stat_cache.isfile(output):
+                index += 1
+                continue
+            for (dirpath, dirnames, filenames) in os.walk(install_dir):
+                for filename in filenames:
+                    if filename.startswith(self.__deps_prefix):
+                        os.remove(os.path.join(dirpath, filename))
+            crushed = crush_deps(platform, install_dir, output_name, ldflags, lto_cache_dir)
+            stat_cache.invalidate(output)
+            self.__hashes.set(key, [signature, crushed])
+            if crushed:
+                index += 1
+        self.__hashes.save()
+
+    # Configures the platform and sets up the flags used for compiling and linking
+    def __configure_flags(self, platform, env_vars, dep_install_dirs):
         print (('\t%-15s\t' % (self.name() + ':')) + 'Configuring Platform')
         platform.configure(self.install_dir(platform), env_vars, None, self.deps())
 
@@ -241,120 +390,257 @@ class CPackage(Package):
         for key, flags in app_flags:
             platform.append_flags(key, ' '+flags)
 
-        self._compile(platform)
-        if self.__build_failed:
-            print (('\t%-15s\t' % (self.name() + ':')) + error_str('ERROR') + ': Compilation Failed!')
-            sys.exit(1)
-        else:
-            self._link(platform)
-            if self.__should_install_headers:
-                self.__inc_path = os.path.join(self.install_dir(platform), 'include')
-                if not os.path.exists(self.__inc_path):
-                    os.makedirs(self.__inc_path)
-                for header in self.headers():
-                    shutil.copy(header, self.__inc_path)
-
     # Compilation step
     def _compile(self, platform):
         print (('\t%-15s\t' % (self.name() + ':')) + 'Compiling')
         start_time = time.time()
-        compiler_pool = multiprocessing.Pool(self._num_threads)
-        compiler_pool.map_async(CompilerFunc(self, platform), self._sources).get(9999999)
+        max_jobs = default_jobs(self._num_threads)
+        sources = [file_path for file_path in self._sources
+                   if file_path in self.__outdated_sources or older(self.__object_path(file_path), [file_path])]
+        rss_history = RssHistory(os.path.join(self.install_dir(platform), '.amigo', 'rss.json'))
+        compiled_sources = []
+        failed_sources = []
+        launches = [0]
+
+        def compiled(file_path, result):
+            if result:
+                peak_rss, seconds, launched, status = result
+                rss_history.record(file_path, peak_rss)
+                if launched:
+                    launches[0] += 1
+                if status != 0:
+                    failed_sources.append(file_path)
+                    return
+                build_history.record_compile(self, file_path, seconds)
+                compiled_sources.append(file_path)
+
+        # Without --keep-going the first failure cancels the running compiles
+        should_stop = None
+        if not amigo_config.KEEP_GOING:
+            should_stop = lambda: len(failed_sources) > 0
+        compiler_pool = worker_pool(min(max_jobs, max(1, len(sources))), CompilerFunc(self, platform))
+        cancelled = run_admitted(compiler_pool, max_jobs, sources,
+                                 rss_history.estimate, compiled, should_stop)
+        for file_path in cancelled:
+            obj_path = self.__object_path(file_path)
+            if os.path.exists(obj_path):
+                os.remove(obj_path)
         print (('\t%-15s\t' % (self.name() + ':')) + 'Compiling took:\t' + str(time.time() - start_time) + 's')
+        if launches[0]:
+            launcher.add_launches(launches[0])
+            print (('\t%-15s\t' % (self.name() + ':')) + launcher.report(launches[0]))
         compiler_pool.close()
         compiler_pool.join()
-        self.__build_failed = self.__build_failed or len(failed_files) > 0
+        rss_history.save()
+        for file_path in sources:
+            stat_cache.invalidate(self.__object_path(file_path))
+        if self.__profiles:
+            for file_path in compiled_sources:
+                self.__profiles.record(self.__object_path(file_path), self.install_dir(platform))
+            self.__profiles.save()
+        self.__failed_sources = sorted(failed_sources)
+        self.__build_failed = self.__build_failed or len(failed_sources) > 0
 
     # Compiles a file for the specified platform with provided compiler and flags
+    # The compiler's output is printed in one piece with the file name
+    # Returns (peak RSS or None if it wasn't measured, compile seconds,
+    # whether the compiler ran locally, exit status)
     def compile_file(self, file_path, platform, cc, cflags):
-        output_name = self.__output_name(file_path) 
-        output = os.path.join(self.__obj_path, output_name)
+        output = self.__object_path(file_path)
         if (file_path not in self.__outdated_sources and
                 not older(output, [file_path])):
             return
-        if file_path in self.__src_to_header_map:
-            self.__add_include_flags(file_path, cflags)
-        call_str = cc + " -c " + file_path + " " + " -o " + output + " " + (' '.join(cflags))
-        status = call([call_str], env=platform.var_env(), shell=True)
+        argv = self.__compile_argv(platform, file_path, cc, cflags, output)
+        env = platform.var_env()
+        result = None
+        start_time = time.time()
+        # Objects are cached by their preprocessed source and command, PGO
+        # objects also depend on the profiles so they aren't
+        cache_key = None
+        cached = False
+        source = None
+        if remote_cache.enabled() and not self._pgo():
+            source = remote_compile.preprocess(cc, cflags, file_path, env)
+            if source is not None:
+                key_argv = launcher.split(cc) + cflags + ['-c', remote_compile.INPUT, '-o', remote_compile.OUTPUT]
+                cache_key = remote_cache.object_key(cc, key_argv, source, env)
+                cached = remote_cache.fetch_object(cache_key, output)
+        # PGO profiles are only readable on this machine
+        if not cached and (self._pgo() or
+                           not remote_compile.compile_file(cc, cflags, file_path, output, env, source)):
+            result = launcher.run(argv, env)
+        if cache_key and not cached and (result is None or result.status == 0):
+            remote_cache.store_object(cache_key, output)
+        seconds = time.time() - start_time
         if check_extensions(file_path, ['.cpp', '.cc', '.mm']):
-            print ('\t  CXX\t' + file_path)
+            text = '\t  CXX\t' + file_path
         else:
-            print ('\t  CC\t' + file_path)
+            text = '\t  CC\t' + file_path
+        if cached:
+            text += ' (cached)'
         if amigo_config.VERBOSE:
-            print (call_str)
-        if status != 0:
-            failed_files.append(file_path)
-
-    # Linking step
+            text += '\n' + launcher.command_line(argv)
+        launcher.print_output(text, result.output if result else b'')
+        if result:
+            return result.peak_rss, seconds, True, result.status
+        return None, seconds, False, 0
+
+    # Returns the object file path for a source file
+    def __object_path(self, file_path):
+        return os.path.join(self.__obj_path, self.__output_name(file_path))
+
+    # Returns the argv compiling file_path into output
+    # Adds the include (and LTO/PGO) flags to cflags
+    def __compile_argv(self, platform, file_path, cc, cflags, output):
+        if self.__include_graph.has_reachable(file_path):
+            self.__add_include_flags(file_path, cflags)
+        if self._lto():
+            cflags.extend(platform.lto_compile_flags())
+        if self._pgo():
+            cflags.extend(pgo.compile_flags(platform, self._pgo(), self.install_dir(platform)))
+            output = os.path.relpath(output)
+        return launcher.split(cc) + ['-c', file_path, '-o', output] + cflags
+
+    # Linking step, returns whether it succeeded
     def _link(self, platform):
         status = 0
-        cc = platform.flags('CXX')
-        ar = platform.flags('AR')
-        ldflags = platform.flags('LDFLAGS').split()
         obj_files = []
-        for (dirpath, dirnames, filenames) in os.walk(self.__obj_path):
+        is_obj = lambda filename: filename.startswith(self.name())
+        for (dirpath, dirnames, filenames) in stat_cache.walk(self.__obj_path, is_obj):
             for filename in filenames:
                 if(filename.startswith(self.name())):
                     obj_files.append(os.path.join(dirpath, filename))
+        obj_files.sort()
         if self.__package_type == CPackage.STATIC_LIB:
             print (('\t%-15s\t' % (self.name() + ':')) + 'Preparing Static Library')
-            output = os.path.join(self.__lib_path, self.__lib_prefix + self.name() + ".a")
-            if not older(output, obj_files):
-                return
-            call_str = ar + " -r " + output + " " + (' '.join(obj_files))
-            if amigo_config.VERBOSE:
-                print (call_str)
-            status = call([call_str], env=platform.var_env(), shell=True)
         elif self.__package_type == CPackage.SHARED_LIB:
             print (('\t%-15s\t' % (self.name() + ':')) + 'Preparing Shared Library')
             self.__add_dep_lib(self.name(), self.__lib_path, True)
-            output = os.path.join(self.__lib_path, self.__lib_prefix + self.name() + ".so")
-            if not older(output, obj_files):
-                return
-            call_str = (cc + " -shared -o " + output + " " +
-                        (' '.join(obj_files)) + " " + (' '.join(ldflags)))
-            if amigo_config.VERBOSE:
-                print (call_str)
-            status = call([call_str], env=platform.var_env(), shell=True)
         elif self.__package_type == CPackage.EXECUTABLE:
             print (('\t%-15s\t' % (self.name() + ':')) + 'Preparing Executable')
-            output = os.path.join(self.__bin_path, self.name())
-            if not older(output, obj_files):
-                return
-            call_str = (cc + " -o " + output + " " +
-                        (' '.join(obj_files)) + " " + (' '.join(ldflags)))
+        output, argv = self.__link_argv(platform, obj_files)
+        if output is not None:
+            # Early cutoff: objects recompiled to the same bytes and deps
+            # relinked to the same bytes don't relink the output
+            dep_outputs = self.__dep_outputs(platform)
+            signature = self.__hashes.signature(obj_files + dep_outputs, argv)
+            self.__hashes.set('deps', self.__hashes.signature(dep_outputs))
+            if stat_cache.isfile(output) and self.__hashes.matches(output, signature):
+                print (('\t%-15s\t' % (self.name() + ':')) + 'Output Unchanged')
+                self.__hashes.save()
+                return True
+            previous = self.__hashes.previous(output)
             if amigo_config.VERBOSE:
-                print (call_str)
-            status = call([call_str], env=platform.var_env(), shell=True)
+                print (launcher.command_line(argv))
+            result = launcher.run(argv, platform.var_env())
+            if result.output:
+                launcher.print_output(None, result.output)
+            status = result.status
+            if status == 0:
+                # Dependents see no change if the output has the same bytes
+                self.__hashes.keep_mtime(output, previous)
+                self.__hashes.set(output, signature)
+            self.__hashes.save()
+            stat_cache.invalidate(output)
         if status != 0:
             print (('\t%-15s\t' % (self.name() + ':')) + error_str('ERROR') + ': Linking Failed!')
-            sys.exit(1)
+            return False
+        return True
 
-    # Appends required include flags to the passed cflags var 
-    def __add_include_flags(self, file_path, cflags, files_added=set(), include_set=set()):
-        def path_len(path):
-            if os.path.normpath(self._package_dir) in path:
-                return len(path) - len(self._package_dir)
-            return len(path)
-        headers = self.__src_to_rel_header_map[file_path]
-        for header in headers:
-            matched_headers = []
-            for header_path in self._headers:
-                if header_path.endswith(header):
-                    matched_headers.append(header_path)
-            if matched_headers:
-                matched_headers = sorted(matched_headers, key=lambda x: path_len(x))
-                header_path = matched_headers[0]
-                if header_path in files_added:
-                    continue
-                files_added.add(header_path)
-                include_path = header_path[:-len(header)]
-                include_set.add(' -I' + include_path)
+    # Returns the outputs of the (transitive) deps linked into the package
+    # Static libs don't link their deps
+    def __dep_outputs(self, platform):
+        if self.__package_type == CPackage.STATIC_LIB:
+            return []
+        dep_outputs = []
+        for dep in self.__all_deps():
+            output = dep.output_path(platform) if isinstance(dep, CPackage) else None
+            if output:
+                dep_outputs.append(output)
+        return sorted(dep_outputs)
+
+    # Returns the deps of the package and their deps
+    def __all_deps(self):
+        all_deps = []
+        deps = list(self.deps())
+        while deps:
+            dep = deps.pop()
+            if dep in all_deps:
+                continue
+            all_deps.append(dep)
+            deps.extend(dep.deps())
+        return all_deps
+
+    # Whether the package needs linking though no source changed: its output
+    # is missing or the content of a dep it links changed
+    def __needs_relink(self, platform):
+        output = self.output_path(platform)
+        if output is None:
+            return False
+        if not stat_cache.isfile(output):
+            return True
+        return not self.__hashes.matches('deps', self.__hashes.signature(self.__dep_outputs(platform)))
 
-        for include_dir in include_set:
-            cflags.append(include_dir)
+    # Returns the package output path and the argv linking obj_files into it
+    # (None, None) if the package type doesn't link
+    def __link_argv(self, platform, obj_files):
+        cc = launcher.split(platform.flags('CXX'))
+        ar = platform.flags('AR')
+        ldflags = platform.flag_tokens('LDFLAGS')
+        if self._lto():
+            ar = platform.lto_ar()
+            ldflags += platform.lto_link_flags(self.__lto_cache_dir(platform))
+        ldflags += pgo.link_flags(self._pgo())
+        output = self.output_path(platform)
+        if self.__package_type == CPackage.STATIC_LIB:
+            return output, launcher.split(ar) + ['-r', output] + obj_files
+        elif self.__package_type == CPackage.SHARED_LIB:
+            return output, cc + ['-shared', '-o', output] + obj_files + ldflags
+        elif self.__package_type == CPackage.EXECUTABLE:
+            return output, cc + ['-o', output] + obj_files + ldflags
+        return None, None
+
+    # Appends the include flags file_path needs to the passed cflags var
+    def __add_include_flags(self, file_path, cflags):
+        cflags.extend(['-I' + include_dir for include_dir in self.__include_dirs(file_path)])
+
+    # Returns the include dirs file_path needs
+    # Only the dirs the #includes it reaches resolve from are returned, ordered
+    # like the header resolution (shortest path within the package first)
+    # Sources reaching the same #include names share the list
+    def __include_dirs(self, file_path):
+        headers = self.__include_graph.reachable_labels(file_path)
+        include_dirs = self.__include_dirs_cache.get(headers)
+        if include_dirs is None:
+            include_dirs = set()
+            for header in headers:
+                header_path = self.__resolve_header(header)
+                if header_path:
+                    include_dirs.add(header_path[:-len(header)])
+            include_dirs = sorted(include_dirs, key=lambda x: (self.__path_len(x), x))
+            self.__include_dirs_cache[headers] = include_dirs
+        return include_dirs
+
+    # Length of a path, relative to the package dir for paths within it
+    def __path_len(self, path):
+        if os.path.normpath(self._package_dir) in path:
+            return len(path) - len(self._package_dir)
+        return len(path)
+
+    # Returns the header an #include name resolves to, None if it isn't
+    # a header of the package or its deps
+    def __resolve_header(self, header):
+        if header not in self.__resolved_headers:
+            matched_headers = [header_path for header_path in
+                               self.__header_index.get(os.path.basename(header), ())
+                               if header_path.endswith(header)]
+            resolved = None
+            if matched_headers:
+                resolved = min(matched_headers, key=lambda x: (self.__path_len(x), x))
+            self.__resolved_headers[header] = resolved
+        return self.__resolved_headers[header]
 
-    def __collect_files_by_extension(self, filenames=set()):
+    def __collect_files_by_extension(self, filenames):
         for file_path in self.files():
             filename = os.path.basename(file_path)
             if check_extensions(file_path, self.__header_exts):
@@ -381,101 +667,138 @@ class CPackage(Package):
                     self._sources.add(file_path)
 
     # Populates Source<-->Header maps
-    def __populate_src_maps(self):
+    def __populate_src_maps(self, platform, env_vars=None):
+        self.__header_index = {}
+        for header_path in self._headers:
+            self.__header_index.setdefault(os.path.basename(header_path), []).append(header_path)
+        self.__scanner = IncludeScanner(self.__scan_conditions(platform, env_vars),
+                                        amigo_config.SCAN_HEAD_ONLY)
+        # Scan the include tree level by level so each level is scanned in parallel
+        pending = [file_path for file_path in self._sources if stat_cache.isfile(file_path)]
+        scanned = set(pending)
+        while pending:
+            self.__scanner.scan_files(pending)
+            found = []
+            for file_path in pending:
+                for header_file in self.__scanner.includes(file_path):
+                    for header_path in self.__header_index.get(os.path.basename(header_file), ()):
+                        if header_path not in scanned:
+                            scanned.add(header_path)
+                            found.append(header_path)
+            pending = found
+        self.__include_graph = PathGraph()
+        self.__resolved_headers = {}
+        self.__include_dirs_cache = {}
         for file_path in self._sources:
-            self.__populate_src_maps_for_file(file_path)
+            self.__add_includes(file_path)
 
-    # Adds entry to Header->Sources map
-    def __add_header_to_src_mapping(self, header_path, source_file):
-        if header_path in self.__header_to_src_map:
-            self.__header_to_src_map[header_path].add(source_file)
-        else:
-            self.__header_to_src_map[header_path] = {source_file}
-
-    # Adds entry to Source->Headers map
-    def __add_src_to_header_mapping(self, source_file, header_path):
-        if source_file in self.__src_to_header_map:
-            self.__src_to_header_map[source_file].add(header_path)
-        else:
-            self.__src_to_header_map[source_file] = {header_path}
-
-    # Adds entry to Source->RelativeHeaders map
-    # Relative header is the path in the actual #include statement
-    def __add_src_to_rel_header_mapping(self, source_file, header_file):
-        if source_file in self.__src_to_rel_header_map:
-            self.__src_to_rel_header_map[source_file].add(header_file)
-        else:
-            self.__src_to_rel_header_map[source_file] = {header_file}
-
-    # Recursively populate Source<-->Header maps for the given source file
-    def __populate_src_maps_for_file(self, source_file):
-        if not os.path.isfile(source_file):
+    # Returns the preprocessor conditions used to skip disabled #includes
+    # Only #if 0 style constant conditions unless conditional scanning is enabled
+    def __scan_conditions(self, platform, env_vars=None):
+        if not amigo_config.SCAN_CONDITIONALS:
+            return Conditions()
+        if not env_vars:
+            env_vars = self._env_vars
+        flags = []
+        for key in ('CFLAGS', 'CXXFLAGS'):
+            if key in env_vars:
+                key_flags = env_vars[key]
+            else:
+                key_flags = platform.default_flags(key)
+            flags.append(key_flags + ' ' + self._appended_flags.get(key, ''))
+        return conditions_from_flags(*flags)
+
+    # Adds the source file and the headers it includes, directly or
+    # indirectly, to the include graph
+    def __add_includes(self, source_file):
+        if not stat_cache.isfile(source_file):
             return
-        files_checked = set()
-
-        def include_loop(file_path):
-            if file_path in files_checked:
-                return
-            files_checked.add(file_path)
-            if file_path in self.__src_to_header_map:
-                for header_rel_path in self.__src_to_rel_header_map[file_path]:
-                    self.__add_src_to_rel_header_mapping(source_file, header_rel_path)
-                for header_path in self.__src_to_header_map[file_path]:
-                    self.__add_header_to_src_mapping(header_path, source_file)
-                    self.__add_src_to_header_mapping(source_file, header_path)
-                    include_loop(header_path)
-                return
-            for line in open(file_path):
-                match = re.match(r'\s*#\s*include\s*("|<)\s*(.*)\s*("|>).*', line)
-                if match:
-                    header_file = match.group(2).strip()
-                    header_file_name = os.path.basename(header_file)
-                    for header_path in self._headers:
-                        if os.path.basename(header_path) == header_file_name:
-                            self.__add_header_to_src_mapping(header_path, source_file)
-                            self.__add_src_to_header_mapping(source_file, header_path)
-                            self.__add_src_to_rel_header_mapping(source_file, header_file)
-                            if file_path is not source_file:
-                                self.__add_src_to_header_mapping(file_path, header_path)
-                                self.__add_src_to_rel_header_mapping(file_path, header_file)
-                            include_loop(header_path)
-
-        include_loop(source_file)
+        self.__include_graph.add_root(source_file)
+        pending = [source_file]
+        while pending:
+            file_path = pending.pop()
+            if self.__include_graph.is_expanded(file_path):
+                continue
+            header_paths = []
+            header_files = []
+            for header_file in self.__scanner.includes(file_path):
+                resolved = self.__header_index.get(os.path.basename(header_file), ())
+                if resolved:
+                    header_paths += resolved
+                    header_files.append(header_file)
+            self.__include_graph.set_edges(file_path, header_paths, header_files)
+            pending += header_paths
 
     # Returns a set of source files that require recompilation
+    # Also records why each source is recompiled in the build history:
+    # 'new' (no object), 'source' (source changed), 'header' (included header changed)
+    # or 'profile' (PGO profile of the object changed)
     def __needs_recompile(self):
-        sources_to_recompile = set()
+        reasons = {}
         for source_file in self._sources:
-            if not (source_file  in self.__src_to_header_map and self.__src_to_header_map[source_file]):
-                obj_file = self.__output_name(source_file)
-                obj_path = os.path.join(self.__obj_path, obj_file)
-                if (not os.path.isfile(obj_path) or
-                        older(obj_path, [source_file])):
-                    sources_to_recompile.add(source_file)
-        for header_file in self._headers:
-            if header_file in self.__header_to_src_map:
-                sources = self.__header_to_src_map[header_file]
-                for source_file in sources:
-                    obj_file = self.__output_name(source_file)
-                    obj_path = os.path.join(self.__obj_path, obj_file)
-                    if (not os.path.isfile(obj_path) or
-                            older(obj_path, [header_file, source_file])):
-                        sources_to_recompile.add(source_file)
-        return sources_to_recompile
-
-    def cmake(self, platform):
+            reason = self.__recompile_reason(source_file)
+            if reason:
+                reasons[source_file] = reason
+        build_history.record_files(self, len(self._sources), reasons)
+        return set(reasons)
+
+    # Returns (reason, changed file) if the source needs recompiling, None otherwise
+    def __recompile_reason(self, source_file):
+        obj_file = self.__output_name(source_file)
+        obj_path = os.path.join(self.__obj_path, obj_file)
+        obj_mtime = stat_cache.mtime(obj_path)
+        if obj_mtime is None:
+            return ('new', source_file)
+        # Same checks as older(), with the object's mtime looked up once
+        source_mtime = stat_cache.mtime(source_file)
+        if source_mtime is None or obj_mtime <= source_mtime:
+            return ('source', source_file)
+        changed_headers = []
+        for header_file in self.__include_graph.reachable(source_file):
+            header_mtime = stat_cache.mtime(header_file)
+            if header_mtime is None or obj_mtime <= header_mtime:
+                changed_headers.append((header_mtime, header_file))
+        if changed_headers:
+            # Credits the same header in every run: a missing one, else the
+            # newest, ties by path
+            return ('header', min(changed_headers, key=lambda x: (x[0] is not None, -(x[0] or 0), x[1]))[1])
+        if self.__profiles and self.__profiles.changed(obj_path, os.path.dirname(self.__obj_path)):
+            return ('profile', source_file)
+        return None
+
+    # Collects the package files and scans their #includes without building
+    # Optional: also resolve #includes of headers of dependencies scanned before
+    def scan(self, platform, dep_headers=False):
         print (('\t%-15s\t' % (self.name() + ':')) + 'Collecting Files')
         self._collect_files()
         print (('\t%-15s\t' % (self.name() + ':')) + 'Indexing Files')
-        self.__collect_files_by_extension()
-        self.__populate_src_maps()
+        self.__collect_files_by_extension(set())
+        if dep_headers:
+            for dep in self.deps():
+                self._headers.update(dep.headers())
+        self.__populate_src_maps(platform)
+
+    # Returns {header path: set of sources including it directly or indirectly}
+    # Available after scan() or a build
+    def header_to_sources(self):
+        return self.__include_graph.reverse_closure()
+
+    # Returns {file path: set of header paths it includes directly}
+    # for the sources and the headers they include
+    # Available after scan() or a build
+    def include_graph(self):
+        return dict((file_path, set(header_paths))
+                    for file_path, header_paths in self.__include_graph.edges())
+
+    def cmake(self, platform):
+        self.scan(platform)
         print (('\t%-15s\t' % (self.name() + ':')) + 'Collecting Header Dirs')
-        include_dirs = []
+        include_dirs = set()
         for file_path in self._sources:
-            if file_path in self.__src_to_header_map:
-                self.__add_include_flags(file_path, include_dirs)
+            if self.__include_graph.has_reachable(file_path):
+                include_dirs.update(self.__include_dirs(file_path))
 
-        include_dirs = ' '.join(map(lambda x: "${PROJECT_SOURCE_DIR}/"+x[3:], list(set(include_dirs))))
+        include_dirs = ' '.join(map(lambda x: "${PROJECT_SOURCE_DIR}/"+x, list(include_dirs)))
         dep_include_dirs = set()
         for dep in self.deps():
             dep_dir = dep.install_dir(platform)
@@ -496,32 +819,92 @@ class CPackage(Package):
         print("add_library(%s STATIC %s)" % (self.name(), ' '.join(sources)), file=cmake_file)
 
 
+    # Writes a build.ninja and compile_commands.json that build the package
+    # and its dependencies with the commands amigomake computes
+    def ninja(self, platform, ninja_path='build.ninja', compdb_path='compile_commands.json'):
+        print (('\t%-15s\t' % (self.name() + ':')) + 'Creating ' + ninja_path)
+        generate_ninja([self], platform, ninja_path, compdb_path)
+
+    # Adds the package's build statements to the ninja context
+    # Returns the package outputs that dependents should depend on
+    def _write_ninja(self, platform, context):
+        if self in context.outputs:
+            return context.outputs[self]
+        context.outputs[self] = []
+        self._pre_build(platform)
+        self.__init_output_dirs(platform)
+        self.__collect_files_by_extension(set())
+        dep_outputs = []
+        dep_install_dirs = self.__process_deps(
+            platform, lambda dep: dep_outputs.extend(dep._write_ninja(platform, context)))
+        self.__crush_deps(platform, dep_install_dirs)
+        print (('\t%-15s\t' % (self.name() + ':')) + 'Initializing Source Maps')
+        self.__populate_src_maps(platform)
+        self.__configure_flags(platform, self._env_vars, dep_install_dirs)
+
+        print (('\t%-15s\t' % (self.name() + ':')) + 'Writing Build Statements')
+        writer = context.writer
+        writer.comment(self.name())
+        obj_files = []
+        for file_path in sorted(self._sources):
+            compiler = source_compiler(file_path, platform)
+            if not compiler:
+                continue
+            cc, cflags = compiler
+            output = self.__object_path(file_path)
+            command = launcher.command_line(self.__compile_argv(platform, file_path, cc, cflags, output))
+            if check_extensions(file_path, ['.cpp', '.cc', '.mm']):
+                desc = 'CXX ' + file_path
+            else:
+                desc = 'CC ' + file_path
+            writer.build(output, 'cc', file_path, order_only=dep_outputs,
+                         variables={'cmd': escape(command), 'desc': escape(desc)})
+            context.compile_commands.append({'directory': context.directory, 'command': command,
+                                             'file': file_path, 'output': output})
+            obj_files.append(output)
+
+        outputs = []
+        if self.__package_type == CPackage.SHARED_LIB:
+            self.__add_dep_lib(self.name(), self.__lib_path, True)
+        output, argv = self.__link_argv(platform, obj_files)
+        if output is not None:
+            command = launcher.command_line(argv)
+            writer.build(output, 'link', obj_files, implicit=dep_outputs,
+                         variables={'cmd': escape(command), 'desc': escape('LINK ' + output)})
+            outputs.append(output)
+        if self.__should_install_headers:
+            inc_path = self.__include_path(platform)
+            for header in sorted(self.headers()):
+                installed = os.path.join(inc_path, os.path.basename(header))
+                writer.build(installed, 'copy', header)
+                outputs.append(installed)
+        writer.newline()
+        context.outputs[self] = outputs
+        return outputs
+
+
 class CompilerFunc(object):
     def __init__(self, package, platform):
         self.__platform = platform
         self.__package = package
 
+    # Returns the compile_file result
     def __call__(self, file_path):
-        if failed_files:
-            return
-        self.__compile_file_path(self.__platform, file_path)
+        return self.__compile_file_path(self.__platform, file_path)
 
     def __compile_file_path(self, platform, file_path):
-        if check_extensions(file_path, ['.c', '.m']):
-            self.__c_build(file_path, platform)
-        if check_extensions(file_path, ['.cpp', '.cc', '.mm']):
-            self.__cpp_build(file_path, platform)
-
-    # Compiles a c file for the specifies platform
-    def __c_build(self, file_path, platform):
-        cc = platform.flags('CC')
-        cflags = platform.flags('CFLAGS').split()
-        self.__package.compile_file(file_path, platform, cc, cflags)
-
-    # Compiles a c file for the specifies platform
-    def __cpp_build(self, file_path, platform):
-        cc = platform.flags('CXX')
-        cflags = platform.flags('CXXFLAGS').split()
-        self.__package.compile_file(file_path, platform, cc, cflags)
-
-
+        compiler = source_compiler(file_path, platform)
+        if compiler:
+            cc, cflags = compiler
+            return self.__package.compile_file(file_path, platform, cc, cflags)
+        return None
+
+
+# Returns the (compiler, flags list) used to build a source file
+# or None if the file isn't a C/C++/Objective-C source
+def source_compiler(file_path, platform):
+    if check_extensions(file_path, ['.c', '.m']):
+        return platform.flags('CC'), platform.flag_tokens('CFLAGS')
+    if check_extensions(file_path, ['.cpp', '.cc', '.mm']):
+        return platform.flags('CXX'), platform.flag_tokens('CXXFLAGS')
+    return None
@@ -1,13 +1,24 @@
 from subprocess import call
-from multiprocessing import cpu_count
 from cpackage import CPackage
 from package import error_str, warn_str
+from job_scheduler import make_job_args
+from file_lock import FileLock, dir_lock_path, write_json
+from platform import Platform
 import amigo_config
+import build_history
+import json
+import remote_cache
+import stat_cache
 import zipfile
 import tarfile
 import os
 import sys
 import shutil
+import time
+
+# Start of this run, installs completed after it by concurrent runs are
+# reused instead of rebuilt
+_run_started = time.time()
 
 class ExternalCPackage(CPackage):
     def __init__(self, version, rootdir, package_type=CPackage.EXTERNAL, package_name=None, num_threads=1):
@@ -23,6 +34,13 @@ class ExternalCPackage(CPackage):
         self.__files_to_copy = []
         self.__cwd = os.getcwd()
 
+    # External packages are built without link-time or profile-guided optimization
+    def _lto(self):
+        return False
+
+    def _pgo(self):
+        return None
+
     # Returns the root directory for the package
     def rootdir(self):
         return self._package_dir
@@ -137,11 +155,16 @@ class ExternalCPackage(CPackage):
 
         return True
 
+    # Returns the env vars and configure command the package is built with
+    # Packages set their flags and configure options here rather than in
+    # _build, so they're part of the remote cache key
+    def _build_options(self, platform, env_vars, configure):
+        return env_vars, configure
+
     # Build step: configure, make
     def _build(self, platform, env_vars=None, configure=""):
         install_dir = os.path.abspath(self.install_dir(platform))
-        if not env_vars:
-            env_vars = self._env_vars
+        env_vars, configure = self._build_options(platform, dict(env_vars or self._env_vars), configure)
         try:
             app_flags = self._appended_flags.iteritems()
         except AttributeError:
@@ -161,25 +184,118 @@ class ExternalCPackage(CPackage):
         self._build_finished = True
 
     # Builds the package
+    # The build runs under an exclusive lock on the install dir, and the
+    # extraction, configure and make under one on the source dir (shared by
+    # the variants of a platform and arch), so concurrent amigomake runs
+    # don't build in the same dirs
+    # Like other packages, flags the build sets on the platform are reverted
+    # when it's done
     def build(self, platform, env_vars=None, configure=""):
         if self._build_finished:
             return
-        if not env_vars:
-            env_vars = self._env_vars
+        # Builds change their vars, keep the package's as set
+        env_vars = dict(env_vars or self._env_vars)
+        with stat_cache.scope(), platform.flag_scope():
+            self.__build(platform, env_vars, configure)
 
-        if self._pre_build(platform):
-            self._build(platform, env_vars, configure)
-        self._post_build(platform)
+    def __build(self, platform, env_vars, configure):
+        install_dir = self.install_dir(platform)
+        with FileLock(dir_lock_path(install_dir)), build_history.timed(self, platform):
+            stamp_path = os.path.join(install_dir, '.amigo', 'installed-' + self.name() + '.json')
+            key = self._cache_key(platform, env_vars, configure)
+            # Dependents need the deps, even when this package isn't built
+            for dep in self.deps():
+                dep.build(platform)
+            if self.__installed_concurrently(stamp_path, key):
+                print (('\t%-15s\t' % (self.name() + ':')) + 'Installed by a concurrent build')
+                build_history.record_noop(self, True)
+                self._build_finished = True
+                return
+            installed_before = None
+            if remote_cache.enabled():
+                if remote_cache.fetch_package(key, install_dir):
+                    print (('\t%-15s\t' % (self.name() + ':')) + 'Installed from the cache')
+                    build_history.record_noop(self, True)
+                    write_json(stamp_path, {'key': key, 'time': time.time()})
+                    self._build_finished = True
+                    return
+                installed_before = remote_cache.snapshot(install_dir)
+            with FileLock(self.__source_lock_path()):
+                built = self._pre_build(platform)
+                if built:
+                    with build_history.phase(self, 'build'):
+                        self._build(platform, env_vars, configure)
+                build_history.record_noop(self, not built)
+                self._post_build(platform)
+            if built:
+                write_json(stamp_path, {'key': key, 'time': time.time()})
+                if installed_before is not None:
+                    remote_cache.store_package(key, install_dir,
+                                               remote_cache.changed_files(install_dir, installed_before))
+
+    # Returns the lock file guarding the source dir: the local path, or the
+    # package's extraction in the root dir
+    def __source_lock_path(self):
+        if self.__local_path is not None:
+            return dir_lock_path(self.__local_path)
+        return os.path.join(self.rootdir(), self.name() + '.lock')
+
+    # Returns the strings describing how the package is built: what it's
+    # built from, with which flags and options, for which platform and
+    # install dir (installed files can hold the prefix)
+    # Packages choosing options _build_options doesn't return (eg. which
+    # components to build) add them
+    def _cache_strings(self, platform, env_vars, configure):
+        env_vars, configure = self._build_options(platform, dict(env_vars), configure)
+        strings = [self.__class__.__name__, self.name(), self.__version, str(self.__url), str(self.__zipname),
+                   platform.build_name(), self.install_dir(platform), str(configure),
+                   str(amigo_config.GCC), str(amigo_config.CXX11)]
+        for key in sorted(Platform.FLAG_KEYS) + ['CC', 'CXX', Platform.CONFIG_FLAGS]:
+            strings += [key, str(platform.default_flags(key))]
+        for values in (self._appended_flags, env_vars):
+            strings += [key + '=' + str(values[key]) for key in sorted(values)]
+        return strings
+
+    # Returns the remote cache key of the package's install, from its
+    # cache strings and patches and the keys of its deps
+    def _cache_key(self, platform, env_vars, configure):
+        strings = self._cache_strings(platform, env_vars, configure)
+        for dep in self.deps():
+            if isinstance(dep, ExternalCPackage):
+                strings.append(dep._cache_key(platform, dep._env_vars, ''))
+            else:
+                strings.append(dep.name())
+        files = self.__patches + [to_copy[0] for to_copy in self.__files_to_copy]
+        return remote_cache.package_key(strings, files)
+
+    # Whether another amigomake run installed the package with the same
+    # key (version, options, deps...) while this run waited for the lock
+    def __installed_concurrently(self, stamp_path, key):
+        try:
+            with open(stamp_path) as f:
+                stamp = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        return stamp.get('key') == key and stamp.get('time', 0) >= _run_started
+
+    # External packages aren't described in ninja, they're built up front
+    # and their installs are used as prebuilt inputs
+    def _write_ninja(self, platform, context):
+        if self not in context.outputs:
+            context.outputs[self] = []
+            self.build(platform)
+        return context.outputs[self]
 
     # Make step
     def _make(self, platform, install_dir):
-        if self._num_threads:
-            mt = '-j' + str(self._num_threads)
-        else:
-            mt = '-j' + str(cpu_count())
-        call(["make", mt], env=platform.var_env())
+        mt = self._make_jobs()
+        call(["make"] + mt, env=platform.var_env())
         call(["make", "install"], env=platform.var_env())
 
+    # Returns the make -j/-l arguments, with the job count capped by available memory
+    def _make_jobs(self):
+        return make_job_args(self._num_threads)
+
     # Adds a file to copy to a path relative to the source dir
     def copy_to_src(self, copy_from, copy_to):
         self.__files_to_copy.append([os.path.abspath(copy_from), copy_to])
@@ -190,6 +306,10 @@ class ExternalCPackage(CPackage):
         patch_path = os.path.abspath(patch_path)
         self.__patches.append(patch_path)
 
+    # Returns the patch files
+    def patches(self):
+        return self.__patches
+
     # Clears the patches
     def remove_patches(self):
         self.__patches = []
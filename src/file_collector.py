@@ -0,0 +1,193 @@
+from fnmatch import fnmatch
+from file_lock import write_json
+import amigo_config
+import atexit
+import json
+import os
+import stat_cache
+import time
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+# Directories containing this file are build outputs and never collected
+BUILD_MARKER = '.amigo_build'
+# Names of the per-platform build dirs created under <package>/build
+BUILD_DIR_PATTERNS = ['native_x86*', 'android_*', 'ios_*']
+# Ignore file read from the root of a package
+IGNORE_FILE = '.amigoignore'
+# Always ignored
+DEFAULT_IGNORES = ['.git/', '.hg/', '.svn/', '.amigomake/']
+# Listings of directories modified less than this many seconds ago aren't
+# cached, entries could still be added within the same mtime tick
+SNAPSHOT_MIN_AGE = 2
+
+# Install dirs of all packages, pruned from every collection
+_install_dirs = set()
+# Absolute dir path -> [dir mtime, subdir names, file names]
+_snapshots = None
+_snapshots_changed = False
+
+
+# Registers a directory holding build outputs
+def add_install_dir(path):
+    _install_dirs.add(os.path.abspath(path))
+
+
+# Marks a directory as build output
+def mark_build_dir(path):
+    marker = os.path.join(path, BUILD_MARKER)
+    if not os.path.exists(marker):
+        open(marker, 'a').close()
+
+
+def _snapshot_path():
+    if not amigo_config.STATE_DIR:
+        return None
+    return os.path.join(amigo_config.STATE_DIR, 'dir_snapshot.json')
+
+
+def _load_snapshots():
+    global _snapshots
+    if _snapshots is not None:
+        return
+    _snapshots = {}
+    path = _snapshot_path()
+    if path:
+        try:
+            with open(path) as f:
+                _snapshots = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+        atexit.register(save_snapshots)
+
+
+# Writes the directory listings cached in this run
+def save_snapshots():
+    global _snapshots_changed
+    path = _snapshot_path()
+    if not path or not _snapshots_changed:
+        return
+    write_json(path, _snapshots)
+    _snapshots_changed = False
+
+
+# Returns (subdir names, file names) of a directory, from the snapshot when
+# the directory's mtime didn't change since it was listed
+# Symlinked directories are left out, like os.walk they aren't followed
+# Files of fresh listings matching record(name) get their mtime cached in stat_cache
+def _list_dir(path, record):
+    global _snapshots_changed
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return [], []
+    snapshot = _snapshots.get(path)
+    if snapshot and snapshot[0] == mtime:
+        return snapshot[1], snapshot[2]
+    dirnames = []
+    filenames = []
+    if scandir is not None:
+        try:
+            entries = list(scandir(path))
+        except OSError:
+            return [], []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    dirnames.append(entry.name)
+            else:
+                filenames.append(entry.name)
+                if record(entry.name):
+                    stat_cache.record(entry)
+    else:
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return [], []
+        for name in names:
+            name_path = os.path.join(path, name)
+            if os.path.isdir(name_path):
+                if not os.path.islink(name_path):
+                    dirnames.append(name)
+            else:
+                filenames.append(name)
+    if time.time() - mtime >= SNAPSHOT_MIN_AGE:
+        _snapshots[path] = [mtime, dirnames, filenames]
+        _snapshots_changed = True
+    return dirnames, filenames
+
+
+# Returns the ignore patterns of the .amigoignore file in a directory
+# One glob per line, # starts a comment
+def read_ignore_file(directory):
+    patterns = []
+    try:
+        with open(os.path.join(directory, IGNORE_FILE)) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    patterns.append(line)
+    except (IOError, OSError):
+        pass
+    return patterns
+
+
+# Whether an ignore pattern matches a path relative to the collection root
+# Patterns with a / (other than a trailing one) match the relative path,
+# others the name; a trailing / only matches directories
+def _ignored(patterns, rel_path, name, is_dir):
+    for pattern in patterns:
+        if pattern.endswith('/'):
+            if not is_dir:
+                continue
+            pattern = pattern[:-1]
+        if '/' in pattern:
+            if fnmatch(rel_path, pattern.lstrip('/')):
+                return True
+        elif fnmatch(name, pattern):
+            return True
+    return False
+
+
+def _is_build_dir(parent, name):
+    if os.path.basename(parent) != 'build':
+        return False
+    for pattern in BUILD_DIR_PATTERNS:
+        if fnmatch(name, pattern):
+            return True
+    return False
+
+
+# Returns the paths of the files under top for which match(filename) is true
+# Skips registered install dirs, per-platform build dirs, directories with a
+# build marker, and paths matching the ignore patterns or top/.amigoignore
+# Paths are joined onto top like os.walk does
+def collect(top, match, ignore_patterns=()):
+    _load_snapshots()
+    patterns = DEFAULT_IGNORES + read_ignore_file(top) + list(ignore_patterns)
+    abs_top = os.path.abspath(top)
+    files = []
+    pending = [(top, abs_top, '')]
+    while pending:
+        dirpath, abs_dirpath, rel_dirpath = pending.pop()
+        dirnames, filenames = _list_dir(abs_dirpath, match)
+        if BUILD_MARKER in filenames and abs_dirpath != abs_top:
+            continue
+        for filename in filenames:
+            rel_path = rel_dirpath + filename
+            if match(filename) and not _ignored(patterns, rel_path, filename, False):
+                files.append(os.path.join(dirpath, filename))
+        for dirname in reversed(dirnames):
+            abs_path = os.path.join(abs_dirpath, dirname)
+            rel_path = rel_dirpath + dirname
+            if (abs_path in _install_dirs or _is_build_dir(abs_dirpath, dirname) or
+                    _ignored(patterns, rel_path, dirname, True)):
+                continue
+            pending.append((os.path.join(dirpath, dirname), abs_path, rel_path + '/'))
+    return files
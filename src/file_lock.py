@@ -0,0 +1,113 @@
+import json
+import os
+import tempfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Locks held by this process: lock file path -> [file, shared, count]
+# Locking a path again (eg. a package building a dep with the same install
+# dir) nests instead of waiting on itself
+_held = {}
+
+
+# Inter-process lock on a lock file (flock), for build steps that several
+# amigomake runs (eg. one per arch, or CI jobs sharing a root dir) may run
+# at the same time
+# Shared locks can be held together, an exclusive lock waits for all others
+# Re-locking a path held by this process nests, a shared lock nested in an
+# exclusive one keeps it exclusive
+# Without fcntl (Windows) locking is skipped
+#
+#   with FileLock(path + '.lock'):
+#       ...
+class FileLock(object):
+    def __init__(self, path, shared=False):
+        self.__path = os.path.abspath(path)
+        self.__shared = shared
+        # Whether entering upgraded a shared lock of this process
+        self.__upgraded = False
+
+    def __enter__(self):
+        held = _held.get(self.__path)
+        if held:
+            if held[1] and not self.__shared:
+                _flock(held[0], False)
+                held[1] = False
+                self.__upgraded = True
+            held[2] += 1
+            return self
+        directory = os.path.dirname(self.__path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process
+                pass
+        lock_file = open(self.__path, 'a')
+        _flock(lock_file, self.__shared)
+        _held[self.__path] = [lock_file, self.__shared, 1]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        held = _held[self.__path]
+        held[2] -= 1
+        if self.__upgraded:
+            _flock(held[0], True)
+            held[1] = True
+            self.__upgraded = False
+        if held[2] == 0:
+            if fcntl:
+                fcntl.flock(held[0].fileno(), fcntl.LOCK_UN)
+            held[0].close()
+            del _held[self.__path]
+
+
+# Locks several paths, in sorted order so runs locking overlapping sets
+# don't deadlock
+class FileLocks(object):
+    def __init__(self, paths, shared=False):
+        self.__locks = [FileLock(path, shared) for path in sorted(set(paths))]
+        self.__entered = []
+
+    def __enter__(self):
+        for lock in self.__locks:
+            lock.__enter__()
+            self.__entered.append(lock)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        while self.__entered:
+            self.__entered.pop().__exit__(exc_type, exc_value, traceback)
+
+
+def _flock(lock_file, shared):
+    if fcntl:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+
+# Returns the lock file guarding a directory (next to it, so removing or
+# replacing the directory keeps the lock)
+def dir_lock_path(path):
+    return os.path.abspath(path).rstrip(os.sep) + '.lock'
+
+
+# Writes data as JSON to a temp file and renames it over path, so readers
+# never see a partial file and concurrent writers don't interleave
+def write_json(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
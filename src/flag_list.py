@@ -0,0 +1,102 @@
+import shlex
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Options taking the next token as their value, kept together with it
+PAIRED_FLAGS = set([
+    '-arch', '-isysroot', '-sysroot', '-target', '-include', '-imacros', '-isystem', '-iquote',
+    '-idirafter', '-iprefix', '-I', '-L', '-F', '-B', '-D', '-U', '-x', '-o', '-MF', '-MT', '-MQ',
+    '-framework', '-weak_framework', '-Xlinker', '-Xclang', '-Xassembler', '-Xpreprocessor', '-mllvm',
+    '-install_name', '-rpath', '-exported_symbols_list', '-bundle_loader', '-u', '-e',
+])
+# Search path options, the first occurrence wins
+SEARCH_FLAGS = ('-I', '-L', '-F', '-B', '-isystem', '-iquote', '-idirafter', '-iprefix')
+# Options whose meaning depends on their position (eg. -Wl,--whole-archive
+# around some libs), never deduplicated
+POSITIONAL_FLAGS = ('-Wl,', '-Xlinker', '-Xclang', '-Xassembler', '-Xpreprocessor', '-Xarch_', '-mllvm')
+
+
+# Groups tokens into flags, an option and its separate value are one flag
+def _group(tokens):
+    flags = []
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token in PAIRED_FLAGS and index + 1 < len(tokens):
+            flags.append((token, tokens[index + 1]))
+            index += 2
+        else:
+            flags.append((token,))
+            index += 1
+    return flags
+
+
+# Ordered, deduplicated list of command line flags (eg. CFLAGS)
+# Strings are split with the shell's quoting rules and rendered quoted again
+# Duplicates keep the first occurrence for search paths (-I, -L...) and the
+# last one otherwise, which is the one compilers and linkers honor (-O, -D)
+# and keeps libs (-l, archives) after the objects and libs using them
+class FlagList(object):
+    def __init__(self, flags=''):
+        self.__flags = []
+        self.__seen = set()
+        self.extend(flags)
+
+    # Appends flags, a string or a list of tokens
+    def extend(self, flags):
+        if isinstance(flags, string_types):
+            flags = shlex.split(flags)
+        for flag in _group(flags):
+            if flag[0].startswith(POSITIONAL_FLAGS):
+                self.__flags.append(flag)
+                continue
+            if flag in self.__seen:
+                if flag[0].startswith(SEARCH_FLAGS):
+                    continue
+                self.__flags.remove(flag)
+            self.__seen.add(flag)
+            self.__flags.append(flag)
+
+    def tokens(self):
+        return [token for flag in self.__flags for token in flag]
+
+    def copy(self):
+        flag_list = FlagList()
+        flag_list.__flags = list(self.__flags)
+        flag_list.__seen = set(self.__seen)
+        return flag_list
+
+    def __str__(self):
+        return ' '.join(quote(token) for token in self.tokens())
+
+
+# Ordered, deduplicated list of paths separated by ':' (eg. LD_LIBRARY_PATH)
+# The first occurrence of a path wins like in a search
+class PathList(object):
+    def __init__(self, paths=''):
+        self.__paths = []
+        self.extend(paths)
+
+    # Appends paths, a ':' separated string or a list
+    def extend(self, paths):
+        if isinstance(paths, string_types):
+            paths = paths.split(':')
+        for path in paths:
+            path = path.strip()
+            if path and path not in self.__paths:
+                self.__paths.append(path)
+
+    def tokens(self):
+        return list(self.__paths)
+
+    def copy(self):
+        return PathList(self.__paths)
+
+    def __str__(self):
+        return ':'.join(self.__paths)
@@ -0,0 +1,158 @@
+from build_stats import median
+import json
+
+# Rows printed per ranking
+TOP = 20
+# PCH candidates: included by at least this share of a package's sources...
+PCH_MIN_SHARE = 0.5
+# ...of a package with at least this many sources...
+PCH_MIN_SOURCES = 4
+# ...and changed at most this many times
+PCH_MAX_CHANGES = 1
+# Split candidates: changed at least this many times while included by
+# at least this share of a package's sources...
+SPLIT_MIN_CHANGES = 2
+SPLIT_MIN_SHARE = 0.25
+# ...or umbrella headers including at least this many headers directly
+SPLIT_MIN_INCLUDES = 8
+
+
+# Returns the strongly connected components with more than one file
+# (or a file including itself) of an include graph
+def include_cycles(graph):
+    index = {}
+    low = {}
+    on_stack = set()
+    stack = []
+    cycles = []
+    counter = [0]
+    for root in sorted(graph):
+        if root in index:
+            continue
+        # Iterative Tarjan: (node, iterator over its includes)
+        work = [(root, iter(sorted(graph.get(root, ()))))]
+        index[root] = low[root] = counter[0]
+        counter[0] += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, includes = work[-1]
+            advanced = False
+            for child in includes:
+                if child not in index:
+                    index[child] = low[child] = counter[0]
+                    counter[0] += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(sorted(graph.get(child, ())))))
+                    advanced = True
+                    break
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+            if advanced:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+            if low[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1 or node in graph.get(node, ()):
+                    cycles.append(sorted(component))
+    return cycles
+
+
+# Ranks headers by what they cost incremental builds
+# packages: [(package name, sources, header_to_sources, include_graph)]
+# compile_times: {source path: seconds}, sources without a recorded time
+# are assumed to take the median time
+# changes: {header path: number of builds its change triggered}
+class HeaderReport(object):
+    def __init__(self, packages, compile_times, changes):
+        default_time = median(compile_times.values()) or 0.0
+        includers = {}
+        share = {}
+        graph = {}
+        for name, sources, header_to_sources, include_graph in packages:
+            for header, header_sources in header_to_sources.items():
+                includers.setdefault(header, set()).update(header_sources)
+                if len(sources) >= PCH_MIN_SOURCES:
+                    header_share = float(len(header_sources)) / len(sources)
+                    share[header] = max(share.get(header, 0.0), header_share)
+            for file_path, includes in include_graph.items():
+                graph.setdefault(file_path, set()).update(includes)
+
+        self.cycles = include_cycles(graph)
+        in_cycle = set(file_path for cycle in self.cycles for file_path in cycle)
+        self.headers = []
+        for header, header_sources in includers.items():
+            rebuild = sum(compile_times.get(source, default_time) for source in header_sources)
+            header_changes = changes.get(header, 0)
+            direct = len(graph.get(header, ()))
+            entry = {
+                'header': header,
+                'includers': len(header_sources),
+                'rebuild_seconds': rebuild,
+                'estimated': any(source not in compile_times for source in header_sources),
+                'cost': len(header_sources) * rebuild,
+                'changes': header_changes,
+                'churn_seconds': header_changes * rebuild,
+                'includes': direct,
+                'share': share.get(header, 0.0),
+                'cycle': header in in_cycle,
+            }
+            entry['pch'] = (entry['share'] >= PCH_MIN_SHARE and header_changes <= PCH_MAX_CHANGES and
+                            not entry['cycle'])
+            entry['split'] = ((header_changes >= SPLIT_MIN_CHANGES and entry['share'] >= SPLIT_MIN_SHARE) or
+                              (direct >= SPLIT_MIN_INCLUDES and len(header_sources) > 1))
+            self.headers.append(entry)
+
+    # Headers sorted by includers x compile time of the includers
+    def by_cost(self):
+        return sorted(self.headers, key=lambda x: (-x['cost'], x['header']))
+
+    # Headers that changed, sorted by the compile time their changes caused
+    def by_churn(self):
+        return sorted([x for x in self.headers if x['changes']],
+                      key=lambda x: (-x['churn_seconds'], -x['changes'], x['header']))
+
+    def to_json(self):
+        return json.dumps({
+            'headers': self.by_cost(),
+            'cycles': self.cycles,
+        }, indent=2)
+
+    def __print_rows(self, entries):
+        print ('\t%-40s %9s %10s %12s %8s  %s' %
+               ('Header', 'Includers', 'Rebuild', 'Cost', 'Changes', 'Flags'))
+        for entry in entries[:TOP]:
+            flags = []
+            if entry['pch']:
+                flags.append('pch')
+            if entry['split']:
+                flags.append('split')
+            if entry['cycle']:
+                flags.append('cycle')
+            print ('\t%-40s %9d %9.2fs%s %11.1f %8d  %s' %
+                   (entry['header'], entry['includers'], entry['rebuild_seconds'],
+                    '~' if entry['estimated'] else ' ', entry['cost'], entry['changes'],
+                    ','.join(flags)))
+
+    def print_report(self):
+        print ('\tBy rebuild fan-out x compile time:')
+        self.__print_rows(self.by_cost())
+        churn = self.by_churn()
+        if churn:
+            print ('\n\tBy change frequency (changes x rebuild time):')
+            self.__print_rows(churn)
+        print ('\n\tRebuild: compile time of all includers (~ some times estimated), Cost: includers x rebuild')
+        print ('\tpch: stable header included by most sources, good precompiled header candidate')
+        print ('\tsplit: widely included header that changes often or includes many headers')
+        for cycle in self.cycles:
+            print ('\tInclude cycle between: ' + ', '.join(cycle))
@@ -0,0 +1,453 @@
+from multiprocessing import Pool, cpu_count
+import amigo_config
+import atexit
+import mmap
+import os
+import re
+import shlex
+import stat_cache
+
+# Any preprocessor directive: name and the rest of the line
+DIRECTIVE_RE = re.compile(br'^[ \t]*#[ \t]*([A-Za-z_]+)[ \t]*(.*?)[ \t]*\r?$', re.M)
+INCLUDE_RE = re.compile(br'"([^"]+)"|<([^>]+)>')
+DEFINE_NAME_RE = re.compile(br'([A-Za-z_]\w*)')
+EXPR_TOKEN_RE = re.compile(r'\s*(0[xX][0-9a-fA-F]+|\d+|[A-Za-z_]\w*|&&|\|\||==|!=|<=|>=|<<|>>|[!~()<>+\-*/%&|^])')
+INT_SUFFIX_RE = re.compile(r'[uUlL]+$')
+COMMENT_RE = re.compile(r'/\*.*?\*/|//.*$')
+
+INCLUDE_DIRECTIVES = (b'include', b'import', b'include_next')
+
+# Files are scanned on a worker pool when at least this many are pending
+PARALLEL_THRESHOLD = 64
+
+_pool = None
+# (path, conditions key, head only) -> (mtime, includes)
+_cache = {}
+
+
+# Known state of preprocessor macros used to evaluate #if/#ifdef
+# Macros that are neither defined nor undefined are unknown, and branches
+# depending on them are followed, so dependencies are never missed
+class Conditions(object):
+    def __init__(self, defines=None, undefs=None):
+        self.defines = dict(defines or {})
+        self.undefs = set(undefs or [])
+
+    def key(self):
+        return (tuple(sorted(self.defines.items())), tuple(sorted(self.undefs)))
+
+    def copy(self):
+        return Conditions(self.defines, self.undefs)
+
+    # Forgets what is known about a macro
+    def forget(self, name):
+        self.defines.pop(name, None)
+        self.undefs.discard(name)
+
+    # Returns True/False if the macro is known to be defined or not, None otherwise
+    def is_defined(self, name):
+        if name in self.defines:
+            return True
+        if name in self.undefs:
+            return False
+        return None
+
+    # Returns the integer value of the macro or None if unknown
+    def value(self, name):
+        if name in self.undefs:
+            return 0
+        if name in self.defines:
+            return parse_int(self.defines[name])
+        return None
+
+    # Evaluates a #if expression, returns True/False or None if undecidable
+    def evaluate(self, expression):
+        expression = COMMENT_RE.sub(' ', expression)
+        tokens = []
+        pos = 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            match = EXPR_TOKEN_RE.match(expression, pos)
+            if not match:
+                return None
+            tokens.append(match.group(1))
+            pos = match.end()
+        try:
+            parser = _ExpressionParser(tokens, self)
+            result = parser.parse()
+        except (ValueError, IndexError, ZeroDivisionError):
+            return None
+        if result is None:
+            return None
+        return result != 0
+
+
+# Returns the Conditions described by the -D/-U options in the flag strings
+# A macro is only known if all flag strings agree on it (eg. CFLAGS and CXXFLAGS)
+def conditions_from_flags(*flag_strings):
+    known = None
+    for flags in flag_strings:
+        defines = {}
+        undefs = set()
+        try:
+            tokens = shlex.split(flags)
+        except ValueError:
+            tokens = flags.split()
+        index = 0
+        while index < len(tokens):
+            token = tokens[index]
+            if token in ('-D', '-U') and index + 1 < len(tokens):
+                index += 1
+                token = token + tokens[index]
+            if token.startswith('-D') and len(token) > 2:
+                name, _, value = token[2:].partition('=')
+                if '=' not in token:
+                    value = '1'
+                defines[name] = value
+                undefs.discard(name)
+            elif token.startswith('-U') and len(token) > 2:
+                defines.pop(token[2:], None)
+                undefs.add(token[2:])
+            index += 1
+        if known is None:
+            known = Conditions(defines, undefs)
+        else:
+            known = Conditions(dict(x for x in known.defines.items() if defines.get(x[0]) == x[1]),
+                               known.undefs & undefs)
+    return known or Conditions()
+
+
+def parse_int(value):
+    value = INT_SUFFIX_RE.sub('', value.strip())
+    try:
+        return int(value, 0)
+    except ValueError:
+        # Old style octal literals such as 010
+        try:
+            return int(value, 8)
+        except ValueError:
+            return None
+
+
+# Recursive descent parser for #if expressions with unknown (None) values
+class _ExpressionParser(object):
+    BINARY_LEVELS = [
+        ['|'], ['^'], ['&'], ['==', '!='], ['<', '>', '<=', '>='], ['<<', '>>'], ['+', '-'], ['*', '/', '%'],
+    ]
+
+    def __init__(self, tokens, conditions):
+        self.__tokens = tokens
+        self.__pos = 0
+        self.__conditions = conditions
+
+    def parse(self):
+        value = self.__or()
+        if self.__pos != len(self.__tokens):
+            raise ValueError('Unexpected token')
+        return value
+
+    def __peek(self):
+        if self.__pos < len(self.__tokens):
+            return self.__tokens[self.__pos]
+        return None
+
+    def __next(self):
+        token = self.__tokens[self.__pos]
+        self.__pos += 1
+        return token
+
+    def __or(self):
+        value = self.__and()
+        while self.__peek() == '||':
+            self.__next()
+            right = self.__and()
+            if value or right:
+                value = 1
+            elif value is None or right is None:
+                value = None
+            else:
+                value = 0
+        return value
+
+    def __and(self):
+        value = self.__binary(0)
+        while self.__peek() == '&&':
+            self.__next()
+            right = self.__binary(0)
+            if value == 0 or right == 0:
+                value = 0
+            elif value is None or right is None:
+                value = None
+            else:
+                value = 1
+        return value
+
+    def __binary(self, level):
+        if level == len(self.BINARY_LEVELS):
+            return self.__unary()
+        value = self.__binary(level + 1)
+        while self.__peek() in self.BINARY_LEVELS[level]:
+            op = self.__next()
+            right = self.__binary(level + 1)
+            if value is None or right is None:
+                value = None
+            else:
+                value = _apply(op, value, right)
+        return value
+
+    def __unary(self):
+        token = self.__peek()
+        if token in ('!', '-', '+', '~'):
+            self.__next()
+            value = self.__unary()
+            if value is None:
+                return None
+            return {'!': lambda x: int(not x), '-': lambda x: -x,
+                    '+': lambda x: x, '~': lambda x: ~x}[token](value)
+        return self.__primary()
+
+    def __primary(self):
+        token = self.__next()
+        if token == '(':
+            value = self.__or()
+            if self.__next() != ')':
+                raise ValueError('Expected )')
+            return value
+        if token == 'defined':
+            parens = self.__peek() == '('
+            if parens:
+                self.__next()
+            name = self.__next()
+            if parens and self.__next() != ')':
+                raise ValueError('Expected )')
+            defined = self.__conditions.is_defined(name)
+            if defined is None:
+                return None
+            return int(defined)
+        if token[0].isdigit():
+            value = parse_int(token)
+            if value is None:
+                raise ValueError('Bad number')
+            return value
+        if token[0].isalpha() or token[0] == '_':
+            if self.__peek() == '(':
+                # Function-like macro invocation
+                return None
+            return self.__conditions.value(token)
+        raise ValueError('Unexpected token')
+
+
+def _apply(op, left, right):
+    if op == '|':
+        return left | right
+    if op == '^':
+        return left ^ right
+    if op == '&':
+        return left & right
+    if op == '==':
+        return int(left == right)
+    if op == '!=':
+        return int(left != right)
+    if op == '<':
+        return int(left < right)
+    if op == '>':
+        return int(left > right)
+    if op == '<=':
+        return int(left <= right)
+    if op == '>=':
+        return int(left >= right)
+    if op == '<<':
+        return left << right
+    if op == '>>':
+        return left >> right
+    if op == '+':
+        return left + right
+    if op == '-':
+        return left - right
+    if op == '*':
+        return left * right
+    if op == '/':
+        return int(left / right)
+    return left % right
+
+
+# Returns the offset where the leading block of preprocessor directives,
+# comments and blank lines ends
+def head_length(data):
+    pos = 0
+    size = len(data)
+    while pos < size:
+        char = data[pos:pos + 1]
+        if char in (b' ', b'\t', b'\r', b'\n', b'\f', b'\v'):
+            pos += 1
+        elif data[pos:pos + 2] == b'/*':
+            end = data.find(b'*/', pos + 2)
+            if end < 0:
+                return size
+            pos = end + 2
+        elif data[pos:pos + 2] == b'//' or char == b'#':
+            # Line comment or directive, including continuation lines
+            while True:
+                end = data.find(b'\n', pos)
+                if end < 0:
+                    return size
+                line_end = end
+                if line_end > 0 and data[line_end - 1:line_end] == b'\r':
+                    line_end -= 1
+                pos = end + 1
+                if data[line_end - 1:line_end] != b'\\':
+                    break
+        else:
+            return pos
+    return size
+
+
+# Returns the list of includes of a file (in order) that may be active
+# under the given conditions
+def scan_file(file_path, conditions, head_only=False):
+    try:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return []
+    try:
+        end = head_length(data) if head_only else len(data)
+        return _scan_directives(data, end, conditions)
+    finally:
+        data.close()
+
+
+def _scan_directives(data, end, conditions):
+    includes = []
+    # Frames of (parent active, some branch definitely taken, all branches definitely not taken)
+    stack = []
+    active = True
+    local = conditions
+    for match in DIRECTIVE_RE.finditer(data, 0, end):
+        name = match.group(1)
+        rest = match.group(2)
+        if name in INCLUDE_DIRECTIVES:
+            if active:
+                include = INCLUDE_RE.search(rest)
+                if include:
+                    include = (include.group(1) or include.group(2)).strip()
+                    includes.append(include.decode('latin-1'))
+        elif name in (b'if', b'ifdef', b'ifndef'):
+            condition = False
+            if active:
+                condition = _evaluate(name, rest, local)
+            stack.append([active, condition is True, condition is False])
+            active = active and condition is not False
+        elif name == b'elif':
+            if not stack:
+                continue
+            frame = stack[-1]
+            if frame[1] or not frame[0]:
+                active = False
+                continue
+            condition = _evaluate(b'if', rest, local)
+            frame[1] = condition is True
+            frame[2] = frame[2] and condition is False
+            active = condition is not False
+        elif name == b'else':
+            if not stack:
+                continue
+            frame = stack[-1]
+            active = frame[0] and not frame[1]
+        elif name == b'endif':
+            if stack:
+                active = stack.pop()[0]
+        elif name in (b'define', b'undef') and active:
+            macro = DEFINE_NAME_RE.match(rest)
+            if macro:
+                if local is conditions:
+                    local = conditions.copy()
+                local.forget(macro.group(1).decode('latin-1'))
+    return includes
+
+
+def _evaluate(directive, rest, conditions):
+    text = rest.decode('latin-1')
+    if directive == b'if':
+        return conditions.evaluate(text)
+    macro = DEFINE_NAME_RE.match(rest)
+    if not macro:
+        return None
+    defined = conditions.is_defined(macro.group(1).decode('latin-1'))
+    if defined is None or directive == b'ifdef':
+        return defined
+    return not defined
+
+
+def _scan_job(args):
+    file_path, conditions, head_only = args
+    return scan_file(file_path, conditions, head_only)
+
+
+def _worker_pool():
+    global _pool
+    if _pool is None:
+        _pool = Pool(amigo_config.JOBS or cpu_count())
+        atexit.register(_close_pool)
+    return _pool
+
+
+def _close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+
+# Scans files for #include directives
+# Results are cached per file (until its mtime changes) and conditions
+class IncludeScanner(object):
+    def __init__(self, conditions=None, head_only=False):
+        self.__conditions = conditions or Conditions()
+        self.__head_only = head_only
+        self.__key = self.__conditions.key()
+        self.__results = {}
+
+    # Scans all the files, on a worker pool when there are enough of them
+    def scan_files(self, file_paths):
+        pending = []
+        for file_path in file_paths:
+            if self.__cached(file_path) is None:
+                pending.append(file_path)
+        if not pending:
+            return
+        if len(pending) >= PARALLEL_THRESHOLD and (amigo_config.JOBS or cpu_count()) > 1:
+            jobs = [(file_path, self.__conditions, self.__head_only) for file_path in pending]
+            results = _worker_pool().map(_scan_job, jobs, max(1, len(jobs) // (4 * cpu_count())))
+        else:
+            results = [scan_file(file_path, self.__conditions, self.__head_only) for file_path in pending]
+        for file_path, includes in zip(pending, results):
+            self.__store(file_path, includes)
+
+    # Returns the includes of a file
+    def includes(self, file_path):
+        includes = self.__cached(file_path)
+        if includes is None:
+            includes = scan_file(file_path, self.__conditions, self.__head_only)
+            self.__store(file_path, includes)
+        return includes
+
+    def __cached(self, file_path):
+        if file_path in self.__results:
+            return self.__results[file_path]
+        entry = _cache.get((file_path, self.__key, self.__head_only))
+        if entry is None:
+            return None
+        if stat_cache.mtime(file_path) != entry[0]:
+            return None
+        self.__results[file_path] = entry[1]
+        return entry[1]
+
+    def __store(self, file_path, includes):
+        self.__results[file_path] = includes
+        mtime = stat_cache.mtime(file_path)
+        if mtime is None:
+            return
+        _cache[(file_path, self.__key, self.__head_only)] = (mtime, includes)
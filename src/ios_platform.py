@@ -44,6 +44,17 @@ class IOSPlatform(Platform):
 
         self.__version = version
 
+    # ld64 does the LTO link itself
+    def lto_link_flags(self, cache_dir):
+        return ['-flto=thin', '-Wl,-cache_path_lto,' + cache_dir]
+
+    # Apple's ar indexes bitcode objects through libLTO
+    def lto_ar(self):
+        return self.flags('AR') or self.default_flags('AR')
+
+    def llvm_tool(self, name):
+        return 'xcrun ' + name
+
     def unique_name(self):
         return 'ios_' + super(IOSPlatform, self).unique_name() + '_' + self.arch()
 
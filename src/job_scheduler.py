@@ -0,0 +1,180 @@
+from multiprocessing import Pool, cpu_count
+from file_lock import write_json
+import amigo_config
+import json
+import launcher
+import os
+import signal
+import threading
+
+MB = 1024 * 1024
+# Pending jobs considered for admission past the first one that doesn't fit
+LOOKAHEAD = 64
+
+
+# Returns the memory available for new processes in bytes
+# (MemAvailable from /proc/meminfo) or None if unknown
+def mem_available():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+# Returns the 1 minute load average or None if unknown
+def load_average():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+# Returns the number of jobs to run when no limit was given
+def default_jobs(num_threads=None):
+    return num_threads or amigo_config.JOBS or cpu_count()
+
+
+# Returns the make arguments (-j and -l) for an external build
+# The number of jobs is capped by the available memory
+def make_job_args(num_threads=None):
+    jobs = default_jobs(num_threads)
+    available = mem_available()
+    if available is not None:
+        budget = available - amigo_config.MEM_RESERVE_MB * MB
+        jobs = max(1, min(jobs, int(budget // (amigo_config.JOB_MEMORY_MB * MB))))
+    args = ['-j' + str(jobs)]
+    if amigo_config.MAX_LOAD:
+        args.append('-l' + str(amigo_config.MAX_LOAD))
+    return args
+
+
+# Peak RSS of previous compiles, per source file
+class RssHistory(object):
+    def __init__(self, path):
+        self.__path = path
+        self.__peaks = {}
+        self.__changed = False
+        try:
+            with open(path) as f:
+                self.__peaks = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    # Returns the expected peak RSS of compiling the file in bytes
+    def estimate(self, file_path):
+        return self.__peaks.get(file_path, amigo_config.JOB_MEMORY_MB * MB)
+
+    def record(self, file_path, peak_rss):
+        if peak_rss and self.__peaks.get(file_path) != peak_rss:
+            self.__peaks[file_path] = peak_rss
+            self.__changed = True
+
+    def save(self):
+        if not self.__changed:
+            return
+        write_json(self.__path, self.__peaks)
+        self.__changed = False
+
+
+# Decides when a job may start, based on the memory the running jobs are
+# expected to use, the live available memory and the load average (like make -l)
+# A job is always admitted when nothing else is running
+class AdmissionController(object):
+    def __init__(self):
+        available = mem_available()
+        self.__budget = None
+        if available is not None:
+            self.__budget = available - amigo_config.MEM_RESERVE_MB * MB
+
+    def admit(self, estimate, running_estimates):
+        if not running_estimates:
+            return True
+        if amigo_config.MAX_LOAD:
+            load = load_average()
+            if load is not None and load >= amigo_config.MAX_LOAD:
+                return False
+        if self.__budget is not None:
+            if sum(running_estimates) + estimate > self.__budget:
+                return False
+            available = mem_available()
+            if available is not None and available - amigo_config.MEM_RESERVE_MB * MB < estimate:
+                return False
+        return True
+
+
+# Function run by the workers of a pool created with worker_pool
+_worker_func = None
+
+
+def _init_worker(func):
+    global _worker_func
+    _worker_func = func
+    signal.signal(signal.SIGTERM, _terminate_worker)
+
+
+# Pool.terminate() stops workers with SIGTERM, the job they run is stopped
+# with them
+def _terminate_worker(signum, frame):
+    launcher.terminate_running()
+    os._exit(1)
+
+
+def _call_worker(job):
+    return _worker_func(job)
+
+
+# Creates a pool whose workers run func for run_admitted
+# func is handed to each worker once instead of being pickled with every job
+def worker_pool(processes, func):
+    return Pool(processes, _init_worker, (func,))
+
+
+# Runs the pool's function over the jobs, starting a job only
+# when the admission controller allows it
+# estimate(job) gives the expected peak memory of a job
+# on_done(job, result) is called in this process for every finished job
+# should_stop() is checked after finished jobs, when it returns True the
+# pending jobs are dropped and the pool is terminated, killing running jobs
+# Returns the jobs killed while running
+# Up to 2 * max_jobs admitted jobs are queued on the pool (which runs
+# max_jobs at a time) so workers don't idle between jobs; queued jobs count
+# against the memory budget like running ones
+def run_admitted(pool, max_jobs, jobs, estimate, on_done, should_stop=None):
+    controller = AdmissionController()
+    finished = threading.Event()
+    pending = sorted(jobs, key=estimate, reverse=True)
+    running = {}
+    while pending or running:
+        for job in list(running):
+            result = running[job][0]
+            if result.ready():
+                del running[job]
+                on_done(job, result.get())
+        if should_stop and should_stop():
+            pool.terminate()
+            pool.join()
+            return list(running)
+        # Start the biggest jobs that fit, looking a bounded distance ahead
+        running_estimates = [x[1] for x in running.values()]
+        remaining = []
+        for index, job in enumerate(pending):
+            if len(running) >= 2 * max_jobs or len(remaining) >= LOOKAHEAD:
+                remaining += pending[index:]
+                break
+            job_estimate = estimate(job)
+            if controller.admit(job_estimate, running_estimates):
+                result = pool.apply_async(_call_worker, (job,), callback=lambda _: finished.set())
+                running[job] = (result, job_estimate)
+                running_estimates.append(job_estimate)
+            else:
+                remaining.append(job)
+        pending = remaining
+        if running:
+            # Wake up on completion, or periodically to recheck memory and load
+            finished.wait(0.5)
+            finished.clear()
+    return []
@@ -0,0 +1,189 @@
+from subprocess import Popen, PIPE, STDOUT
+import os
+import re
+import shlex
+import signal
+import sys
+import tempfile
+import time
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# Arguments longer than this (in characters) are passed in an @response file
+RESPONSE_FILE_THRESHOLD = 128 * 1024
+# Runs of /bin/sh timed to estimate its startup cost
+SHELL_SAMPLES = 5
+
+# Processes started in this process (jobs run in worker processes are added
+# with add_launches)
+_launches = 0
+# Seconds /bin/sh takes to start and exit, measured on first use
+_shell_overhead = None
+# Process run is waiting for, killed by terminate_running
+_running = None
+# Popen arguments starting a process in its own process group
+if sys.version_info[0] >= 3:
+    _NEW_GROUP = {'start_new_session': True}
+else:
+    _NEW_GROUP = {'preexec_fn': getattr(os, 'setpgrp', None)}
+
+
+# Result of a command: exit status, combined stdout and stderr (bytes),
+# peak RSS in bytes (None if unknown) and wall time in seconds
+class Result(object):
+    def __init__(self, status, output, peak_rss, seconds):
+        self.status = status
+        self.output = output
+        self.peak_rss = peak_rss
+        self.seconds = seconds
+
+
+# Splits a command line (eg. a compiler with flags) into an argv list, with
+# the same quoting rules the shell applied to the command strings
+def split(command):
+    return shlex.split(command)
+
+
+# Returns a shell command line running argv, for logs, ninja files and
+# compilation databases
+def command_line(argv):
+    return ' '.join(quote(arg) for arg in argv)
+
+
+def _response_quote(arg):
+    if arg and not re.search(r'[\s"\'\\]', arg):
+        return arg
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+# Moves the arguments after the tool (the words before the first option,
+# eg. 'xcrun clang' or 'ccache gcc') into a response file
+# Returns (argv, response file path)
+def _with_response_file(argv):
+    tool = 1
+    while tool < len(argv) and not argv[tool].startswith('-'):
+        tool += 1
+    if tool >= len(argv) - 1:
+        tool = 1
+    fd, path = tempfile.mkstemp(prefix='amigomake-', suffix='.rsp')
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(_response_quote(arg) for arg in argv[tool:]))
+    return argv[:tool] + ['@' + path], path
+
+
+def _exit_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+# Waits for a process, returns (status, peak RSS in bytes of the process
+# and the processes it waited for, or None if unknown)
+def _wait(process):
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    while True:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != 4:  # EINTR
+                raise
+    # Popen would otherwise try to reap the already waited-for process
+    process.returncode = _exit_status(status)
+    peak_rss = usage.ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return process.returncode, peak_rss
+
+
+# Runs argv without a shell and captures its output
+# Long argument lists are passed in a response file
+# The process runs in its own process group, so terminating it also stops
+# the processes it started (eg. cc1 and as started by gcc)
+def run(argv, env=None, cwd=None):
+    global _launches
+    global _running
+    start_time = time.time()
+    response_file = None
+    if sum(len(arg) + 1 for arg in argv) > RESPONSE_FILE_THRESHOLD:
+        argv, response_file = _with_response_file(argv)
+    try:
+        try:
+            process = Popen(argv, env=env, cwd=cwd, stdout=PIPE, stderr=STDOUT, **_NEW_GROUP)
+        except OSError as e:
+            message = argv[0] + ': ' + str(e) + '\n'
+            return Result(127, message.encode('utf-8'), None, time.time() - start_time)
+        _launches += 1
+        _running = process
+        output = process.stdout.read()
+        process.stdout.close()
+        status, peak_rss = _wait(process)
+    except BaseException:
+        # eg. KeyboardInterrupt, the process group doesn't get the terminal's
+        # signals
+        terminate_running()
+        raise
+    finally:
+        _running = None
+        if response_file:
+            os.remove(response_file)
+    return Result(status, output, peak_rss, time.time() - start_time)
+
+
+# Terminates the process run is waiting for and the processes it started,
+# eg. when a worker running jobs is cancelled
+def terminate_running():
+    if _running is not None and _running.returncode is None:
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(_running.pid, signal.SIGTERM)
+            else:
+                _running.terminate()
+        except OSError:
+            pass
+
+
+# Writes text (if any) and a job's captured output to stdout in one write,
+# so the output of parallel jobs doesn't interleave
+def print_output(text, output=b''):
+    data = b''
+    if text:
+        data = text.encode('utf-8') + b'\n'
+    if output:
+        data += output
+        if not output.endswith(b'\n'):
+            data += b'\n'
+    sys.stdout.flush()
+    fd = sys.stdout.fileno()
+    while data:
+        data = data[os.write(fd, data):]
+
+
+# Counts jobs launched by worker processes
+def add_launches(count):
+    global _launches
+    _launches += count
+
+
+def launches():
+    return _launches
+
+
+# Returns the seconds starting a command through /bin/sh adds
+def shell_overhead():
+    global _shell_overhead
+    if _shell_overhead is None:
+        start_time = time.time()
+        for _ in range(SHELL_SAMPLES):
+            Popen(['/bin/sh', '-c', 'exit 0']).wait()
+        _shell_overhead = (time.time() - start_time) / SHELL_SAMPLES
+    return _shell_overhead
+
+
+# Describes the shell startup time saved by launching jobs directly
+def report(count):
+    return ('%d jobs launched without a shell, ~%.3fs of shell startup saved' %
+            (count, count * shell_overhead()))
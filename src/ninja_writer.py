@@ -0,0 +1,118 @@
+import amigo_config
+import json
+import os
+
+
+# Escapes a string for use in a ninja variable or command
+def escape(value):
+    return value.replace('$', '$$')
+
+
+# Escapes a path for use in a ninja build statement
+def escape_path(path):
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
+# Minimal writer for the ninja build file syntax
+class NinjaWriter(object):
+    def __init__(self, output):
+        self.__output = output
+
+    def newline(self):
+        self.__output.write('\n')
+
+    def comment(self, text):
+        for line in text.splitlines():
+            self.__output.write('# ' + line + '\n')
+
+    def variable(self, key, value, indent=0):
+        if value is None:
+            return
+        if isinstance(value, (list, tuple)):
+            value = ' '.join(v for v in value if v)
+        self.__output.write('  ' * indent + key + ' = ' + value + '\n')
+
+    def rule(self, name, command, description=None, depfile=None, deps=None,
+             generator=False, restat=False, rspfile=None, rspfile_content=None):
+        self.__output.write('rule ' + name + '\n')
+        self.variable('command', command, 1)
+        self.variable('description', description, 1)
+        self.variable('depfile', depfile, 1)
+        self.variable('deps', deps, 1)
+        self.variable('rspfile', rspfile, 1)
+        self.variable('rspfile_content', rspfile_content, 1)
+        if generator:
+            self.variable('generator', '1', 1)
+        if restat:
+            self.variable('restat', '1', 1)
+
+    # Writes a build statement
+    # Optional: implicit inputs (|), order-only inputs (||) and edge variables
+    def build(self, outputs, rule, inputs=None, implicit=None, order_only=None, variables=None):
+        outputs = [escape_path(x) for x in as_list(outputs)]
+        line = 'build ' + ' '.join(outputs) + ': ' + rule
+        for paths, separator in ((inputs, None), (implicit, '|'), (order_only, '||')):
+            paths = [escape_path(x) for x in as_list(paths)]
+            if paths:
+                if separator:
+                    line += ' ' + separator
+                line += ' ' + ' '.join(paths)
+        self.__output.write(line + '\n')
+        if variables:
+            for key in sorted(variables):
+                self.variable(key, variables[key], 1)
+
+    def default(self, paths):
+        self.__output.write('default ' + ' '.join(escape_path(x) for x in as_list(paths)) + '\n')
+
+    def close(self):
+        self.__output.close()
+
+
+# Generation state shared by all packages written to one build.ninja
+class NinjaContext(object):
+    def __init__(self, writer, directory):
+        self.writer = writer
+        self.directory = os.path.abspath(directory)
+        self.compile_commands = []
+        self.outputs = {}
+
+
+def as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+# Writes a ninja file building the packages (and their dependencies) for the
+# platform, plus a compile_commands.json with every compile command
+# Packages provide the build statements through _write_ninja
+def generate(packages, platform, ninja_path='build.ninja', compdb_path='compile_commands.json'):
+    ninja_file = open(ninja_path, 'w')
+    context = NinjaContext(NinjaWriter(ninja_file), os.getcwd())
+    writer = context.writer
+    writer.comment('Generated by amigomake for ' + platform.unique_name() + ', do not edit')
+    writer.newline()
+    writer.rule('cc', '$cmd -MD -MF $out.d', description='$desc', depfile='$out.d', deps='gcc')
+    writer.rule('link', '$cmd', description='$desc')
+    writer.rule('copy', 'cp $in $out', description='COPY $in')
+    if amigo_config.COMMAND and amigo_config.MAKEFILE:
+        writer.rule('regen', escape(amigo_config.COMMAND), description='Regenerating ' + ninja_path,
+                    generator=True)
+        writer.build(ninja_path, 'regen', implicit=[amigo_config.MAKEFILE])
+    writer.newline()
+
+    outputs = []
+    for package in packages:
+        outputs += package._write_ninja(platform, context)
+    writer.newline()
+    writer.build('all', 'phony', outputs)
+    writer.default('all')
+    writer.close()
+
+    if compdb_path:
+        with open(compdb_path, 'w') as f:
+            json.dump(context.compile_commands, f, indent=2)
+    return outputs
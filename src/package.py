@@ -1,3 +1,6 @@
+import build_history
+import file_collector
+import stat_cache
 import os
 
 
@@ -9,6 +12,7 @@ class Package(object):
         self.__files = set()
         self.__deps = []
         self.__src_exts = src_exts
+        self.__ignore_patterns = []
         self._package_dir = os.path.relpath(directory)
         self._install_dirs = {}
         self._cwd = os.getcwd()
@@ -35,28 +39,42 @@ class Package(object):
     # Sets the installation directory for the specified platform
     def set_install_dir(self, platform, install_dir):
         self._install_dirs[platform] = os.path.abspath(install_dir)
+        file_collector.add_install_dir(install_dir)
 
     # Returns the installation directory for the specified platform
     def install_dir(self, platform):
         if platform not in self._install_dirs:
-            self.set_install_dir(platform, os.path.join(self._package_dir, 'build/'+platform.unique_name()))
+            self.set_install_dir(platform, os.path.join(self._package_dir, 'build/'+self._build_dir_name(platform)))
         return self._install_dirs[platform]
 
+    # Name of the default install dir under <package dir>/build
+    # Inherited classes can add to it for builds that mustn't share outputs
+    def _build_dir_name(self, platform):
+        return platform.build_name()
+
+    # Sets glob patterns of paths skipped when collecting files, relative to
+    # the package dir (see file_collector, also read from .amigoignore)
+    def ignore_paths(self, patterns):
+        self.__ignore_patterns = patterns
+
     # Collect files in the package dir that match the source extensions
+    # Build outputs and ignored paths are skipped
     def _collect_files(self):
         if self._package_dir is not None:
-            for (dirpath, dirnames, filenames) in os.walk(self._package_dir):
-                for filename in filenames:
-                    if check_extensions(filename, self.__src_exts):
-                        self.__files.add(os.path.join(dirpath, filename))
+            is_src = lambda filename: check_extensions(filename, self.__src_exts)
+            self.__files.update(file_collector.collect(self._package_dir, is_src, self.__ignore_patterns))
 
     # Builds the package for a specified by calling:
     # _pre_build, _build, _post_build
     # Optional: additional environment variables
+    # File metadata is cached for the duration of the build (see stat_cache)
+    # and the platform flags it sets are dropped afterwards
     def build(self, platform, env_vars=None):
-        self._pre_build(platform, env_vars)
-        self._build(platform, env_vars)
-        self._post_build(platform, env_vars)
+        with stat_cache.scope(), build_history.timed(self, platform), platform.flag_scope():
+            with build_history.phase(self, 'collect'):
+                self._pre_build(platform, env_vars)
+            self._build(platform, env_vars)
+            self._post_build(platform, env_vars)
 
     # Adds a dependency on another package
     def add_dep(self, dep):
@@ -102,12 +120,12 @@ def check_extensions(filename, extensions):
 
 # Checks whether the file is older than the all files in the provided list 
 def older(file_path, files_to_check):
-    if not os.path.isfile(file_path):
+    file_mtime = stat_cache.mtime(file_path)
+    if file_mtime is None:
         return True
     for file_to_check in files_to_check:
-        if not os.path.isfile(file_to_check):
-            return True
-        if os.path.getmtime(file_path) <= os.path.getmtime(file_to_check):
+        check_mtime = stat_cache.mtime(file_to_check)
+        if check_mtime is None or file_mtime <= check_mtime:
             return True
     return False
 
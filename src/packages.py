@@ -4,10 +4,14 @@ from android_platform import AndroidPlatform
 from ios_platform import IOSPlatform
 from external_cpackage import ExternalCPackage
 from cpackage import CPackage
-from subprocess import call
-from multiprocessing import cpu_count
+from file_lock import FileLock
+from package import error_str
+from subprocess import call, Popen, PIPE, STDOUT
+import amigo_config
+import hashlib
 import os
 import shutil
+import sys
 
 
 def _patch_libtool(module):
@@ -27,10 +31,10 @@ class Proj4(ExternalCPackage):
         self.set_zip_name("proj-" + version + ".tar.gz")
         self.set_url("http://download.osgeo.org/proj/" + self.zip_name())
 
-    def _build(self, platform, env_vars=None, configure=""):
+    def _build_options(self, platform, env_vars, configure):
         configure = "./configure " + (platform.default_flags(platform.CONFIG_FLAGS) +
                                       " --without-jni")
-        super(Proj4, self)._build(platform, env_vars, configure)
+        return env_vars, configure
 
 class Png(ExternalCPackage):
     def __init__(self, version, rootdir):
@@ -47,11 +51,15 @@ class GMock(ExternalCPackage):
         self.__package_dir = os.path.join(rootdir, 'gmock-'+version)
 
 
-    def _build(self, platform, env_vars=None, configure=""):
-        self.exclude_sources(['gtest/', 'test/', 'fused-src/'])
+    def _build_options(self, platform, env_vars, configure):
         env_vars['CFLAGS'] = (platform.default_flags('CFLAGS') + ' -I' + self.__package_dir)
         env_vars['CXXFLAGS'] = (platform.default_flags('CXXFLAGS') + ' -I' + self.__package_dir)
         env_vars['CPPFLAGS'] = (platform.default_flags('CPPFLAGS') + ' -I' + self.__package_dir)
+        return env_vars, configure
+
+    def _build(self, platform, env_vars=None, configure=""):
+        self.exclude_sources(['gtest/', 'test/', 'fused-src/'])
+        env_vars, configure = self._build_options(platform, dict(env_vars or self._env_vars), configure)
         self.set_package_dir(self.__package_dir)
         super(ExternalCPackage, self)._pre_build(platform, env_vars)
         super(ExternalCPackage, self)._build(platform, env_vars)
@@ -84,10 +92,10 @@ class Freetype(ExternalCPackage):
         self.set_zip_name("freetype-" + version + ".tar.gz")
         self.set_url("http://download.savannah.gnu.org/releases/freetype/" + self.zip_name())
 
-    def _build(self, platform, env_vars=None, configure=""):
+    def _build_options(self, platform, env_vars, configure):
         if isinstance(platform, IOSPlatform) and platform.arch() == 'i386':
             configure = "./configure --build=x86 " + platform.default_flags(Platform.CONFIG_FLAGS)
-        super(Freetype, self)._build(platform, env_vars, configure)
+        return env_vars, configure
 
     def _post_build(self, platform, env_vars=None):
         install_dir = os.path.abspath(self.install_dir(platform))
@@ -110,8 +118,12 @@ class Minizip(ExternalCPackage):
     def _download_and_unzip(self, install_dir, unzip_path=None, retries=3):
         super(Minizip, self)._download_and_unzip(install_dir, self.__package_dir, retries)
 
-    def _build(self, platform, env_vars=None, configure=""):
+    def _build_options(self, platform, env_vars, configure):
         env_vars['CFLAGS'] = platform.default_flags('CFLAGS') + " -DUSE_FILE32API"
+        return env_vars, configure
+
+    def _build(self, platform, env_vars=None, configure=""):
+        env_vars, configure = self._build_options(platform, dict(env_vars or self._env_vars), configure)
         self.set_package_dir(self.__package_dir)
         super(ExternalCPackage, self)._pre_build(platform, env_vars)
         super(ExternalCPackage, self)._build(platform, env_vars)
@@ -124,27 +136,22 @@ class Bzip(ExternalCPackage):
         self.set_zip_name("bzip2-" + version + ".tar.gz")
         self.set_url("http://bzip.org/" + version + "/" + self.zip_name())
 
-    def _build(self, platform, env_vars=None, configure=""):
-        if not env_vars:
-            env_vars = self._env_vars
+    def _build_options(self, platform, env_vars, configure):
         env_vars['CFLAGS'] = platform.default_flags('CFLAGS') + " -D_FILE_OFFSET_BITS=64"
         env_vars['CXXFLAGS'] = platform.default_flags('CXXFLAGS') + " -D_FILE_OFFSET_BITS=64"
-        super(Bzip, self)._build(platform, env_vars, configure=None)
+        return env_vars, None
 
     def _make(self, platform, install_dir):
         cflags = "CFLAGS=" + platform.flags('CFLAGS')
         prefix = "PREFIX=" + install_dir
-        if self._num_threads:
-            mt = '-j' + str(self._num_threads)
-        else:
-            mt = '-j' + str(cpu_count())
+        mt = self._make_jobs()
         if isinstance(platform, AndroidPlatform):
             cc = "CC=" + platform.flags('CC')
             ar = "AR=" + platform.flags('AR')
             ranlib = "RANLIB=" + platform.flags('RANLIB')
-            call(["make", mt, cc, ar, ranlib, cflags], env=platform.var_env())
+            call(["make"] + mt + [cc, ar, ranlib, cflags], env=platform.var_env())
         else:
-            call(["make", mt, cflags], env=platform.var_env())
+            call(["make"] + mt + [cflags], env=platform.var_env())
         call(["make", "install", prefix], env=platform.var_env())
 
 
@@ -154,10 +161,8 @@ class OpenSSL(ExternalCPackage):
         self.set_zip_name("openssl-" + version + ".tar.gz")
         self.set_url("http://www.openssl.org/source/" + self.zip_name())
 
-    def _build(self, platform, env_vars=None, configure=""):
+    def _build_options(self, platform, env_vars, configure):
         install_dir = os.path.abspath(self.install_dir(platform))
-        if not env_vars:
-            env_vars = self._env_vars
         if isinstance(platform, AndroidPlatform):
             env_vars['LDFLAGS'] = (platform.default_flags('LDFLAGS') +
                                    " -dynamiclib -nostdlib -lc -lgcc")
@@ -174,14 +179,11 @@ class OpenSSL(ExternalCPackage):
                          " --openssldir=" + install_dir)
         else:
             configure = ("./config no-asm no-krb5 no-gost zlib --openssldir=" + install_dir)
-        super(OpenSSL, self)._build(platform, env_vars, configure)
+        return env_vars, configure
 
     def _make(self, platform, install_dir):
         env_vars = platform.var_env()
-        if self._num_threads:
-            mt = '-j' + str(self._num_threads)
-        else:
-            mt = '-j' + str(cpu_count())
+        mt = self._make_jobs()
         if isinstance(platform, AndroidPlatform):
             shutil.move("Makefile", "Makefile~")
             call(['sed "s/\.so\.\$(SHLIB_MAJOR).\$(SHLIB_MINOR)/\.so/" Makefile~ > Makefile~1'],
@@ -190,7 +192,7 @@ class OpenSSL(ExternalCPackage):
         cc = "CC=" + env_vars['CC']
         cflags = "CFLAG=" + env_vars['CFLAGS']
         ldflags = "SHARED_LDFLAGS=" + env_vars['LDFLAGS']
-        call(["make", mt, cc, cflags, ldflags], env=env_vars)
+        call(["make"] + mt + [cc, cflags, ldflags], env=env_vars)
         call(["make", "install_sw"], env=env_vars)
 
 
@@ -200,10 +202,8 @@ class Curl(ExternalCPackage):
         self.set_zip_name("curl-" + version + ".tar.gz")
         self.set_url("http://curl.haxx.se/download/" + self.zip_name())
 
-    def _build(self, platform, env_vars=None, configure=""):
+    def _build_options(self, platform, env_vars, configure):
         configure = "./configure " + platform.default_flags(Platform.CONFIG_FLAGS)
-        if not env_vars:
-            env_vars = self._env_vars
         install_dir = os.path.abspath(self.install_dir(platform))
         env_vars['LDFLAGS'] = platform.default_flags('LDFLAGS')
         if isinstance(platform, AndroidPlatform):
@@ -225,22 +225,18 @@ class Curl(ExternalCPackage):
             if dep_dir is not None:
                 if isinstance(dep, OpenSSL):
                     configure += " --with-ssl=" + dep_dir
-
-        super(Curl, self)._build(platform, env_vars, configure)
+        return env_vars, configure
 
     def _make(self, platform, install_dir):
         self.__patch(platform)
-        if self._num_threads:
-            mt = '-j' + str(self._num_threads)
-        else:
-            mt = '-j' + str(cpu_count())
+        mt = self._make_jobs()
         cflags = "CFLAG=" + platform.flags('CFLAGSx')
         ldflags = "SHARED_LDFLAGS=" + platform.flags('LDFLAGS')
         os.chdir(os.path.join(self.local_path(), "lib"))
-        call(["make", mt, cflags, ldflags], env=platform.var_env())
+        call(["make"] + mt + [cflags, ldflags], env=platform.var_env())
         call(["make", "install"], env=platform.var_env())
         os.chdir(os.path.join(self.local_path(), "include"))
-        call(["make", mt, cflags, ldflags], env=platform.var_env())
+        call(["make"] + mt + [cflags, ldflags], env=platform.var_env())
         call(["make", "install"], env=platform.var_env())
 
     def __patch(self, platform):
@@ -257,24 +253,61 @@ class Icu(ExternalCPackage):
         self.set_zip_name("icu4c-" + version.replace(".", "_") + "-src.tgz")
         self.set_url("http://download.icu-project.org/files/icu4c/" + version + "/" + self.zip_name())
 
+    # Returns the host build the cross builds use, built once in
+    # .amigomake/host-tools for all archs and later runs
+    # The build is keyed by the ICU version, the host compilers and the
+    # patches, it has its own copy of the source and is complete once its
+    # stamp is written
     def __cross_build(self, platform):
-        rootdir = self.rootdir()
-        hostbuild = rootdir + "/icu/hostbuild"
-        if not os.path.exists(hostbuild):
-            os.makedirs(hostbuild)
-        os.chdir(hostbuild)
-        if self._num_threads:
-            mt = '-j' + str(self._num_threads)
-        else:
-            mt = '-j' + str(cpu_count())
-        call(["../source/configure --prefix=" + hostbuild], shell=True)
-        call(["make", mt])
+        state_dir = amigo_config.STATE_DIR or os.path.abspath('.amigomake')
+        cache_dir = os.path.join(state_dir, 'host-tools', 'icu-' + self.version() + '-' + self.__host_key())
+        hostbuild = os.path.join(cache_dir, 'hostbuild')
+        stamp = os.path.join(cache_dir, 'complete')
+        with FileLock(cache_dir + '.lock'):
+            if not os.path.exists(stamp):
+                print (('\t%-15s\t' % (self.name() + ':')) + 'Building host tools in ' + cache_dir)
+                if os.path.exists(cache_dir):
+                    shutil.rmtree(cache_dir)
+                shutil.copytree(os.path.join(self.local_path(), "source"), os.path.join(cache_dir, "source"))
+                os.makedirs(hostbuild)
+                os.chdir(hostbuild)
+                mt = self._make_jobs()
+                if (call(["../source/configure --prefix=" + hostbuild], shell=True) != 0 or
+                        call(["make"] + mt) != 0):
+                    print (('\t%-15s\t' % (self.name() + ':')) + error_str('ERROR') +
+                           ': Host tools build failed!')
+                    sys.exit(1)
+                open(stamp, 'w').close()
+            elif amigo_config.VERBOSE:
+                print (('\t%-15s\t' % (self.name() + ':')) + 'Using host tools in ' + cache_dir)
         self.set_local_path(os.path.join(self.local_path(), "source"))
         os.chdir(self.local_path())
         self.apply_patches()
         self._post_build(platform)
         return hostbuild
 
+    # Hash of what the host build depends on besides the version
+    def __host_key(self):
+        md5 = hashlib.md5()
+        for compiler in (os.environ.get('CC', 'cc'), os.environ.get('CXX', 'c++')):
+            md5.update(compiler.encode('utf-8'))
+            try:
+                process = Popen(compiler + ' --version', shell=True, stdout=PIPE, stderr=STDOUT)
+                md5.update(process.communicate()[0])
+            except OSError:
+                pass
+        for patch_file in self.patches():
+            with open(patch_file, 'rb') as f:
+                md5.update(f.read())
+        return md5.hexdigest()[:12]
+
+    # Cross builds also depend on the host tools
+    def _cache_strings(self, platform, env_vars, configure):
+        strings = super(Icu, self)._cache_strings(platform, env_vars, configure)
+        if isinstance(platform, (AndroidPlatform, IOSPlatform)):
+            strings.append(self.__host_key())
+        return strings
+
     def _build_ios(self, platform, env_vars):
         hostbuild = self.__cross_build(platform)
         inc_common = os.path.join(self.local_path(), "common")
@@ -0,0 +1,180 @@
+from array import array
+
+
+# Yields the indexes of the bits set in an int bitset, lowest first
+def bit_indexes(bitset):
+    digits = bin(bitset)[:1:-1]
+    index = digits.find('1')
+    while index >= 0:
+        yield index
+        index = digits.find('1', index + 1)
+
+
+# Directed graph of file paths (eg. sources and the headers they #include)
+# Paths are interned to integer ids, the direct edges of a node are kept in
+# an array of ids and the nodes reachable from a node (its transitive
+# closure) are computed lazily as an int bitset, bit i standing for node i
+# Edges can carry labels (eg. the #include name that resolved to a header)
+class PathGraph(object):
+    def __init__(self):
+        self.__ids = {}
+        self.__paths = []
+        self.__edges = []
+        self.__expanded = []
+        self.__label_ids = {}
+        self.__labels = []
+        self.__node_labels = []
+        self.__roots = set()
+        # Node id -> bitset of the nodes reachable from it
+        self.__closures = {}
+        # Node id -> frozenset of the labels reachable from it
+        self.__label_closures = {}
+        # Node id -> array of the roots it is reachable from
+        self.__reverse = None
+
+    # Returns the id of a path, adding a node for it if needed
+    def intern(self, path):
+        node = self.__ids.get(path)
+        if node is None:
+            node = len(self.__paths)
+            self.__ids[path] = node
+            self.__paths.append(path)
+            self.__edges.append(array('i'))
+            self.__expanded.append(False)
+            self.__node_labels.append(array('i'))
+        return node
+
+    def __label(self, label):
+        label_id = self.__label_ids.get(label)
+        if label_id is None:
+            label_id = len(self.__labels)
+            self.__label_ids[label] = label_id
+            self.__labels.append(label)
+        return label_id
+
+    def __contains__(self, path):
+        return path in self.__ids
+
+    def __invalidate(self):
+        self.__closures = {}
+        self.__label_closures = {}
+        self.__reverse = None
+
+    # Marks the path as a root, ie. a node reverse lookups report
+    def add_root(self, path):
+        self.__roots.add(self.intern(path))
+        self.__reverse = None
+
+    # Sets the direct edges of a path and the labels of those edges
+    def set_edges(self, path, targets, labels=()):
+        node = self.intern(path)
+        edges = array('i')
+        seen = set()
+        for target in targets:
+            target_node = self.intern(target)
+            if target_node not in seen:
+                seen.add(target_node)
+                edges.append(target_node)
+        self.__edges[node] = edges
+        self.__node_labels[node] = array('i', sorted(set(self.__label(label) for label in labels)))
+        self.__expanded[node] = True
+        self.__invalidate()
+
+    # Whether set_edges was called for the path
+    def is_expanded(self, path):
+        node = self.__ids.get(path)
+        return node is not None and self.__expanded[node]
+
+    # Yields (path, direct targets) of the nodes whose edges were set
+    def edges(self):
+        for node, path in enumerate(self.__paths):
+            if self.__expanded[node]:
+                yield path, [self.__paths[target] for target in self.__edges[node]]
+
+    # Returns the bitset of the nodes reachable from a node
+    # Strongly connected components are found with Tarjan's algorithm, every
+    # component gets its closure once all the components it reaches have theirs
+    def __closure(self, node):
+        if node in self.__closures:
+            return self.__closures[node]
+        index = {node: 0}
+        low = {node: 0}
+        stack = [node]
+        on_stack = set(stack)
+        work = [[node, 0]]
+        while work:
+            frame = work[-1]
+            current = frame[0]
+            edges = self.__edges[current]
+            if frame[1] < len(edges):
+                child = edges[frame[1]]
+                frame[1] += 1
+                if child in self.__closures:
+                    continue
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append([child, 0])
+                elif child in on_stack:
+                    low[current] = min(low[current], index[child])
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[current])
+            if low[current] != index[current]:
+                continue
+            members = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                members.append(member)
+                if member == current:
+                    break
+            closure = 0
+            for member in members:
+                for child in self.__edges[member]:
+                    closure |= 1 << child
+                    # Children in other components are done already
+                    closure |= self.__closures.get(child, 0)
+            for member in members:
+                self.__closures[member] = closure
+        return self.__closures[node]
+
+    # Whether any node is reachable from the path
+    def has_reachable(self, path):
+        node = self.__ids.get(path)
+        return node is not None and self.__closure(node) != 0
+
+    # Returns the paths reachable from the path, in interning order
+    def reachable(self, path):
+        node = self.__ids.get(path)
+        if node is None:
+            return []
+        return [self.__paths[reached] for reached in bit_indexes(self.__closure(node))]
+
+    # Returns the labels of the edges reachable from the path
+    def reachable_labels(self, path):
+        node = self.__ids.get(path)
+        if node is None:
+            return frozenset()
+        if node not in self.__label_closures:
+            label_ids = set(self.__node_labels[node])
+            for reached in bit_indexes(self.__closure(node)):
+                label_ids.update(self.__node_labels[reached])
+            self.__label_closures[node] = frozenset(self.__labels[label_id] for label_id in label_ids)
+        return self.__label_closures[node]
+
+    # Returns {path: set of the roots it is reachable from} for every
+    # path reachable from a root
+    def reverse_closure(self):
+        if self.__reverse is None:
+            self.__reverse = {}
+            for root in sorted(self.__roots):
+                for reached in bit_indexes(self.__closure(root)):
+                    if reached not in self.__reverse:
+                        self.__reverse[reached] = array('i')
+                    self.__reverse[reached].append(root)
+        return dict((self.__paths[node], set(self.__paths[root] for root in roots))
+                    for node, roots in self.__reverse.items())
@@ -0,0 +1,195 @@
+from subprocess import Popen, PIPE
+from file_lock import write_json
+import amigo_config
+import glob
+import hashlib
+import json
+import os
+import shutil
+import stat_cache
+
+# Builds collecting profiles with instrumented code
+INSTRUMENT = 'instrument'
+# Builds optimized with the collected profiles
+OPTIMIZE = 'optimize'
+# Actions -> PGO mode of the packages they build
+# train runs the executables of the instrumented build
+ACTION_MODES = {
+    'pgo-instrument': INSTRUMENT,
+    'train': INSTRUMENT,
+    'pgo-optimize': OPTIMIZE,
+}
+# Merged clang profile
+PROFDATA = 'default.profdata'
+
+# Platform build name -> Profiles
+_profiles = {}
+
+
+# Returns the directory holding the profiles of a platform
+def profile_dir(platform):
+    state_dir = amigo_config.STATE_DIR or os.path.abspath('.amigomake')
+    return os.path.join(state_dir, 'pgo', platform.build_name())
+
+
+# Raw profiles written by the instrumented executables (.profraw with
+# clang, .gcda named after the objects with gcc)
+def raw_dir(platform):
+    return os.path.join(profile_dir(platform), 'raw')
+
+
+# Removes the raw profiles, eg. before training a new instrumented build
+def reset(platform):
+    path = raw_dir(platform)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+
+# Merges the raw clang profiles into default.profdata
+# Returns whether there is profile data to optimize with
+def merge(platform):
+    path = raw_dir(platform)
+    if amigo_config.GCC:
+        return bool(glob.glob(os.path.join(path, '*.gcda')))
+    raw_files = sorted(glob.glob(os.path.join(path, '*.profraw')))
+    if not raw_files:
+        return False
+    call_str = (platform.llvm_tool('llvm-profdata') + ' merge -o ' +
+                os.path.join(profile_dir(platform), PROFDATA) + ' ' + ' '.join(raw_files))
+    if amigo_config.VERBOSE:
+        print (call_str)
+    process = Popen(call_str, shell=True, env=platform.var_env())
+    return process.wait() == 0
+
+
+# Flags compiling an object of a package installed in install_dir
+# gcc names the .gcda files after the object path relative to install_dir,
+# so both builds find the same profile (object paths must be relative)
+def compile_flags(platform, mode, install_dir):
+    path = raw_dir(platform)
+    if amigo_config.GCC:
+        prefix = ['-fprofile-prefix-path=' + os.path.abspath(install_dir) + '/']
+        if mode == INSTRUMENT:
+            return ['-fprofile-generate=' + path] + prefix
+        return ['-fprofile-use=' + path] + prefix + ['-fprofile-partial-training', '-Wno-missing-profile']
+    if mode == INSTRUMENT:
+        return ['-fprofile-generate=' + path]
+    return ['-fprofile-use=' + os.path.join(profile_dir(platform), PROFDATA),
+            '-Wno-profile-instr-unprofiled', '-Wno-profile-instr-out-of-date']
+
+
+# Flags linking shared libs and executables, instrumented code needs the
+# profiling runtime
+def link_flags(mode):
+    if mode == INSTRUMENT:
+        return ['-fprofile-generate']
+    return []
+
+
+def _output(call_str, env):
+    process = Popen(call_str, shell=True, stdout=PIPE, env=env)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        return None
+    return output.decode('utf-8', 'replace')
+
+
+# Key of a profiled function, static functions are prefixed with their
+# file name ("file.c:f" or "file.c;f") and Mach-O symbols with an underscore
+def _function_key(name):
+    return name.split(';')[-1].split(':')[-1].lstrip('_')
+
+
+# Returns the profiles of a platform
+def profiles(platform):
+    if platform.build_name() not in _profiles:
+        _profiles[platform.build_name()] = Profiles(platform)
+    return _profiles[platform.build_name()]
+
+
+# Fingerprints of the profile data each optimized object was compiled with,
+# so retraining only recompiles the objects whose profile changed
+# gcc keeps a .gcda per object, the clang profile is split by the functions
+# the object defines
+class Profiles(object):
+    def __init__(self, platform):
+        self.__platform = platform
+        self.__stamps_path = os.path.join(profile_dir(platform), 'stamps.json')
+        self.__stamps = {}
+        self.__changed = False
+        # Function key -> [profile records], loaded once per run
+        self.__functions = None
+        try:
+            with open(self.__stamps_path) as f:
+                self.__stamps = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def __load_functions(self):
+        self.__functions = {}
+        profdata = os.path.join(profile_dir(self.__platform), PROFDATA)
+        if not os.path.exists(profdata):
+            return
+        text = _output(self.__platform.llvm_tool('llvm-profdata') + ' merge --text -o - ' + profdata,
+                       self.__platform.var_env())
+        # Records are separated by blank lines and start with the function name
+        for record in (text or '').split('\n\n'):
+            lines = [line for line in record.strip().splitlines()
+                     if line and not line.startswith('#') and not line.startswith(':')]
+            if lines:
+                self.__functions.setdefault(_function_key(lines[0]), []).append(record.strip())
+
+    # Returns the functions defined in an object, cached until it changes
+    def __symbols(self, obj_path):
+        stamp = self.__stamps.get(obj_path, {})
+        mtime = stat_cache.mtime(obj_path)
+        if stamp.get('mtime') == mtime and 'symbols' in stamp:
+            return stamp['symbols']
+        output = _output(self.__platform.llvm_tool('llvm-nm') + ' --defined-only -j ' + obj_path,
+                         self.__platform.var_env())
+        symbols = sorted(set(_function_key(line.strip()) for line in (output or '').splitlines()
+                             if line.strip()))
+        stamp = dict(stamp, mtime=mtime, symbols=symbols)
+        self.__stamps[obj_path] = stamp
+        self.__changed = True
+        return symbols
+
+    # Returns a hash of the profile data of an object, None without profile
+    def __fingerprint(self, obj_path, install_dir):
+        if amigo_config.GCC:
+            relative = os.path.relpath(os.path.abspath(obj_path), os.path.abspath(install_dir))
+            gcda = os.path.join(raw_dir(self.__platform),
+                                os.path.splitext(relative)[0].replace(os.sep, '#') + '.gcda')
+            try:
+                with open(gcda, 'rb') as f:
+                    return hashlib.md5(f.read()).hexdigest()
+            except (IOError, OSError):
+                return None
+        if self.__functions is None:
+            self.__load_functions()
+        if not self.__functions:
+            return None
+        md5 = hashlib.md5()
+        for symbol in self.__symbols(obj_path):
+            for record in self.__functions.get(symbol, []):
+                md5.update(record.encode('utf-8'))
+        return md5.hexdigest()
+
+    # Whether the profile of an existing object changed since it was compiled
+    def changed(self, obj_path, install_dir):
+        stamp = self.__stamps.get(obj_path, {})
+        return stamp.get('profile') != self.__fingerprint(obj_path, install_dir)
+
+    # Records the profile an object was just compiled with
+    def record(self, obj_path, install_dir):
+        stamp = self.__stamps.get(obj_path, {})
+        stamp['profile'] = self.__fingerprint(obj_path, install_dir)
+        self.__stamps[obj_path] = stamp
+        self.__changed = True
+
+    def save(self):
+        if not self.__changed:
+            return
+        write_json(self.__stamps_path, self.__stamps)
+        self.__changed = False
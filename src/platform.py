@@ -1,75 +1,102 @@
 from subprocess import call
+from contextlib import contextmanager
+from flag_list import FlagList, PathList
+from job_scheduler import default_jobs
 import amigo_config
+import launcher
 import shutil
 import os
 
-
-def crush_deps(platform, install_dir, output_name, ldflags=''):
-    cwd = os.getcwd()
-    ar = platform.flags('AR')
-    lipo = platform.flags('LIPO')
-    cc = platform.flags('CXX')
-    tmp_path = os.path.join(install_dir, 'tmp')
+# Build variants -> flags appended to the compile and link flags
+# AmigoMakefiles can define more in a VARIANTS dict
+VARIANTS = {
+    'release': '-Os',
+    'debug': '-g -ggdb -O0',
+}
+# Variant building into the plain per-platform dirs
+DEFAULT_VARIANT = 'release'
+
+
+# Crushes the static libs of an install dir into one static lib (and a
+# shared lib on iOS)
+# Optional: ThinLTO cache dir when the libs hold LTO objects, they are then
+# archived with the platform's LTO archiver so the symbol index covers them
+# Each output is extracted in its own tmp dir and renamed into lib once
+# complete, so packages crushing the same install dir don't collide
+def crush_deps(platform, install_dir, output_name, ldflags='', lto_cache_dir=None):
+    ar = launcher.split(platform.flags('AR'))
+    ldflags = launcher.split(ldflags)
+    if lto_cache_dir:
+        ar = launcher.split(platform.lto_ar())
+        ldflags += platform.lto_link_flags(lto_cache_dir)
+    lipo = launcher.split(platform.flags('LIPO'))
+    cc = launcher.split(platform.flags('CXX'))
+    tmp_path = os.path.join(install_dir, 'tmp', output_name)
     lib_path = os.path.join(install_dir, 'lib')
-    output = os.path.join(lib_path, output_name)
+    output = os.path.join(tmp_path, output_name)
     if os.path.exists(tmp_path):
         shutil.rmtree(tmp_path)
     os.makedirs(tmp_path)
-    # Find lib files
-    lib_files = []
-    for (dirpath, dirnames, filenames) in os.walk(lib_path):
-        for filename in filenames:
-            if filename.endswith('.a'):
-                path = os.path.join(dirpath, filename)
-                if not os.path.islink(path):
-                    lib_files.append((path, filename[:-2]))
+    lib_files = [(path, os.path.basename(path)[:-2]) for path in crushed_libs(install_dir)]
+    obj_files = []
     for lib_file, lib_name in lib_files:
         extract_path = os.path.join(tmp_path, lib_name)
         if os.path.exists(extract_path):
             shutil.rmtree(extract_path)
         os.makedirs(extract_path)
-        os.chdir(extract_path)
-        call_str = ar + " -x " + lib_file
-        if amigo_config.VERBOSE:
-            print (call_str)
-        call([call_str], shell=True)
-        files = os.listdir(extract_path)
+        _run_tool(ar + ['-x', os.path.abspath(lib_file)], extract_path)
         i = 0
-        for file in files:
+        for file in os.listdir(extract_path):
             if file.endswith('.o'):
-                os.rename (file, lib_name+"_" + str(i) +".o")
+                obj_file = os.path.join(extract_path, lib_name + "_" + str(i) + ".o")
+                os.rename(os.path.join(extract_path, file), obj_file)
+                obj_files.append(obj_file)
                 i += 1
         if lipo:
-            call_str = lipo + ' -create -arch ' + platform.arch() + ' ' + lib_file + ' -output ' + lib_file
-            if amigo_config.VERBOSE:
-                print (call_str)
-            call([call_str], shell=True)
+            _run_tool(lipo + ['-create', '-arch', platform.arch(), lib_file, '-output', lib_file])
     status = False
-    os.chdir(tmp_path)
     if lib_files:
-        ar_flag = 'crus'
-        obj_files = tmp_path + "/*/*.o"
-        call_str = ar + ' ' + ar_flag + ' ' + output + '.a' + " " + obj_files
-        if amigo_config.VERBOSE:
-            print (call_str)
-        call([call_str], shell=True)
+        obj_files.sort()
+        _run_tool(ar + ['crus', output + '.a'] + obj_files, tmp_path)
         if lipo:
-            call_str = lipo + ' -create -arch ' + platform.arch() + ' ' + output + '.a' + ' -output ' + output + '.a'
-            if amigo_config.VERBOSE:
-                print (call_str)
-            call([call_str], shell=True)
-        call_str = (cc + " -shared -o " + output + '.so' +
-                    " -Wl,-force_load " + obj_files + " " + ldflags)
-        if amigo_config.VERBOSE:
-            print (call_str)
-        call([call_str], shell=True)
+            _run_tool(lipo + ['-create', '-arch', platform.arch(), output + '.a', '-output', output + '.a'])
+        _run_tool(cc + ['-shared', '-o', output + '.so', '-Wl,-force_load'] + obj_files + ldflags, tmp_path)
+        for ext in ('.a', '.so'):
+            if os.path.exists(output + ext):
+                os.rename(output + ext, os.path.join(lib_path, output_name + ext))
         status = True
-    os.chdir(cwd)
     return status
 
 
+# Returns the static libs of an install dir crush_deps extracts, without the
+# libs crushed from them (libdeps_*)
+def crushed_libs(install_dir):
+    lib_files = []
+    for (dirpath, dirnames, filenames) in os.walk(os.path.join(install_dir, 'lib')):
+        for filename in filenames:
+            if filename.endswith('.a') and not filename.startswith('libdeps_'):
+                path = os.path.join(dirpath, filename)
+                if not os.path.islink(path):
+                    lib_files.append(path)
+    return sorted(lib_files)
+
+
+# Runs a tool of crush_deps, its status is ignored like the libs that fail
+# to extract
+def _run_tool(argv, cwd=None):
+    if amigo_config.VERBOSE:
+        print (launcher.command_line(argv))
+    result = launcher.run(argv, cwd=cwd)
+    if result.output:
+        launcher.print_output(None, result.output)
+
+
 class Platform(object):
     CONFIG_FLAGS = 'configure_flags'
+    # Environment vars kept as deduplicated token lists, rendered to strings
+    # when the environment is passed to a process
+    FLAG_KEYS = ('CFLAGS', 'CPPFLAGS', 'CXXFLAGS', 'OBJCFLAGS', 'LDFLAGS')
+    PATH_KEYS = ('LD_LIBRARY_PATH', 'DYLD_LIBRARY_PATH', 'PKG_CONFIG_PATH')
 
     def __init__(self, name, arch, sdk_path=None):
         self.__name = name
@@ -78,7 +105,12 @@ class Platform(object):
         self.__env = Environment()
         self._toolchain = None
         self.__var_env = os.environ.copy()
+        # FLAG_KEYS and PATH_KEYS -> FlagList/PathList
+        self.__flags = {}
+        self.__rendered_env = None
+        self.__scopes = []
         self.__default_flags = {}
+        self.__variant = DEFAULT_VARIANT
         self._set_default_flags('AR', "ar")
         cxx_modifiers = ''
         if amigo_config.CXX11:
@@ -97,6 +129,20 @@ class Platform(object):
     def unique_name(self):
         return self.__name
 
+    # Build variant (eg. release, debug)
+    def variant(self):
+        return self.__variant
+
+    def set_variant(self, variant):
+        self.__variant = variant
+
+    # Unique name of the platform and variant, outputs of different
+    # variants are kept apart (eg. native_x86-debug)
+    def build_name(self):
+        if self.__variant == DEFAULT_VARIANT:
+            return self.unique_name()
+        return self.unique_name() + '-' + self.__variant
+
     # Target Architecture (eg. armv7)
     def arch(self):
         return self.__arch
@@ -118,15 +164,64 @@ class Platform(object):
     # Optional: takes additional environment variable to initialize
     def init_env_vars(self, env_vars=None):
         self.__var_env = os.environ.copy()
+        self.__flags = {}
+        for flag_key in list(self.__var_env):
+            if flag_key in Platform.FLAG_KEYS or flag_key in Platform.PATH_KEYS:
+                self.set_flags(flag_key, self.__var_env.pop(flag_key))
         for flag_key in self.__default_flags:
-            self.__var_env[flag_key] = self.default_flags(flag_key)
+            self.set_flags(flag_key, self.default_flags(flag_key))
         if env_vars:
             for flag_key in env_vars:
-                self.__var_env[flag_key] = env_vars[flag_key]
+                self.set_flags(flag_key, env_vars[flag_key])
+        self.__rendered_env = None
 
     # Environment Variables
     def var_env(self):
-        return self.__var_env
+        if self.__rendered_env is None:
+            self.__rendered_env = dict(self.__var_env)
+            for flag_key, flag_list in self.__flags.items():
+                self.__rendered_env[flag_key] = str(flag_list)
+        return self.__rendered_env
+
+    # Restores the flags changed within the scope (eg. by a package's build)
+    # when it exits
+    @contextmanager
+    def flag_scope(self):
+        self.__scopes.append((dict(self.__var_env),
+                              dict((key, flag_list.copy()) for key, flag_list in self.__flags.items())))
+        try:
+            yield
+        finally:
+            self.__var_env, self.__flags = self.__scopes.pop()
+            self.__rendered_env = None
+
+    # Flags compiling objects for link-time optimization
+    # ThinLTO with clang, full LTO with gcc
+    def lto_compile_flags(self):
+        if amigo_config.GCC:
+            return ['-flto']
+        return ['-flto=thin']
+
+    # Flags linking LTO objects into a shared lib or executable
+    # cache_dir keeps ThinLTO code generation results between links
+    def lto_link_flags(self, cache_dir):
+        if amigo_config.GCC:
+            # gcc has no ThinLTO cache, partitions are optimized in parallel instead
+            return ['-flto=' + str(default_jobs())]
+        return ['-flto=thin', '-fuse-ld=lld', '-Wl,--thinlto-cache-dir=' + cache_dir]
+
+    # Archiver that indexes the symbols of LTO objects (gcc-ar or llvm-ar
+    # next to the compiler), plain ar would leave bitcode archives unlinkable
+    def lto_ar(self):
+        if amigo_config.GCC:
+            return (self.flags('CC') or self.default_flags('CC')).split()[0] + '-ar'
+        return self.llvm_tool('llvm-ar')
+
+    # Returns the command running an LLVM tool (llvm-ar, llvm-nm, llvm-profdata...)
+    # of the toolchain, looked up next to the compiler
+    def llvm_tool(self, name):
+        cc = (self.flags('CC') or self.default_flags('CC')).split()[0]
+        return os.path.join(os.path.dirname(cc), name)
 
     # Calls configure with the provided installation dir
     # Optional: takes additional environment variables
@@ -145,17 +240,14 @@ class Platform(object):
                 else:
                     print ('No install dir in package ' + dep.name() + ' for ' + self.name())
 
-        for dep_dir in dep_dirs:
+        # The flag lists drop the dirs that are already there
+        for dep_dir in sorted(dep_dirs):
             lib_path = os.path.join(dep_dir, "lib")
             inc_path = os.path.join(dep_dir, "include")
-            if not " -L" + lib_path in self.flags('LDFLAGS'):
-                self.append_flags('LDFLAGS', " -L" + lib_path)
-            if not lib_path in self.flags('LD_LIBRARY_PATH'):
-                self.append_flags('LD_LIBRARY_PATH', ":" + lib_path)
-            if not " -I" + lib_path in self.flags('CFLAGS'):
-                self.append_flags('CFLAGS', " -I" + inc_path)
-            if not " -I" + lib_path in self.flags('CXXFLAGS'):
-                self.append_flags('CXXFLAGS', " -I" + inc_path)
+            self.append_flags('LDFLAGS', ['-L' + lib_path])
+            self.append_flags('LD_LIBRARY_PATH', [lib_path])
+            self.append_flags('CFLAGS', ['-I' + inc_path])
+            self.append_flags('CXXFLAGS', ['-I' + inc_path])
 
         if configure is not None:
             if configure == "":
@@ -188,21 +280,41 @@ class Platform(object):
 
     # Retrieve all set flags for the provided key should
     def flags(self, key):
+        if key in self.__flags:
+            return str(self.__flags[key])
         if key in self.__var_env:
             return self.__var_env[key]
         else:
             return ""
 
+    # Returns the flags of a key as a list of tokens (eg. to build an argv)
+    def flag_tokens(self, key):
+        if key in self.__flags:
+            return self.__flags[key].tokens()
+        return FlagList(self.flags(key)).tokens()
+
     # Append additional flags to the provided environment var
+    # Flags are a string, or a list of tokens for FLAG_KEYS and PATH_KEYS
     def append_flags(self, key, flags):
-        if key in self.__var_env:
+        self.__rendered_env = None
+        if key in Platform.FLAG_KEYS or key in Platform.PATH_KEYS:
+            if key not in self.__flags:
+                self.set_flags(key, self.__var_env.pop(key, ''))
+            self.__flags[key].extend(flags)
+        elif key in self.__var_env:
             self.__var_env[key] += ' ' + flags
         else:
             self.__var_env[key] = flags
 
     # Sets flags for provided environment var
     def set_flags(self, key, flags):
-        self.__var_env[key] = flags
+        self.__rendered_env = None
+        if key in Platform.FLAG_KEYS:
+            self.__flags[key] = FlagList(flags)
+        elif key in Platform.PATH_KEYS:
+            self.__flags[key] = PathList(flags)
+        else:
+            self.__var_env[key] = flags
 
 
 class Environment(object):
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# Remote build cache over HTTP
+#
+# Entries are addressed by a hash of everything that produced them:
+#   GET <url>/<kind>/<key>  -> 200 with the entry, 404 if missing
+#   PUT <url>/<kind>/<key>  <- the entry
+# Kinds are 'obj' (object files, keyed by the preprocessed source, the
+# compile command and the compiler version) and 'pkg' (tar.gz of the files
+# an external package installed, keyed by its version, patches, flags and
+# platform).
+#
+# With --cache-mode ro entries are only read, with rw (default) builds also
+# upload what they produce. Any error or timeout disables the cache for the
+# rest of the run and the build continues without it.
+#
+# cache_server.py is a reference server storing entries in a directory.
+from __future__ import print_function
+from subprocess import Popen, PIPE, STDOUT
+from package import warn_str
+import amigo_config
+import hashlib
+import io
+import os
+import tarfile
+import tempfile
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+READ_ONLY = 'ro'
+READ_WRITE = 'rw'
+OBJECTS = 'obj'
+PACKAGES = 'pkg'
+
+# Set after the first error, the cache isn't used for the rest of the run
+_disabled = [False]
+# Compiler command -> hash of its --version output
+_compiler_ids = {}
+
+
+def enabled():
+    return bool(amigo_config.CACHE_URL) and not _disabled[0]
+
+
+def writable():
+    return enabled() and amigo_config.CACHE_MODE == READ_WRITE
+
+
+def _disable(error):
+    if not _disabled[0]:
+        print ('\t  CACHE\t' + warn_str('WARNING') + ': ' + amigo_config.CACHE_URL +
+               ' unavailable, building without the cache (' + str(error) + ')')
+    _disabled[0] = True
+
+
+# Checks the cache is reachable before the build starts (and before compile
+# workers are forked), so an unavailable cache is only reported once
+def check():
+    get(OBJECTS, '0' * 64)
+
+
+def _url(kind, key):
+    return amigo_config.CACHE_URL.rstrip('/') + '/' + kind + '/' + key
+
+
+# Returns a cache entry, None if it's missing or the cache is unavailable
+def get(kind, key):
+    if not enabled():
+        return None
+    try:
+        response = urlopen(_url(kind, key), timeout=amigo_config.CACHE_TIMEOUT)
+        try:
+            data = response.read()
+            length = response.headers.get('Content-Length')
+        finally:
+            response.close()
+        if length is not None and int(length) != len(data):
+            raise IOError('Truncated response')
+        return data
+    except HTTPError as e:
+        if e.code != 404:
+            _disable(e)
+    except Exception as e:
+        _disable(e)
+    return None
+
+
+# Stores a cache entry (rw mode only)
+def put(kind, key, data):
+    if not writable():
+        return
+    request = Request(_url(kind, key), data=data)
+    request.add_header('Content-Type', 'application/octet-stream')
+    request.get_method = lambda: 'PUT'
+    try:
+        urlopen(request, timeout=amigo_config.CACHE_TIMEOUT).close()
+    except Exception as e:
+        _disable(e)
+
+
+# Returns a hash of a compiler's version, so objects of different compiler
+# versions don't share keys
+def _compiler_id(cc, env):
+    if cc not in _compiler_ids:
+        try:
+            process = Popen(cc + ' --version', shell=True, stdout=PIPE, stderr=STDOUT, env=env)
+            output = process.communicate()[0]
+        except OSError:
+            output = b''
+        _compiler_ids[cc] = hashlib.sha256(output).hexdigest()
+    return _compiler_ids[cc]
+
+
+# Returns the key of the object compiled from a preprocessed source with
+# argv, in which the source and object paths are replaced by placeholders
+def object_key(cc, argv, source, env):
+    sha = hashlib.sha256()
+    sha.update(_compiler_id(cc, env).encode('utf-8'))
+    for arg in argv:
+        sha.update(b'\0' + arg.encode('utf-8'))
+    sha.update(b'\0\0' + source)
+    return sha.hexdigest()
+
+
+# Writes a cached object to output, returns whether there was one
+def fetch_object(key, output):
+    data = get(OBJECTS, key)
+    if data is None:
+        return False
+    _write_file(output, data)
+    return True
+
+
+def store_object(key, output):
+    if not writable():
+        return
+    with open(output, 'rb') as f:
+        put(OBJECTS, key, f.read())
+
+
+def _write_file(path, data):
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+# Returns the key of an external package install from the strings
+# describing it (name, version, platform, flags...) and its patch files
+def package_key(strings, files=()):
+    sha = hashlib.sha256()
+    for value in strings:
+        sha.update(b'\0' + value.encode('utf-8'))
+    for file_path in files:
+        with open(file_path, 'rb') as f:
+            sha.update(b'\0\0' + hashlib.sha256(f.read()).hexdigest().encode('utf-8'))
+    return sha.hexdigest()
+
+
+# Extracts a cached package install into install_dir, returns whether there
+# was one
+def fetch_package(key, install_dir):
+    data = get(PACKAGES, key)
+    if data is None:
+        return False
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as archive:
+            for member in archive.getmembers():
+                paths = [member.name]
+                if member.issym() or member.islnk():
+                    paths.append(os.path.join(os.path.dirname(member.name), member.linkname))
+                for path in paths:
+                    path = os.path.normpath(path)
+                    if path.startswith('..') or os.path.isabs(path):
+                        raise IOError('Invalid path in cache entry: ' + member.name)
+            archive.extractall(install_dir)
+    except (IOError, OSError, tarfile.TarError) as e:
+        _disable(e)
+        return False
+    return True
+
+
+# Packs files of install_dir (paths relative to it) and stores them
+def store_package(key, install_dir, files):
+    if not writable() or not files:
+        return
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as archive:
+        for file_path in sorted(files):
+            archive.add(os.path.join(install_dir, file_path), file_path, recursive=False)
+    put(PACKAGES, key, data.getvalue())
+
+
+# Returns {relative path: (mtime, size)} of the files in a directory, used
+# to find the files a package installed
+def snapshot(directory):
+    files = {}
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        dirnames[:] = [dirname for dirname in dirnames if dirname != '.amigo']
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            files[os.path.relpath(path, directory)] = (st.st_mtime, st.st_size)
+    return files
+
+
+# Returns the files added or changed since a snapshot
+def changed_files(directory, before):
+    after = snapshot(directory)
+    return [path for path, stat in after.items() if before.get(path) != stat]
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# Remote compilation over a simple worker protocol
+#
+# Sources are preprocessed locally and sent to a worker together with the
+# compiler command line; the worker compiles them and returns the object file.
+# Every message is a 4 byte big-endian header length, a JSON header and a
+# payload of header['size'] bytes:
+#   request:  {'argv': [...], 'suffix': '.ii', 'size': N} + preprocessed source
+#   response: {'status': 0, 'output': '...', 'size': M} + object file
+# In argv the INPUT and OUTPUT placeholders are replaced by the worker's
+# temporary source and object paths.
+#
+# Workers run any command line they are sent, so they should only listen on
+# interfaces reachable by trusted build machines (loopback by default).
+#
+# Start a worker with:
+#   python remote_compile.py [--host 127.0.0.1] [--port 8765] [--jobs N]
+from __future__ import print_function
+from subprocess import Popen, PIPE, STDOUT
+from multiprocessing import cpu_count
+import amigo_config
+import argparse
+import json
+import launcher
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 8765
+INPUT = '{input}'
+OUTPUT = '{output}'
+
+# Preprocessed source suffix by source extension
+PREPROCESSED_SUFFIXES = {
+    '.c': '.i',
+    '.cpp': '.ii',
+    '.cc': '.ii',
+    '.m': '.mi',
+    '.mm': '.mii',
+}
+
+# Workers that failed to connect, skipped for the rest of the process
+_dead_workers = set()
+_next_worker = [os.getpid()]
+
+
+def send_message(sock, header, payload=b''):
+    header = dict(header)
+    header['size'] = len(payload)
+    data = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(data)) + data + payload)
+
+
+def recv_message(sock):
+    header_len = struct.unpack('>I', _recv_exactly(sock, 4))[0]
+    header = json.loads(_recv_exactly(sock, header_len).decode('utf-8'))
+    payload = _recv_exactly(sock, header.get('size', 0))
+    return header, payload
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise IOError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+# Parses 'host:port' (port defaults to DEFAULT_PORT)
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    if not host:
+        return address, DEFAULT_PORT
+    return host, int(port)
+
+
+# Preprocesses file_path with the compiler and flags it's compiled with
+# Returns the preprocessed source, None if it isn't a C/C++/Objective-C
+# source or preprocessing failed
+def preprocess(cc, cflags, file_path, env):
+    suffix = PREPROCESSED_SUFFIXES.get(os.path.splitext(file_path)[1].lower())
+    if not suffix:
+        return None
+    tmp_dir = tempfile.mkdtemp(prefix='amigomake-pp-')
+    try:
+        preprocessed = os.path.join(tmp_dir, 'source' + suffix)
+        argv = launcher.split(cc) + ['-E', file_path, '-o', preprocessed] + cflags
+        if launcher.run(argv, env).status != 0:
+            return None
+        with open(preprocessed, 'rb') as f:
+            return f.read()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# Compiles file_path into output on one of the configured workers
+# The file is preprocessed locally with the same compiler and flags (unless
+# the preprocessed source is passed)
+# Returns True when the worker produced the object file, False when the
+# caller should fall back to compiling locally
+def compile_file(cc, cflags, file_path, output, env, source=None):
+    workers = amigo_config.REMOTE_WORKERS
+    suffix = PREPROCESSED_SUFFIXES.get(os.path.splitext(file_path)[1].lower())
+    if not workers or not suffix:
+        return False
+    if source is None:
+        source = preprocess(cc, cflags, file_path, env)
+        if source is None:
+            return False
+
+    argv = launcher.split(cc) + cflags + ['-c', INPUT, '-o', OUTPUT]
+    for address in _worker_order(workers):
+        try:
+            header, payload = _request(address, argv, suffix, source)
+        except (IOError, OSError, ValueError, socket.error) as e:
+            _dead_workers.add(address)
+            if amigo_config.VERBOSE:
+                print('\t  REMOTE\t' + address + ' unavailable (' + str(e) + ')')
+            continue
+        if header.get('status') != 0:
+            # Let the local compiler report the diagnostics
+            return False
+        with open(output, 'wb') as f:
+            f.write(payload)
+        if amigo_config.VERBOSE:
+            print('\t  REMOTE\t' + address + '\t' + file_path)
+            if header.get('output'):
+                print(header['output'])
+        return True
+    return False
+
+
+# Live workers in round robin order, starting from a different worker per call
+def _worker_order(workers):
+    live = [worker for worker in workers if worker not in _dead_workers]
+    if not live:
+        return []
+    start = _next_worker[0] % len(live)
+    _next_worker[0] += 1
+    return live[start:] + live[:start]
+
+
+def _request(address, argv, suffix, source):
+    sock = socket.create_connection(parse_address(address), amigo_config.REMOTE_TIMEOUT)
+    try:
+        send_message(sock, {'version': PROTOCOL_VERSION, 'argv': argv, 'suffix': suffix}, source)
+        return recv_message(sock)
+    finally:
+        sock.close()
+
+
+class CompileHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            header, source = recv_message(self.request)
+        except (IOError, ValueError):
+            return
+        with self.server.slots:
+            response, payload = self.server.compile(header, source)
+        send_message(self.request, response, payload)
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, jobs=None, compilers=None):
+        socketserver.TCPServer.__init__(self, address, CompileHandler)
+        self.slots = threading.Semaphore(jobs or cpu_count())
+        self.compilers = compilers
+
+    # Compiles a preprocessed source, returns the response header and object
+    def compile(self, header, source):
+        argv = header.get('argv')
+        suffix = header.get('suffix', '')
+        if (header.get('version') != PROTOCOL_VERSION or not argv or
+                os.path.basename(suffix) != suffix or not suffix.startswith('.')):
+            return {'status': -1, 'output': 'Invalid request'}, b''
+        if self.compilers and os.path.basename(argv[0]) not in self.compilers:
+            return {'status': -1, 'output': 'Compiler not allowed: ' + argv[0]}, b''
+        tmp_dir = tempfile.mkdtemp(prefix='amigomake-worker-')
+        try:
+            input_path = os.path.join(tmp_dir, 'source' + suffix)
+            output_path = os.path.join(tmp_dir, 'source.o')
+            with open(input_path, 'wb') as f:
+                f.write(source)
+            argv = [input_path if arg == INPUT else output_path if arg == OUTPUT else arg
+                    for arg in argv]
+            try:
+                process = Popen(argv, stdout=PIPE, stderr=STDOUT, cwd=tmp_dir)
+                output = process.communicate()[0].decode('utf-8', 'replace')
+                status = process.returncode
+            except OSError as e:
+                return {'status': -1, 'output': str(e)}, b''
+            payload = b''
+            if status == 0:
+                with open(output_path, 'rb') as f:
+                    payload = f.read()
+            return {'status': status, 'output': output}, payload
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='amigomake remote compile worker')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (127.0.0.1 by default)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    parser.add_argument('-j', '--jobs', type=int, help='Concurrent compiles (number of cores by default)')
+    parser.add_argument('--compiler', dest='compilers', action='append',
+                        help='Only accept this compiler (basename), may be specified multiple times')
+    params = parser.parse_args()
+    amigo_config.init()
+    server = WorkerServer((params.host, params.port), params.jobs, params.compilers)
+    print('amigomake worker listening on %s:%d' % server.server_address[:2])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+import os
+import stat
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+# Path -> modification time, None when the path isn't a regular file
+# Only kept while a build scope is open, so every file is stat'ed once per build
+_mtimes = None
+# Relative paths are keyed against the working directory the scope opened in
+_cwd = None
+# Path as passed -> normalized key
+_keys = None
+_depth = 0
+
+
+# Opens a build scope, scopes can be nested and the cache is dropped
+# when the outermost one closes
+@contextmanager
+def scope():
+    global _mtimes, _cwd, _keys, _depth
+    if _depth == 0:
+        _mtimes = {}
+        _keys = {}
+        _cwd = os.getcwd()
+    _depth += 1
+    try:
+        yield
+    finally:
+        _depth -= 1
+        if _depth == 0:
+            _mtimes = None
+            _keys = None
+            _cwd = None
+
+
+def _key(path):
+    key = _keys.get(path)
+    if key is None:
+        key = os.path.normpath(os.path.join(_cwd, path))
+        _keys[path] = key
+    return key
+
+
+def _regular_mtime(st):
+    if stat.S_ISREG(st.st_mode):
+        return st.st_mtime
+    return None
+
+
+def _stat_mtime(path):
+    try:
+        return _regular_mtime(os.stat(path))
+    except OSError:
+        return None
+
+
+# Returns the modification time of a regular file, None if it doesn't exist
+# (or isn't a regular file)
+def mtime(path):
+    if _mtimes is None:
+        return _stat_mtime(path)
+    key = _key(path)
+    if key in _mtimes:
+        return _mtimes[key]
+    value = _stat_mtime(path)
+    _mtimes[key] = value
+    return value
+
+
+def isfile(path):
+    return mtime(path) is not None
+
+
+# Caches the modification time of a directory entry returned by os.scandir
+def record(entry):
+    if _mtimes is None:
+        return
+    try:
+        _mtimes[_key(entry.path)] = _regular_mtime(entry.stat())
+    except OSError:
+        _mtimes[_key(entry.path)] = None
+
+
+# Forgets a path, eg. after a build step wrote it
+def invalidate(path):
+    if _mtimes is not None:
+        _mtimes.pop(_key(path), None)
+
+
+# Walks a directory tree like os.walk (top down, symlinked dirs not followed)
+# Within a build scope the files for which wanted(filename) is true
+# (all files without a wanted function) get their modification time
+# cached from the directory entries
+def walk(top, wanted=None):
+    if scandir is None:
+        for dirpath, dirnames, filenames in os.walk(top):
+            yield dirpath, dirnames, filenames
+        return
+    pending = [top]
+    while pending:
+        dirpath = pending.pop()
+        try:
+            entries = list(scandir(dirpath))
+        except OSError:
+            continue
+        dirnames = []
+        filenames = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirnames.append(entry.name)
+                continue
+            filenames.append(entry.name)
+            if wanted is None or wanted(entry.name):
+                record(entry)
+        yield dirpath, dirnames, filenames
+        for dirname in reversed(dirnames):
+            path = os.path.join(dirpath, dirname)
+            if not os.path.islink(path):
+                pending.append(path)
@@ -0,0 +1,133 @@
+# Remote build cache against the reference server on loopback
+from __future__ import print_function
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+# src/platform.py shadows the standard module, which the test runner may
+# have imported already
+if not hasattr(sys.modules.get('platform'), 'crush_deps'):
+    sys.modules.pop('platform', None)
+
+import amigo_config
+amigo_config.init()
+
+from cache_server import CacheServer
+from cpackage import CPackage
+from x86_platform import X86Platform
+import remote_cache
+
+KEY = 'ab' * 32
+
+
+class RemoteCacheTest(unittest.TestCase):
+    def setUp(self):
+        amigo_config.init()
+        amigo_config.GCC = True
+        remote_cache._disabled[0] = False
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp(prefix='amigomake-test-')
+        os.chdir(self.tmp_dir)
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.server = CacheServer(('127.0.0.1', 0), self.cache_dir)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        amigo_config.CACHE_URL = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    # Returns the entries the server stores
+    def entries(self):
+        return sorted(filename for dirpath, dirnames, filenames in os.walk(self.cache_dir)
+                      for filename in filenames)
+
+    def test_put_get(self):
+        self.assertIsNone(remote_cache.get(remote_cache.OBJECTS, KEY))
+        remote_cache.put(remote_cache.OBJECTS, KEY, b'object')
+        self.assertEqual(remote_cache.get(remote_cache.OBJECTS, KEY), b'object')
+        self.assertIsNone(remote_cache.get(remote_cache.PACKAGES, KEY))
+        # Misses don't disable the cache
+        self.assertTrue(remote_cache.enabled())
+
+    def test_package_round_trip(self):
+        install_dir = os.path.join(self.tmp_dir, 'install')
+        os.makedirs(os.path.join(install_dir, 'include'))
+        with open(os.path.join(install_dir, 'include', 'old.h'), 'w') as f:
+            f.write('old')
+        before = remote_cache.snapshot(install_dir)
+        os.makedirs(os.path.join(install_dir, 'lib'))
+        with open(os.path.join(install_dir, 'lib', 'libnew.a'), 'w') as f:
+            f.write('new')
+        changed = remote_cache.changed_files(install_dir, before)
+        self.assertEqual(changed, [os.path.join('lib', 'libnew.a')])
+        remote_cache.store_package(KEY, install_dir, changed)
+
+        restored_dir = os.path.join(self.tmp_dir, 'restored')
+        self.assertTrue(remote_cache.fetch_package(KEY, restored_dir))
+        with open(os.path.join(restored_dir, 'lib', 'libnew.a')) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertFalse(os.path.exists(os.path.join(restored_dir, 'include')))
+        self.assertFalse(remote_cache.fetch_package('cd' * 32, restored_dir))
+
+    def test_read_only(self):
+        remote_cache.put(remote_cache.OBJECTS, KEY, b'object')
+        amigo_config.CACHE_MODE = remote_cache.READ_ONLY
+        self.assertFalse(remote_cache.writable())
+        remote_cache.put(remote_cache.OBJECTS, 'cd' * 32, b'other')
+        self.assertEqual(self.entries(), [KEY])
+        self.assertEqual(remote_cache.get(remote_cache.OBJECTS, KEY), b'object')
+
+    def test_build_uses_cache(self):
+        build_dir = self.write_package()
+        self.build_package()
+        self.assertEqual(len(self.entries()), 1)
+        shutil.rmtree(build_dir)
+        self.build_package()
+        self.assertIn(' (cached)', self.output)
+
+    def test_unreachable_cache(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        amigo_config.CACHE_URL = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+        amigo_config.CACHE_TIMEOUT = 2
+        remote_cache.check()
+        self.assertFalse(remote_cache.enabled())
+        self.write_package()
+        self.build_package()
+
+    # Writes a package with one source, returns its build dir
+    def write_package(self):
+        os.makedirs(os.path.join('lib', 'src'))
+        with open(os.path.join('lib', 'src', 'answer.c'), 'w') as f:
+            f.write('int answer(void) { return 42; }\n')
+        return os.path.join('lib', 'build')
+
+    # Builds the package, checks its object was written and keeps the output
+    def build_package(self):
+        stdout = sys.stdout
+        sys.stdout = output = tempfile.TemporaryFile('w+')
+        try:
+            CPackage('lib', CPackage.STATIC_LIB, 'answer').build(X86Platform('x86_64'))
+        finally:
+            sys.stdout = stdout
+        output.seek(0)
+        self.output = output.read()
+        output.close()
+        objects = [filename for dirpath, dirnames, filenames in os.walk(os.path.join('lib', 'build'))
+                   for filename in filenames if filename.endswith('.o')]
+        self.assertEqual(len(objects), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# Remote compilation against local workers on loopback
+from __future__ import print_function
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+# src/platform.py shadows the standard module, which the test runner may
+# have imported already
+if not hasattr(sys.modules.get('platform'), 'crush_deps'):
+    sys.modules.pop('platform', None)
+
+import amigo_config
+amigo_config.init()
+
+from cpackage import CPackage
+from x86_platform import X86Platform
+import remote_compile
+
+SOURCE = b'int answer(void) { return 42; }\n'
+
+
+# Worker counting the compiles it ran
+class CountingWorker(remote_compile.WorkerServer):
+    def __init__(self, address, compilers=None):
+        remote_compile.WorkerServer.__init__(self, address, 2, compilers)
+        self.compiles = 0
+
+    def compile(self, header, source):
+        self.compiles += 1
+        return remote_compile.WorkerServer.compile(self, header, source)
+
+
+# Returns a loopback address nothing listens on
+def unused_address():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = '127.0.0.1:%d' % sock.getsockname()[1]
+    sock.close()
+    return address
+
+
+class RemoteCompileTest(unittest.TestCase):
+    def setUp(self):
+        amigo_config.init()
+        amigo_config.GCC = True
+        remote_compile._dead_workers.clear()
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp(prefix='amigomake-test-')
+        os.chdir(self.tmp_dir)
+        os.makedirs(os.path.join('lib', 'src'))
+        self.source = os.path.join(self.tmp_dir, 'lib', 'src', 'answer.c')
+        with open(self.source, 'wb') as f:
+            f.write(SOURCE)
+        self.platform = X86Platform('x86_64')
+        self.cc = self.platform.default_flags('CC')
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    # Starts a worker in a thread, returns it and its address
+    def start_worker(self, compilers=None):
+        server = CountingWorker(('127.0.0.1', 0), compilers)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return server, '127.0.0.1:%d' % server.server_address[1]
+
+    # Builds the package with the workers, returns its object file
+    def build_package(self, workers):
+        amigo_config.REMOTE_WORKERS = workers
+        package = CPackage('lib', CPackage.STATIC_LIB, 'answer')
+        package.build(self.platform)
+        objects = [os.path.join(dirpath, filename)
+                   for dirpath, dirnames, filenames in os.walk(os.path.join('lib', 'build'))
+                   for filename in filenames if filename.endswith('.o')]
+        self.assertEqual(len(objects), 1)
+        return objects[0]
+
+    def test_worker_compiles(self):
+        server, address = self.start_worker()
+        amigo_config.REMOTE_WORKERS = [address]
+        output = os.path.join(self.tmp_dir, 'answer.o')
+        self.assertTrue(remote_compile.compile_file(self.cc, ['-O2'], self.source, output, os.environ))
+        self.assertEqual(server.compiles, 1)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(4), b'\x7fELF')
+
+    def test_unreachable_worker(self):
+        address = unused_address()
+        amigo_config.REMOTE_WORKERS = [address]
+        output = os.path.join(self.tmp_dir, 'answer.o')
+        self.assertFalse(remote_compile.compile_file(self.cc, [], self.source, output, os.environ))
+        self.assertIn(address, remote_compile._dead_workers)
+        self.assertFalse(os.path.exists(output))
+        self.assertTrue(os.path.getsize(self.build_package([address])) > 0)
+
+    def test_worker_error(self):
+        server, address = self.start_worker(compilers=['not-a-compiler'])
+        amigo_config.REMOTE_WORKERS = [address]
+        output = os.path.join(self.tmp_dir, 'answer.o')
+        self.assertFalse(remote_compile.compile_file(self.cc, [], self.source, output, os.environ))
+        self.assertNotIn(address, remote_compile._dead_workers)
+        self.assertTrue(os.path.getsize(self.build_package([address])) > 0)
+        self.assertEqual(server.compiles, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()